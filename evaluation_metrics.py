@@ -4,6 +4,10 @@ import time
 
 import json 
 
+import multiprocessing 
+from collections import deque 
+from concurrent.futures import ProcessPoolExecutor 
+
 
 from sklearn.cluster import DBSCAN
 
@@ -13,16 +17,24 @@ import torch
 
 import torch.nn.functional as F
 
+from manip.data.sdf_grid import load_sdf_grid, sample_sdf
+
 def get_frobenious_norm_rot_only(x, y):
     # x, y: N X 3 X 3 
-    error = 0.0
-    for i in range(len(x)):
-        x_mat = x[i][:3, :3]
-        y_mat_inv = np.linalg.inv(y[i][:3, :3])
-        error_mat = np.matmul(x_mat, y_mat_inv)
-        ident_mat = np.identity(3)
-        error += np.linalg.norm(ident_mat - error_mat, 'fro')
-    return error / len(x)
+    return get_frobenious_norm_rot_only_batch(x[None], y[None])[0]
+
+def get_frobenious_norm_rot_only_batch(x, y):
+    # x, y: BS X N X 3 X 3 
+    # Returns BS, the mean Frobenius norm of I - x y^-1 over N. 
+    x_mat = x[:, :, :3, :3]
+    y_mat_inv = np.linalg.inv(y[:, :, :3, :3])
+    error_mat = np.matmul(x_mat, y_mat_inv)
+    ident_mat = np.identity(3)
+    error = np.linalg.norm(ident_mat - error_mat, 'fro', axis=(-2, -1)) # BS X N 
+
+    # Accumulate sequentially in the same order as a per-matrix loop. 
+    error = np.add.accumulate(error, axis=1)[:, -1] 
+    return error / x.shape[1]
 
 def get_foot_sliding(
     verts,
@@ -30,16 +42,14 @@ def get_foot_sliding(
     threshold = 0.01  # 1 cm/frame
 ):
     # verts: T X Nv X 3
-    vert_velocities = []
     up_coord = 2 if up == "z" else 1
     lowest_vert_idx = np.argmin(verts[:, :, up_coord], axis=1)
-    for frame in range(1, verts.shape[0] - 1):
-        vert_idx = lowest_vert_idx[frame]
-        vel = np.linalg.norm(
-            verts[frame + 1, vert_idx, :] - verts[frame - 1, vert_idx, :]
-        ) / 2
-        vert_velocities.append(vel)
-    return np.sum(np.array(vert_velocities) > threshold) / verts.shape[0] * 100
+    frame_idx = np.arange(1, verts.shape[0] - 1)
+    vert_idx = lowest_vert_idx[frame_idx]
+    vert_velocities = np.linalg.norm(
+        verts[frame_idx + 1, vert_idx, :] - verts[frame_idx - 1, vert_idx, :], axis=1
+    ) / 2
+    return np.sum(vert_velocities > threshold) / verts.shape[0] * 100
 
 def determine_floor_height_and_contacts(body_joint_seq, fps=30):
     '''
@@ -233,7 +243,7 @@ def compute_collision_old(ori_verts_pred, human_faces, obj_verts, obj_faces, act
     return mean_collide_depth, collision_percent 
 
 def compute_collision(ori_verts_pred, human_faces, obj_verts, obj_faces, \
-    obj_name, obj_scale, obj_rot_mat, obj_trans, actual_len): 
+    obj_name, obj_scale, obj_rot_mat, obj_trans, actual_len, use_sparse_sdf=False): 
     # ori_verts_pred: T X Nv X 3 
     # human_faces: Nf X 3 
     # obj_verts: T X Nv' X 3 
@@ -242,12 +252,13 @@ def compute_collision(ori_verts_pred, human_faces, obj_verts, obj_faces, \
     # obj_rot_mat: T X 3 X 3 
     # obj_trans: T X 3 
     # actual_len: scalar value 
+    # use_sparse_sdf: query a narrow-band SparseSDFGrid instead of the dense grid. 
 
     object_sdf_folder = "/move/u/jiamanli/datasets/FullBodyManipCapture/rest_object_sdf_256_npy_files"
 
     # Load sdf 
     sdf_path = os.path.join(object_sdf_folder, obj_name+"_cleaned_simplified.obj.npy")
-    sdf_data = np.load(sdf_path) # 256 X 256 X 256 
+    sdf = load_sdf_grid(sdf_path, use_sparse=use_sparse_sdf) # 1 X 256 X 256 X 256 
 
     # Convert human vertices to align with the initial object geometry. 
     tmp_verts = (ori_verts_pred - obj_trans[:, None, :]) * (1/obj_scale[:, None, None]) # T X Nv X 3 
@@ -281,12 +292,8 @@ def compute_collision(ori_verts_pred, human_faces, obj_verts, obj_faces, \
         sdf_extents = np.asarray(sdf_json_data['extents']) # 3 
 
         query_human_verts = (transformed_human_verts - sdf_centroid) * 2 / sdf_extents.max() # T X Nv X 3 
-    
-    query_human_verts = query_human_verts[:,:,[2, 1, 0]] # T X Nv X 3 
 
     vis_debug = False
-            
-    sdf = torch.from_numpy(sdf_data).float() # 256 X 256 X 256 
 
     pen_thresh = 0.04
     pen_loss = torch.tensor(0.0)
@@ -294,26 +301,24 @@ def compute_collision(ori_verts_pred, human_faces, obj_verts, obj_faces, \
     pen_cnt = 0 
 
     num_steps = transformed_human_verts.shape[0]
-    for t_idx in range(num_steps):    
-        signed_dists = F.grid_sample(sdf.unsqueeze(0).unsqueeze(0), \
-            query_human_verts[t_idx].reshape(1, nv, 1, 1, 3).float(), padding_mode='border', align_corners=True) # 
-        signed_dists = signed_dists.squeeze()
 
-        # Apply scale to the signed distance. 
-        signed_dists = signed_dists * obj_scale[t_idx] 
+    # Query all the frames in one call. 
+    all_signed_dists = sample_sdf(sdf, query_human_verts.float()) # T X Nv 
 
-        neg_dists_mask = signed_dists.lt(0).flatten()
-        neg_dists = torch.abs(signed_dists[neg_dists_mask])
-        if len(neg_dists) != 0:
-            pen_mask = neg_dists.gt(pen_thresh).flatten()
+    # Apply scale to the signed distance. 
+    all_signed_dists = all_signed_dists * obj_scale[:num_steps, None] 
 
-            actual_neg_dists = neg_dists[pen_mask]
+    # Penetrating vertices are the ones inside the object deeper than the threshold. 
+    pen_mask = all_signed_dists.lt(0) & torch.abs(all_signed_dists).gt(pen_thresh) # T X Nv 
+    pen_frame_cnt = pen_mask.sum(dim=1) # T 
+    pen_frame_sum = (torch.abs(all_signed_dists) * pen_mask).sum(dim=1) # T 
 
-            if len(actual_neg_dists) > 0:
-                pen_loss += actual_neg_dists.mean()
-                # pen_loss += neg_dists.sum()
+    for t_idx in range(num_steps):    
+        if pen_frame_cnt[t_idx] > 0:
+            pen_loss += pen_frame_sum[t_idx] / pen_frame_cnt[t_idx]
+            # pen_loss += neg_dists.sum()
 
-                pen_cnt += 1
+            pen_cnt += 1
 
         if vis_debug:
             debug_human_mesh = trimesh.Trimesh(
@@ -351,6 +356,89 @@ def compute_collision(ori_verts_pred, human_faces, obj_verts, obj_faces, \
     # print("Pen loss:{0}".format(pen_loss.item()))
     return pen_percent, pen_loss.item() 
 
+def accumulate_float32(values):
+    # Sum a float32 array sequentially, same rounding as adding 0-d tensors one by one in a loop. 
+    # Returns a 0-d array. 
+    return np.add.accumulate(values.astype(np.float32))[-1:].reshape(())
+
+def compute_hand2obj_dist_min(hand_jnt, obj_verts_list, max_chunk_elems=2**27):
+    # hand_jnt: BS X T X 3 
+    # obj_verts_list: BS tensors of T X No X 3, the number of object vertices can differ. 
+    # Returns BS X T, the distance from the hand joint to the closest object vertex in each frame. 
+    bs, num_steps, _ = hand_jnt.shape 
+
+    # Pad with copies of the first vertex, duplicated vertices do not change the minimum. 
+    max_obj_verts = max([obj_verts.shape[1] for obj_verts in obj_verts_list])
+    padded_obj_verts_list = []
+    for obj_verts in obj_verts_list:
+        obj_verts = obj_verts.to(hand_jnt.device)
+        if obj_verts.shape[1] < max_obj_verts:
+            obj_verts = torch.cat((obj_verts, obj_verts[:, 0:1, :].repeat(1, \
+                        max_obj_verts-obj_verts.shape[1], 1)), dim=1)
+        padded_obj_verts_list.append(obj_verts)
+
+    # Evaluate several sequences together while the distance tensor stays under the memory budget. 
+    chunk_size = max(1, max_chunk_elems // (num_steps * max_obj_verts * 3))
+    dist_min_list = []
+    for b_idx in range(0, bs, chunk_size):
+        obj_verts = torch.stack(padded_obj_verts_list[b_idx:b_idx+chunk_size]) # BS' X T X No X 3 
+        hand2obj_dist = torch.sqrt(((hand_jnt[b_idx:b_idx+chunk_size, :, None, :] - obj_verts)**2).sum(dim=-1)) # BS' X T X No 
+        dist_min_list.append(hand2obj_dist.min(dim=2)[0]) # BS' X T 
+
+    return torch.cat(dist_min_list, dim=0) # BS X T 
+
+def compute_foot_sliding_metrics(ori_jpos_gt, ori_jpos_pred):
+    # ori_jpos_gt, ori_jpos_pred: T X J X 3, numpy arrays 
+    # Only uses numpy and DBSCAN, so it can run in a worker process. 
+    gt_floor_height = determine_floor_height_and_contacts(ori_jpos_gt, fps=30)
+    floor_height = determine_floor_height_and_contacts(ori_jpos_pred, fps=30)
+
+    gt_foot_sliding_jnts = compute_foot_sliding_for_smpl(ori_jpos_gt.copy(), gt_floor_height)
+    foot_sliding_jnts = compute_foot_sliding_for_smpl(ori_jpos_pred.copy(), floor_height)
+
+    return gt_foot_sliding_jnts, foot_sliding_jnts, gt_floor_height, floor_height 
+
+class MetricWorkerPool:
+    # Runs CPU-only metrics in worker processes while the caller keeps generating samples. 
+    # At most max_pending jobs are in flight, submit waits for the oldest one when the queue is full. 
+    # Finished jobs are returned in submission order. 
+    def __init__(self, num_workers, max_pending=16):
+        # Spawn the workers, forked children must not touch the parent's CUDA context. 
+        self.executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"))
+        self.max_pending = max(max_pending, 1)
+        self.pending = deque() 
+
+    def pop_oldest(self):
+        key, future = self.pending.popleft()
+        return key, future.result()
+
+    def submit(self, key, fn, *args):
+        # Returns the (key, result) pairs of the jobs that are finished so far. 
+        finished_list = []
+        while len(self.pending) >= self.max_pending:
+            finished_list.append(self.pop_oldest())
+
+        self.pending.append((key, self.executor.submit(fn, *args)))
+
+        return finished_list + self.collect_finished()
+
+    def collect_finished(self):
+        finished_list = []
+        while len(self.pending) > 0 and self.pending[0][1].done():
+            finished_list.append(self.pop_oldest())
+
+        return finished_list 
+
+    def drain(self):
+        finished_list = []
+        while len(self.pending) > 0:
+            finished_list.append(self.pop_oldest())
+
+        return finished_list 
+
+    def shutdown(self):
+        self.executor.shutdown()
+
 def compute_metrics(ori_verts_gt, ori_verts_pred, ori_jpos_gt, ori_jpos_pred, human_faces, \
     gt_trans, pred_trans, gt_rot_mat, pred_rot_mat, gt_obj_com_pos, pred_obj_com_pos, \
     gt_obj_rot_mat, pred_obj_rot_mat, gt_obj_verts, pred_obj_verts, obj_faces, \
@@ -364,24 +452,24 @@ def compute_metrics(ori_verts_gt, ori_verts_pred, ori_jpos_gt, ori_jpos_pred, hu
     # human_faces: Nf X 3, array  
     # obj_verts: T X No X 3
     # obj_faces: Nf X 3, array  
-    # gt_contact_label: T X 2 (left palm, right palm)
-    # pred_contact_label: T X 2
     # actual_len: scale value 
+    return compute_metrics_batch([ori_verts_gt], [ori_verts_pred], [ori_jpos_gt], [ori_jpos_pred], \
+        [gt_trans], [pred_trans], [gt_rot_mat], [pred_rot_mat], [gt_obj_com_pos], [pred_obj_com_pos], \
+        [gt_obj_rot_mat], [pred_obj_rot_mat], [gt_obj_verts], [pred_obj_verts], use_joints24=use_joints24)[0]
 
-    # ori_verts_gt = ori_verts_gt[:actual_len]
-    # ori_verts_pred = ori_verts_pred[:actual_len]
-    # ori_jpos_gt = ori_jpos_gt[:actual_len]
-    # ori_jpos_pred = ori_jpos_pred[:actual_len]
-    # gt_trans = gt_trans[:actual_len]
-    # pred_trans = pred_trans[:actual_len]
-    # gt_rot_mat = gt_rot_mat[:actual_len]
-    # pred_rot_mat = pred_rot_mat[:actual_len]
-    # gt_obj_com_pos = gt_obj_com_pos[:actual_len]
-    # pred_obj_com_pos = pred_obj_com_pos[:actual_len] 
-    # gt_obj_rot_mat = gt_obj_rot_mat[:actual_len]
-    # pred_obj_rot_mat = pred_obj_rot_mat[:actual_len] 
-    # gt_obj_verts = gt_obj_verts[:actual_len]
-    # pred_obj_verts = pred_obj_verts[:actual_len]
+def compute_metrics_batch(ori_verts_gt, ori_verts_pred, ori_jpos_gt, ori_jpos_pred, \
+    gt_trans, pred_trans, gt_rot_mat, pred_rot_mat, gt_obj_com_pos, pred_obj_com_pos, \
+    gt_obj_rot_mat, pred_obj_rot_mat, gt_obj_verts, pred_obj_verts, use_joints24=True, compute_foot_sliding=True):
+    # Each argument is a list of BS per-sequence tensors with the same shapes as in compute_metrics, 
+    # all the sequences have the same number of frames T. Object vertices can differ in number.
+    # Returns a list of BS tuples, each one is the output of compute_metrics for that sequence. 
+    # With compute_foot_sliding=False, the foot sliding and floor height entries are None. 
+    bs = len(ori_jpos_pred)
+
+    ori_verts_gt = torch.stack([v.to(ori_jpos_pred[0].device) for v in ori_verts_gt]) # BS X T X Nv X 3 
+    ori_verts_pred = torch.stack([v.to(ori_jpos_pred[0].device) for v in ori_verts_pred]) # BS X T X Nv X 3 
+    ori_jpos_gt = torch.stack([v.to(ori_jpos_pred[0].device) for v in ori_jpos_gt]) # BS X T X J X 3 
+    ori_jpos_pred = torch.stack(ori_jpos_pred) # BS X T X J X 3 
 
     # Calculate global hand joint position error 
     if use_joints24:
@@ -390,167 +478,141 @@ def compute_metrics(ori_verts_gt, ori_verts_pred, ori_jpos_gt, ori_jpos_pred, hu
     else:
         lhand_idx = 20
         rhand_idx = 21
-    lhand_jpos_pred = ori_jpos_pred[:, lhand_idx, :].detach().cpu().numpy() 
-    rhand_jpos_pred = ori_jpos_pred[:, rhand_idx, :].detach().cpu().numpy() 
-    lhand_jpos_gt = ori_jpos_gt[:, lhand_idx, :].detach().cpu().numpy()
-    rhand_jpos_gt = ori_jpos_gt[:, rhand_idx, :].detach().cpu().numpy() 
-    lhand_jpe = np.linalg.norm(lhand_jpos_pred - lhand_jpos_gt, axis=1).mean() * 1000
-    rhand_jpe = np.linalg.norm(rhand_jpos_pred - rhand_jpos_gt, axis=1).mean() * 1000
+    lhand_jpos_pred = ori_jpos_pred[:, :, lhand_idx, :].detach().cpu().numpy() 
+    rhand_jpos_pred = ori_jpos_pred[:, :, rhand_idx, :].detach().cpu().numpy() 
+    lhand_jpos_gt = ori_jpos_gt[:, :, lhand_idx, :].detach().cpu().numpy()
+    rhand_jpos_gt = ori_jpos_gt[:, :, rhand_idx, :].detach().cpu().numpy() 
+    lhand_jpe = np.linalg.norm(lhand_jpos_pred - lhand_jpos_gt, axis=2).mean(axis=1) * 1000 # BS 
+    rhand_jpe = np.linalg.norm(rhand_jpos_pred - rhand_jpos_gt, axis=2).mean(axis=1) * 1000
     hand_jpe = (lhand_jpe+rhand_jpe)/2.0 
 
     # Calculate MPVPE  
-    verts_pred = ori_verts_pred - ori_jpos_pred[:, 0:1]
-    verts_gt = ori_verts_gt - ori_jpos_gt[:, 0:1]
+    verts_pred = ori_verts_pred - ori_jpos_pred[:, :, 0:1]
+    verts_gt = ori_verts_gt - ori_jpos_gt[:, :, 0:1]
     verts_pred = verts_pred.detach().cpu().numpy()
     verts_gt = verts_gt.detach().cpu().numpy()
-    mpvpe = np.linalg.norm(verts_pred - verts_gt, axis=2).mean() * 1000
+    mpvpe = np.linalg.norm(verts_pred - verts_gt, axis=3).reshape(bs, -1).mean(axis=1) * 1000 # BS 
 
     # Calculate MPJPE 
-    jpos_pred = ori_jpos_pred - ori_jpos_pred[:, 0:1] # zero out root
-    jpos_gt = ori_jpos_gt - ori_jpos_gt[:, 0:1] 
+    jpos_pred = ori_jpos_pred - ori_jpos_pred[:, :, 0:1] # zero out root
+    jpos_gt = ori_jpos_gt - ori_jpos_gt[:, :, 0:1] 
     jpos_pred = jpos_pred.detach().cpu().numpy()
     jpos_gt = jpos_gt.detach().cpu().numpy()
-    mpjpe = np.linalg.norm(jpos_pred - jpos_gt, axis=2).mean() * 1000
+    mpjpe = np.linalg.norm(jpos_pred - jpos_gt, axis=3).reshape(bs, -1).mean(axis=1) * 1000 # BS 
 
     # Caculate translation error 
-    trans_err = np.linalg.norm(pred_trans.squeeze(0).detach().cpu().numpy() - gt_trans.squeeze(0).detach().cpu().numpy(), axis=1).mean() * 1000
+    gt_trans = np.stack([v.squeeze(0).detach().cpu().numpy() for v in gt_trans]) # BS X T X 3 
+    pred_trans = np.stack([v.squeeze(0).detach().cpu().numpy() for v in pred_trans]) 
+    trans_err = np.linalg.norm(pred_trans - gt_trans, axis=2).mean(axis=1) * 1000 # BS 
     
     # Calculate rotation error
-    rot_mat_pred = pred_rot_mat.detach().cpu().numpy()[:, 0] # Only evaluate for root rotation 
-    rot_mat_gt = gt_rot_mat.detach().cpu().numpy()[:, 0]
-    rot_dist = get_frobenious_norm_rot_only(rot_mat_pred.reshape(-1, 3, 3), rot_mat_gt.reshape(-1, 3, 3))
-    # rot_dist = 0 
-
-    # Calculate foot sliding
-    floor_height = determine_floor_height_and_contacts(ori_jpos_pred.detach().cpu().numpy(), fps=30)
-    gt_floor_height = determine_floor_height_and_contacts(ori_jpos_gt.detach().cpu().numpy(), fps=30)
-    # print("floor height:{0}".format(floor_height)) 
-    # print("gt floor height:{0}".format(gt_floor_height)) 
-
-    foot_sliding_jnts = compute_foot_sliding_for_smpl(ori_jpos_pred.detach().cpu().numpy(), floor_height)
-    gt_foot_sliding_jnts = compute_foot_sliding_for_smpl(ori_jpos_gt.detach().cpu().numpy(), gt_floor_height)
+    rot_mat_pred = np.stack([v.detach().cpu().numpy()[:, 0] for v in pred_rot_mat]) # Only evaluate for root rotation 
+    rot_mat_gt = np.stack([v.detach().cpu().numpy()[:, 0] for v in gt_rot_mat])
+    rot_dist = get_frobenious_norm_rot_only_batch(rot_mat_pred.reshape(bs, -1, 3, 3), rot_mat_gt.reshape(bs, -1, 3, 3)) # BS 
+
+    # Calculate foot sliding, floor heights are clustered per sequence. 
+    # They only need the joint positions on CPU, callers can skip them here and use compute_foot_sliding_metrics. 
+    foot_sliding_res_list = [(None, None, None, None)] * bs 
+    if compute_foot_sliding:
+        ori_jpos_pred_np = ori_jpos_pred.detach().cpu().numpy()
+        ori_jpos_gt_np = ori_jpos_gt.detach().cpu().numpy()
+        foot_sliding_res_list = [compute_foot_sliding_metrics(ori_jpos_gt_np[b_idx], ori_jpos_pred_np[b_idx]) \
+                            for b_idx in range(bs)]
 
     # Compute contact score 
-    num_obj_verts = gt_obj_verts.shape[1]
     if use_joints24:
         # contact_threh = 0.05
         contact_threh = 0.05
     else:
         contact_threh = 0.10 
 
-    gt_lhand_jnt = ori_jpos_gt[:, lhand_idx, :] # T X 3 
-    gt_rhand_jnt = ori_jpos_gt[:, rhand_idx, :] # T X 3 
-
     # What if the joint is in the object? already penetrate? 
-    gt_lhand2obj_dist = torch.sqrt(((gt_lhand_jnt[:, None, :].repeat(1, num_obj_verts, 1) - gt_obj_verts.to(gt_lhand_jnt.device))**2).sum(dim=-1)) # T X N  
-    gt_rhand2obj_dist = torch.sqrt(((gt_rhand_jnt[:, None, :].repeat(1, num_obj_verts, 1) - gt_obj_verts.to(gt_rhand_jnt.device))**2).sum(dim=-1)) # T X N  
-
-    gt_lhand2obj_dist_min = gt_lhand2obj_dist.min(dim=1)[0] # T 
-    gt_rhand2obj_dist_min = gt_rhand2obj_dist.min(dim=1)[0] # T 
+    gt_lhand2obj_dist_min = compute_hand2obj_dist_min(ori_jpos_gt[:, :, lhand_idx, :], gt_obj_verts) # BS X T 
+    gt_rhand2obj_dist_min = compute_hand2obj_dist_min(ori_jpos_gt[:, :, rhand_idx, :], gt_obj_verts) # BS X T 
 
     gt_lhand_contact = (gt_lhand2obj_dist_min < contact_threh)
     gt_rhand_contact = (gt_rhand2obj_dist_min < contact_threh)
 
-    lhand_jnt = ori_jpos_pred[:, lhand_idx, :] # T X 3 
-    rhand_jnt = ori_jpos_pred[:, rhand_idx, :] # T X 3 
-
-    lhand2obj_dist = torch.sqrt(((lhand_jnt[:, None, :].repeat(1, num_obj_verts, 1) - pred_obj_verts.to(lhand_jnt.device))**2).sum(dim=-1)) # T X N  
-    rhand2obj_dist = torch.sqrt(((rhand_jnt[:, None, :].repeat(1, num_obj_verts, 1) - pred_obj_verts.to(rhand_jnt.device))**2).sum(dim=-1)) # T X N  
-   
-    lhand2obj_dist_min = lhand2obj_dist.min(dim=1)[0] # T 
-    rhand2obj_dist_min = rhand2obj_dist.min(dim=1)[0] # T 
+    lhand2obj_dist_min = compute_hand2obj_dist_min(ori_jpos_pred[:, :, lhand_idx, :], pred_obj_verts) # BS X T 
+    rhand2obj_dist_min = compute_hand2obj_dist_min(ori_jpos_pred[:, :, rhand_idx, :], pred_obj_verts) # BS X T 
 
     lhand_contact = (lhand2obj_dist_min < contact_threh)
     rhand_contact = (rhand2obj_dist_min < contact_threh)
 
-    num_steps = gt_lhand_contact.shape[0]
+    num_steps = gt_lhand_contact.shape[1]
 
-    # Compute the distance between hand joint and object for frames that are in contact with object in GT. 
-    contact_dist = 0
-    gt_contact_dist = 0 
+    gt_in_contact = (gt_lhand_contact | gt_rhand_contact).detach().cpu().numpy() # BS X T 
+    pred_in_contact = (lhand_contact | rhand_contact).detach().cpu().numpy() # BS X T 
 
-    gt_contact_cnt = 0
-    for idx in range(num_steps):
-        if gt_lhand_contact[idx] or gt_rhand_contact[idx]:
-            gt_contact_cnt += 1 
+    # Distance between hand joint and object for frames that are in contact with object in GT. 
+    hand2obj_dist_min = torch.minimum(lhand2obj_dist_min, rhand2obj_dist_min).detach().cpu().numpy() # BS X T 
+    gt_hand2obj_dist_min = torch.minimum(gt_lhand2obj_dist_min, gt_rhand2obj_dist_min).detach().cpu().numpy() # BS X T 
 
-            contact_dist += min(lhand2obj_dist_min[idx], rhand2obj_dist_min[idx])
-            gt_contact_dist += min(gt_lhand2obj_dist_min[idx], gt_rhand2obj_dist_min[idx])
+    # Obejct rotation error. 
+    obj_rot_mat_pred = np.stack([v.detach().cpu().numpy() for v in pred_obj_rot_mat]) 
+    obj_rot_mat_gt = np.stack([v.detach().cpu().numpy() for v in gt_obj_rot_mat])
+    obj_rot_dist = get_frobenious_norm_rot_only_batch(obj_rot_mat_pred.reshape(bs, -1, 3, 3), obj_rot_mat_gt.reshape(bs, -1, 3, 3))
 
-    if gt_contact_cnt == 0:
-        contact_dist = 0 
-        gt_contact_dist = 0 
-    else:
-        contact_dist = contact_dist.detach().cpu().numpy()/float(gt_contact_cnt)
-        gt_contact_dist = gt_contact_dist.detach().cpu().numpy()/float(gt_contact_cnt)
-
-    pred_contact_cnt = 0
-
-    # Compute precision and recall for contact. 
-    TP = 0
-    FP = 0
-    TN = 0
-    FN = 0
-    for idx in range(num_steps):
-        gt_in_contact = (gt_lhand_contact[idx] or gt_rhand_contact[idx]) 
-        pred_in_contact = (lhand_contact[idx] or rhand_contact[idx])
-        if gt_in_contact and pred_in_contact:
-            TP += 1
-
-        if (not gt_in_contact) and pred_in_contact:
-            FP += 1
-
-        if (not gt_in_contact) and (not pred_in_contact):
-            TN += 1
-
-        if gt_in_contact and (not pred_in_contact):
-            FN += 1
-
-        if pred_in_contact:
-            pred_contact_cnt += 1 
-
-    gt_contact_percent = gt_contact_cnt /float(num_steps)
-    pred_contact_percent = pred_contact_cnt / float(num_steps) 
-
-    contact_acc = (TP+TN)/(TP+FP+TN+FN)
-
-    if (TP+FP) == 0: # Prediction no contact!!!
-        contact_precision = 0
-        print("Contact precision, TP + FP == 0!!")
-    else:
-        contact_precision = TP/(TP+FP)
-    
-    if (TP+FN) == 0: # GT no contact! 
-        contact_recall = 0
-        print("Contact recall, TP + FN == 0!!")
-    else:
-        contact_recall = TP/(TP+FN)
+    # Object com error and matching between the prediction and input conditions. 
+    pred_obj_com_pos = np.stack([v.detach().cpu().numpy() for v in pred_obj_com_pos]) # BS X T X 3 
+    gt_obj_com_pos = np.stack([v.detach().cpu().numpy() for v in gt_obj_com_pos]) # BS X T X 3 
+    obj_com_pos_err = np.linalg.norm(pred_obj_com_pos - gt_obj_com_pos, axis=2).mean(axis=1) * 1000
+    start_obj_com_pos_err = np.linalg.norm(pred_obj_com_pos[:, 0:1] - gt_obj_com_pos[:, 0:1], axis=2).mean(axis=1) * 1000
+    end_obj_com_pos_err = np.linalg.norm(pred_obj_com_pos[:, -1:] - gt_obj_com_pos[:, -1:], axis=2).mean(axis=1) * 1000
 
-    if contact_precision == 0 and contact_recall == 0:
-        contact_f1_score = 0 
-    else:
-        contact_f1_score = 2 * (contact_precision * contact_recall)/(contact_precision+contact_recall) 
-   
-    # Compute object rotation error.
-    obj_rot_mat_pred = pred_obj_rot_mat.detach().cpu().numpy() 
-    obj_rot_mat_gt = gt_obj_rot_mat.detach().cpu().numpy()
-    obj_rot_dist = get_frobenious_norm_rot_only(obj_rot_mat_pred.reshape(-1, 3, 3), obj_rot_mat_gt.reshape(-1, 3, 3))
-    # obj_rot_dist = 0 
+    waypoints_index_list = [29, 59, 89] 
+    waypoints_xy_pos_err = np.linalg.norm(pred_obj_com_pos[:, waypoints_index_list, :2] - \
+                    gt_obj_com_pos[:, waypoints_index_list, :2], axis=2).mean(axis=1) * 1000
+
+    res_list = []
+    for b_idx in range(bs):
+        gt_foot_sliding_jnts, foot_sliding_jnts, gt_floor_height, floor_height = foot_sliding_res_list[b_idx]
+
+        gt_contact_cnt = int(gt_in_contact[b_idx].sum())
+        if gt_contact_cnt == 0:
+            contact_dist = 0 
+            gt_contact_dist = 0 
+        else:
+            contact_dist = accumulate_float32(hand2obj_dist_min[b_idx][gt_in_contact[b_idx]])/float(gt_contact_cnt)
+            gt_contact_dist = accumulate_float32(gt_hand2obj_dist_min[b_idx][gt_in_contact[b_idx]])/float(gt_contact_cnt)
+
+        # Compute precision and recall for contact. 
+        TP = int((gt_in_contact[b_idx] & pred_in_contact[b_idx]).sum())
+        FP = int((~gt_in_contact[b_idx] & pred_in_contact[b_idx]).sum())
+        TN = int((~gt_in_contact[b_idx] & ~pred_in_contact[b_idx]).sum())
+        FN = int((gt_in_contact[b_idx] & ~pred_in_contact[b_idx]).sum())
+
+        pred_contact_cnt = int(pred_in_contact[b_idx].sum())
+
+        gt_contact_percent = gt_contact_cnt /float(num_steps)
+        pred_contact_percent = pred_contact_cnt / float(num_steps) 
+
+        contact_acc = (TP+TN)/(TP+FP+TN+FN)
+
+        if (TP+FP) == 0: # Prediction no contact!!!
+            contact_precision = 0
+            print("Contact precision, TP + FP == 0!!")
+        else:
+            contact_precision = TP/(TP+FP)
+        
+        if (TP+FN) == 0: # GT no contact! 
+            contact_recall = 0
+            print("Contact recall, TP + FN == 0!!")
+        else:
+            contact_recall = TP/(TP+FN)
 
-    # Compute com error. 
-    obj_com_pos_err = np.linalg.norm(pred_obj_com_pos.detach().cpu().numpy() - gt_obj_com_pos.detach().cpu().numpy(), axis=1).mean() * 1000
+        if contact_precision == 0 and contact_recall == 0:
+            contact_f1_score = 0 
+        else:
+            contact_f1_score = 2 * (contact_precision * contact_recall)/(contact_precision+contact_recall) 
 
-    # Compute matching between the prediction and input conditions. 
-    start_obj_com_pos_err = np.linalg.norm(pred_obj_com_pos[0:1].detach().cpu().numpy() - gt_obj_com_pos[0:1].detach().cpu().numpy(), axis=1).mean() * 1000
-    end_obj_com_pos_err = np.linalg.norm(pred_obj_com_pos[-1:].detach().cpu().numpy() - gt_obj_com_pos[-1:].detach().cpu().numpy(), axis=1).mean() * 1000
+        res_list.append((lhand_jpe[b_idx], rhand_jpe[b_idx], hand_jpe[b_idx], mpvpe[b_idx], mpjpe[b_idx], \
+        rot_dist[b_idx], trans_err[b_idx], gt_contact_percent, pred_contact_percent, \
+        gt_foot_sliding_jnts, foot_sliding_jnts, contact_precision, contact_recall, contact_acc, contact_f1_score, \
+        obj_rot_dist[b_idx], obj_com_pos_err[b_idx], start_obj_com_pos_err[b_idx], end_obj_com_pos_err[b_idx], \
+        waypoints_xy_pos_err[b_idx], gt_floor_height, floor_height))
 
-    waypoints_index_list = [29, 59, 89] 
-    waypoints_xy_pos_err = np.linalg.norm(pred_obj_com_pos[waypoints_index_list, :2].detach().cpu().numpy() - \
-                    gt_obj_com_pos[waypoints_index_list, :2].detach().cpu().numpy(), axis=1).mean() * 1000
-
-    return lhand_jpe, rhand_jpe, hand_jpe, mpvpe, mpjpe, rot_dist, trans_err, gt_contact_percent, pred_contact_percent, \
-    gt_foot_sliding_jnts, foot_sliding_jnts, contact_precision, contact_recall, contact_acc, contact_f1_score, \
-    obj_rot_dist, obj_com_pos_err, start_obj_com_pos_err, end_obj_com_pos_err, waypoints_xy_pos_err, gt_floor_height, floor_height 
+    return res_list 
 
 def compute_metrics_long_seq(ori_jpos_pred, pred_obj_com_pos, \
     pred_obj_rot_mat, pred_obj_verts, gt_obj_com_pos, \
@@ -570,8 +632,6 @@ def compute_metrics_long_seq(ori_jpos_pred, pred_obj_com_pos, \
     lhand_idx = 22 
     rhand_idx = 23 
 
-    num_obj_verts = pred_obj_verts.shape[1]
-
     # Calculate foot sliding
     # foot_sliding_verts = get_foot_sliding(ori_verts_pred.detach().cpu().numpy())
     floor_height = determine_floor_height_and_contacts(ori_jpos_pred.detach().cpu().numpy(), fps=30)
@@ -583,11 +643,8 @@ def compute_metrics_long_seq(ori_jpos_pred, pred_obj_com_pos, \
     lhand_jnt = ori_jpos_pred[:, lhand_idx, :] # T X 3 
     rhand_jnt = ori_jpos_pred[:, rhand_idx, :] # T X 3 
 
-    lhand2obj_dist = torch.sqrt(((lhand_jnt[:, None, :].repeat(1, num_obj_verts, 1) - pred_obj_verts.to(lhand_jnt.device))**2).sum(dim=-1)) # T X N  
-    rhand2obj_dist = torch.sqrt(((rhand_jnt[:, None, :].repeat(1, num_obj_verts, 1) - pred_obj_verts.to(rhand_jnt.device))**2).sum(dim=-1)) # T X N  
-   
-    lhand2obj_dist_min = lhand2obj_dist.min(dim=1)[0] # T 
-    rhand2obj_dist_min = rhand2obj_dist.min(dim=1)[0] # T 
+    lhand2obj_dist_min = compute_hand2obj_dist_min(lhand_jnt[None], [pred_obj_verts])[0] # T 
+    rhand2obj_dist_min = compute_hand2obj_dist_min(rhand_jnt[None], [pred_obj_verts])[0] # T 
 
     lhand_contact = (lhand2obj_dist_min < contact_threh)
     rhand_contact = (rhand2obj_dist_min < contact_threh)
@@ -595,13 +652,7 @@ def compute_metrics_long_seq(ori_jpos_pred, pred_obj_com_pos, \
     num_steps = lhand_contact.shape[0]
 
     # Compute contact percentage in sequence.
-    pred_contact_cnt = 0
-
-    for idx in range(num_steps):
-        pred_in_contact = (lhand_contact[idx] or rhand_contact[idx])
-
-        if pred_in_contact:
-            pred_contact_cnt += 1 
+    pred_contact_cnt = int((lhand_contact | rhand_contact).sum())
 
     pred_contact_percent = pred_contact_cnt / float(num_steps) 
 
@@ -0,0 +1,175 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+
+
+def batch_rodrigues(rot_vecs):
+    # rot_vecs: N X 3, returns N X 3 X 3, same as the body model's own conversion.
+    angle = torch.norm(rot_vecs + 1e-8, dim=1, keepdim=True) # N X 1
+    rot_dir = rot_vecs / angle
+
+    cos = torch.unsqueeze(torch.cos(angle), dim=1) # N X 1 X 1
+    sin = torch.unsqueeze(torch.sin(angle), dim=1)
+
+    rx, ry, rz = torch.split(rot_dir, 1, dim=1)
+    zeros = torch.zeros_like(rx)
+    K = torch.cat([zeros, -rz, ry, rz, zeros, -rx, -ry, rx, zeros], dim=1).reshape(-1, 3, 3)
+
+    ident = torch.eye(3, dtype=rot_vecs.dtype, device=rot_vecs.device)[None]
+    rot_mat = ident + sin * K + (1 - cos) * torch.bmm(K, K)
+
+    return rot_mat
+
+
+class BatchedSMPLXLayer:
+    # SMPL-X forward pass for a whole batch of sequences. Frames are grouped by gender so that each gender's model
+    # runs once, and the shape dependent part (shaped template and rest joints) is computed once per subject
+    # and cached across calls instead of once per frame.
+    def __init__(self, bm_fname_dict, num_betas=16, device="cpu", max_cache_size=256):
+        # bm_fname_dict: gender -> SMPL-X npz path
+        self.device = device
+        self.max_cache_size = max_cache_size
+
+        self.model_dict = {}
+        for gender_name in bm_fname_dict:
+            if not os.path.exists(bm_fname_dict[gender_name]):
+                continue
+
+            npz_data = np.load(bm_fname_dict[gender_name])
+            v_template = npz_data['v_template'] # Nv X 3
+            shapedirs = npz_data['shapedirs'][:, :, :num_betas] # Nv X 3 X num_betas
+            posedirs = npz_data['posedirs'] # Nv X 3 X P
+            posedirs = posedirs.reshape(-1, posedirs.shape[-1]).T # P X (Nv*3)
+            j_regressor = np.asarray(npz_data['J_regressor']) # J X Nv
+            lbs_weights = npz_data['weights'] # Nv X J
+
+            parents = npz_data['kintree_table'][0].astype(np.int64)
+            parents[0] = -1
+
+            self.model_dict[gender_name] = {
+                'v_template': torch.from_numpy(v_template).float().to(device),
+                'shapedirs': torch.from_numpy(shapedirs).float().to(device),
+                'posedirs': torch.from_numpy(posedirs).float().to(device),
+                'j_regressor': torch.from_numpy(j_regressor).float().to(device),
+                'lbs_weights': torch.from_numpy(lbs_weights).float().to(device),
+                'parents': parents,
+            }
+
+            self.faces = torch.from_numpy(npz_data['f'].astype(np.int64)).to(device) # Nf X 3
+
+        self.shape_cache = OrderedDict()
+
+    def get_shaped_template(self, betas, gender):
+        # betas: num_betas, gender: a string
+        # Returns the shaped template (Nv X 3) and its rest joints (J X 3) of one subject.
+        key = (gender, betas.detach().cpu().numpy().tobytes())
+        if key in self.shape_cache:
+            self.shape_cache.move_to_end(key)
+            return self.shape_cache[key]
+
+        model = self.model_dict[gender]
+        betas = betas.detach().float().to(self.device)
+        v_shaped = model['v_template'] + torch.matmul(model['shapedirs'], betas) # Nv X 3
+        rest_jnts = torch.matmul(model['j_regressor'], v_shaped) # J X 3
+
+        self.shape_cache[key] = (v_shaped, rest_jnts)
+        if len(self.shape_cache) > self.max_cache_size:
+            self.shape_cache.popitem(last=False)
+
+        return v_shaped, rest_jnts
+
+    def run_lbs(self, model, full_pose, v_shaped, rest_jnts):
+        # full_pose: N X J X 3, v_shaped: N X Nv X 3, rest_jnts: N X J X 3
+        num_frames, num_joints = full_pose.shape[:2]
+        parents = model['parents']
+
+        rot_mats = batch_rodrigues(full_pose.reshape(-1, 3)).reshape(num_frames, num_joints, 3, 3)
+
+        # Pose blend shapes
+        ident = torch.eye(3, dtype=rot_mats.dtype, device=rot_mats.device)
+        pose_feature = (rot_mats[:, 1:] - ident).reshape(num_frames, -1) # N X P
+        pose_offsets = torch.matmul(pose_feature, model['posedirs']).reshape(num_frames, -1, 3) # N X Nv X 3
+        v_posed = v_shaped + pose_offsets
+
+        # Forward kinematics along the kinematic tree
+        rel_jnts = rest_jnts.clone()
+        rel_jnts[:, 1:] = rel_jnts[:, 1:] - rest_jnts[:, parents[1:]]
+        local_transforms = torch.cat((F.pad(rot_mats, [0, 0, 0, 1]), \
+                        F.pad(rel_jnts[..., None], [0, 0, 0, 1], value=1)), dim=-1) # N X J X 4 X 4
+
+        transform_chain = [local_transforms[:, 0]]
+        for j_idx in range(1, num_joints):
+            transform_chain.append(torch.matmul(transform_chain[parents[j_idx]], local_transforms[:, j_idx]))
+        global_transforms = torch.stack(transform_chain, dim=1) # N X J X 4 X 4
+
+        posed_jnts = global_transforms[:, :, :3, 3] # N X J X 3
+
+        # Remove the rest joint positions so that the transforms apply to rest pose vertices.
+        rest_jnts_homo = F.pad(rest_jnts[..., None], [0, 0, 0, 1])
+        rel_transforms = global_transforms - F.pad(torch.matmul(global_transforms, rest_jnts_homo), [3, 0])
+
+        # Linear blend skinning
+        vert_transforms = torch.matmul(model['lbs_weights'], rel_transforms.reshape(num_frames, num_joints, 16))
+        vert_transforms = vert_transforms.reshape(num_frames, -1, 4, 4) # N X Nv X 4 X 4
+        verts = torch.matmul(vert_transforms[:, :, :3, :3], v_posed[..., None]).squeeze(-1) + \
+                vert_transforms[:, :, :3, 3] # N X Nv X 3
+
+        return posed_jnts, verts
+
+    def __call__(self, root_trans, aa_rot_rep, betas, gender, return_joints24=True):
+        # root_trans: BS X T X 3
+        # aa_rot_rep: BS X T X 22 X 3 or BS X T X 52 X 3
+        # betas: BS X 16
+        # gender: BS
+        # Same outputs as run_smplx_model.
+        bs, num_steps, num_joints, _ = aa_rot_rep.shape
+        if num_joints != 52:
+            padding_zeros_hand = torch.zeros(bs, num_steps, 30, 3).to(aa_rot_rep.device) # BS X T X 30 X 3
+            aa_rot_rep = torch.cat((aa_rot_rep, padding_zeros_hand), dim=2) # BS X T X 52 X 3
+
+        # SMPL-X pose: body, jaw, two eyes, hands. Jaw and eyes stay at rest.
+        padding_zeros_face = torch.zeros(bs, num_steps, 3, 3).to(aa_rot_rep.device)
+        full_pose = torch.cat((aa_rot_rep[:, :, :22], padding_zeros_face, aa_rot_rep[:, :, 22:]), dim=2) # BS X T X 55 X 3
+
+        jnts = [None] * bs
+        verts = [None] * bs
+        for gender_name in self.model_dict:
+            b_idx_list = [b_idx for b_idx in range(bs) if gender[b_idx] == gender_name]
+            if len(b_idx_list) == 0:
+                continue
+
+            shaped_list = [self.get_shaped_template(betas[b_idx].reshape(-1), gender_name) for b_idx in b_idx_list]
+            v_shaped = torch.stack([v for v, _ in shaped_list]) # N X Nv X 3
+            rest_jnts = torch.stack([j for _, j in shaped_list]) # N X J X 3
+
+            num_seq = len(b_idx_list)
+            v_shaped = v_shaped[:, None].expand(-1, num_steps, -1, -1).reshape(num_seq*num_steps, -1, 3)
+            rest_jnts = rest_jnts[:, None].expand(-1, num_steps, -1, -1).reshape(num_seq*num_steps, -1, 3)
+
+            gender_jnts, gender_verts = self.run_lbs(self.model_dict[gender_name], \
+                    full_pose[b_idx_list].reshape(num_seq*num_steps, -1, 3), v_shaped, rest_jnts)
+
+            gender_trans = root_trans[b_idx_list].reshape(num_seq*num_steps, 1, 3)
+            gender_jnts = (gender_jnts + gender_trans).reshape(num_seq, num_steps, -1, 3) # N X T X J X 3
+            gender_verts = (gender_verts + gender_trans).reshape(num_seq, num_steps, -1, 3) # N X T X Nv X 3
+
+            for i, b_idx in enumerate(b_idx_list):
+                jnts[b_idx] = gender_jnts[i]
+                verts[b_idx] = gender_verts[i]
+
+        jnts = torch.stack(jnts) # BS X T X 55 X 3
+        verts = torch.stack(verts) # BS X T X Nv X 3
+
+        if return_joints24:
+            lmiddle_index = 28
+            rmiddle_index = 43
+            jnts = torch.cat((jnts[:, :, :22], jnts[:, :, lmiddle_index:lmiddle_index+1], \
+                    jnts[:, :, rmiddle_index:rmiddle_index+1]), dim=2) # BS X T X 24 X 3
+        else:
+            jnts = jnts[:, :, :num_joints]
+
+        return jnts, verts, self.faces
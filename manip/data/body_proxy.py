@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+
+import torch
+
+
+class BodyJointProxy:
+    # Cheap replacement of the SMPL-X forward pass when only a few joint positions are needed, e.g. in guidance losses.
+    # Rest pose joints are linear in betas, so the joint regressor is folded into the template and shape blend shapes
+    # once. Posed joints are then a sum of rotated bone offsets along each joint's kinematic chain, which is linear in
+    # the global joint rotations and differentiable wrt them.
+    def __init__(self, bm_fname_dict, joint_idx_list, num_betas=16, num_rot_joints=22, device="cpu"):
+        # bm_fname_dict: gender -> SMPL-X npz path, joint_idx_list: SMPL-X joint indices to regress.
+        self.joint_idx_list = joint_idx_list
+        self.device = device
+
+        self.rest_jnts_dict = {}
+        parents = None
+        for gender_name in bm_fname_dict:
+            if not os.path.exists(bm_fname_dict[gender_name]):
+                continue
+
+            npz_data = np.load(bm_fname_dict[gender_name])
+            j_regressor = np.asarray(npz_data['J_regressor']) # J X Nv
+            v_template = npz_data['v_template'] # Nv X 3
+            shapedirs = npz_data['shapedirs'][:, :, :num_betas] # Nv X 3 X num_betas
+
+            j_template = j_regressor.dot(v_template) # J X 3
+            j_shapedirs = np.einsum('jv,vcb->jcb', j_regressor, shapedirs) # J X 3 X num_betas
+
+            self.rest_jnts_dict[gender_name] = (torch.from_numpy(j_template).float().to(device), \
+                                torch.from_numpy(j_shapedirs).float().to(device))
+
+            parents = npz_data['kintree_table'][0].astype(np.int64)
+            parents[0] = -1
+
+        # Joints outside the predicted ones (hands, face) have zero local rotation, they use their parent's global rotation.
+        rot_idx_list = []
+        for j_idx in range(len(parents)):
+            if j_idx < num_rot_joints:
+                rot_idx_list.append(j_idx)
+            else:
+                rot_idx_list.append(rot_idx_list[parents[j_idx]])
+
+        # Flatten the kinematic chains of all requested joints into a list of bones.
+        bone_parent_list = []
+        bone_child_list = []
+        bone_target_list = []
+        for k_idx, j_idx in enumerate(joint_idx_list):
+            curr_idx = j_idx
+            while parents[curr_idx] != -1:
+                bone_parent_list.append(parents[curr_idx])
+                bone_child_list.append(curr_idx)
+                bone_target_list.append(k_idx)
+                curr_idx = parents[curr_idx]
+
+        self.bone_parent_idx = torch.tensor(bone_parent_list, dtype=torch.long, device=device) # L
+        self.bone_child_idx = torch.tensor(bone_child_list, dtype=torch.long, device=device) # L
+        self.bone_rot_idx = torch.tensor([rot_idx_list[p_idx] for p_idx in bone_parent_list], \
+                            dtype=torch.long, device=device) # L
+        self.bone_target_idx = torch.tensor(bone_target_list, dtype=torch.long, device=device) # L
+
+    def get_rest_joints(self, betas, gender):
+        # betas: BS X num_betas, gender: BS
+        rest_jnts_list = []
+        for b_idx in range(betas.shape[0]):
+            j_template, j_shapedirs = self.rest_jnts_dict[gender[b_idx]]
+            rest_jnts_list.append(j_template + torch.matmul(j_shapedirs, betas[b_idx].to(j_shapedirs.device)))
+
+        return torch.stack(rest_jnts_list) # BS X J X 3
+
+    def get_joints(self, global_rot_mat, root_trans, betas, gender):
+        # global_rot_mat: BS X T X 22 X 3 X 3
+        # root_trans: BS X T X 3, SMPL-X translation
+        # betas: BS X num_betas
+        # gender: BS
+        # Returns BS X T X K X 3, same as the SMPL-X joints at joint_idx_list with zero hand pose.
+        bs, num_steps = global_rot_mat.shape[:2]
+
+        rest_jnts = self.get_rest_joints(betas, gender).to(global_rot_mat.device) # BS X J X 3
+        bone_offsets = rest_jnts[:, self.bone_child_idx] - rest_jnts[:, self.bone_parent_idx] # BS X L X 3
+
+        rotated_offsets = torch.matmul(global_rot_mat[:, :, self.bone_rot_idx], \
+                        bone_offsets[:, None, :, :, None]).squeeze(-1) # BS X T X L X 3
+
+        jnts = torch.zeros(bs, num_steps, len(self.joint_idx_list), 3, \
+                dtype=rotated_offsets.dtype, device=rotated_offsets.device)
+        jnts = jnts.index_add(2, self.bone_target_idx, rotated_offsets) # BS X T X K X 3
+
+        # The root rotates around the rest root joint.
+        root_jpos = root_trans + rest_jnts[:, None, 0, :] # BS X T X 3
+        jnts = jnts + root_jpos[:, :, None, :]
+
+        return jnts
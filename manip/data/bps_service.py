@@ -0,0 +1,59 @@
+from collections import OrderedDict
+
+import torch
+
+
+class ObjectBPSService:
+    # Computes object BPS features for many poses at once. Rest pose geometry stays resident on the device and
+    # BPS results are memoized per object and rotation.
+    def __init__(self, ds, max_memo_size=4096):
+        self.ds = ds
+        self.max_memo_size = max_memo_size
+
+        self.rest_verts_dict = {}
+        self.bps_memo = OrderedDict()
+
+    def get_rest_verts(self, object_name, device):
+        key = (object_name, str(device))
+        if key not in self.rest_verts_dict:
+            rest_verts, obj_mesh_faces = self.ds.load_rest_pose_object_geometry(object_name)
+            self.rest_verts_dict[key] = torch.from_numpy(rest_verts).float().to(device) # Nv X 3
+
+        return self.rest_verts_dict[key]
+
+    def compute_window_bps(self, object_names, obj_rot_mat, obj_com_pos):
+        # object_names: BS, obj_rot_mat: BS X T X 3 X 3, obj_com_pos: BS X T X 3
+        # Returns the first frame's BPS (BS X 1024 X 3) and the object centers of all frames (BS X T X 3).
+        bs, num_steps = obj_rot_mat.shape[:2]
+
+        obj_bps_list = [None] * bs
+        center_verts_list = [None] * bs
+        for object_name in set(object_names):
+            b_idx_list = [b_idx for b_idx in range(bs) if object_names[b_idx] == object_name]
+
+            rest_verts = self.get_rest_verts(object_name, obj_rot_mat.device)
+            obj_verts = self.ds.load_object_geometry_w_rest_geo(obj_rot_mat[b_idx_list].reshape(-1, 3, 3), \
+                    obj_com_pos[b_idx_list].reshape(-1, 3), rest_verts) # (N*T) X Nv X 3
+            obj_verts = obj_verts.reshape(len(b_idx_list), num_steps, -1, 3) # N X T X Nv X 3
+            center_verts = obj_verts.mean(dim=2) # N X T X 3
+
+            # BPS deltas are taken wrt basis points around the object center, so they only depend on the rotation.
+            memo_keys = [(object_name, obj_rot_mat[b_idx, 0].detach().cpu().numpy().tobytes()) for b_idx in b_idx_list]
+            miss_idx_list = [i for i in range(len(memo_keys)) if memo_keys[i] not in self.bps_memo]
+            if len(miss_idx_list) > 0:
+                object_bps = self.ds.compute_object_geo_bps(obj_verts[miss_idx_list, 0], \
+                            center_verts[miss_idx_list, 0]) # N' X 1024 X 3
+                for m_idx, i in enumerate(miss_idx_list):
+                    self.bps_memo[memo_keys[i]] = object_bps[m_idx]
+                    if len(self.bps_memo) > self.max_memo_size:
+                        self.bps_memo.popitem(last=False)
+
+            for i, b_idx in enumerate(b_idx_list):
+                if memo_keys[i] in self.bps_memo:
+                    self.bps_memo.move_to_end(memo_keys[i])
+                    obj_bps_list[b_idx] = self.bps_memo[memo_keys[i]]
+                else: # Evicted right away when the batch is larger than the memo.
+                    obj_bps_list[b_idx] = self.ds.compute_object_geo_bps(obj_verts[i, 0:1], center_verts[i, 0:1])[0]
+                center_verts_list[b_idx] = center_verts[i]
+
+        return torch.stack(obj_bps_list), torch.stack(center_verts_list)
@@ -5,6 +5,7 @@ import numpy as np
 import joblib 
 import trimesh  
 import json 
+import multiprocessing 
 
 import random 
 
@@ -18,7 +19,12 @@ from bps_torch.tools import sample_sphere_uniform
 
 from human_body_prior.body_model.body_model import BodyModel
 
-from manip.lafan1.utils import rotate_at_frame_w_obj 
+from manip.lafan1.utils import rotate_at_frame_w_obj, get_parent_levels 
+from manip.lafan1.utils import quat_fk_torch as quat_fk_torch_levels 
+
+from manip.data.window_store import WindowStore 
+from manip.data.bps_service import ObjectBPSService 
+from manip.data.preprocess_cache import PreprocessCache, hash_data, PREPROCESS_CACHE_VERSION 
 
 SMPLH_PATH = os.path.join(os.path.dirname(__file__), "../../data/processed_data/smpl_all_models/smplh_amass")
 
@@ -40,7 +46,13 @@ def rotate(points, R):
     r_points = torch.matmul(points, R.transpose(1,2))
     return r_points.reshape(shape)
 
+SMPL_PARENTS_CACHE = {}
+
 def get_smpl_parents(use_joints24=True):
+    # The kinematic tree is loaded once per process and shared as a constant, do not modify the returned array in place. 
+    if use_joints24 in SMPL_PARENTS_CACHE:
+        return SMPL_PARENTS_CACHE[use_joints24]
+
     bm_path = os.path.join(SMPLH_PATH, 'male/model.npz')
     npz_data = np.load(bm_path)
     ori_kintree_table = npz_data['kintree_table'] # 2 X 52 
@@ -56,8 +68,14 @@ def get_smpl_parents(use_joints24=True):
         parents = ori_kintree_table[0, :22] # 22 
         parents[0] = -1 # Assign -1 for the root joint's parent idx.
     
+    SMPL_PARENTS_CACHE[use_joints24] = parents 
+
     return parents
 
+def get_smpl_parent_levels(use_joints24=True):
+    # Group joint indices by their depth in the kinematic tree, level 0 only contains the root joint. 
+    return get_parent_levels(get_smpl_parents(use_joints24=use_joints24))
+
 def local2global_pose(local_pose):
     # local_pose: T X J X 3 X 3 
     kintree = get_smpl_parents(use_joints24=False) 
@@ -68,10 +86,9 @@ def local2global_pose(local_pose):
 
     global_pose = local_pose.clone()
 
-    for jId in range(len(kintree)):
-        parent_id = kintree[jId]
-        if parent_id >= 0:
-            global_pose[:, jId] = torch.matmul(global_pose[:, parent_id], global_pose[:, jId])
+    # Joints of the same depth are composed with their parents together. 
+    for level in get_smpl_parent_levels(use_joints24=False)[1:]:
+        global_pose[:, level] = torch.matmul(global_pose[:, kintree[level]], global_pose[:, level])
 
     return global_pose # T X J X 3 X 3 
 
@@ -103,18 +120,20 @@ def quat_fk_torch(lrot_mat, lpos, use_joints24=True):
 
     lrot = transforms.matrix_to_quaternion(lrot_mat)
 
-    gp, gr = [lpos[..., :1, :]], [lrot[..., :1, :]]
-    for i in range(1, len(parents)):
-        gp.append(
-            transforms.quaternion_apply(gr[parents[i]], lpos[..., i : i + 1, :]) + gp[parents[i]]
-        )
-        if i < lrot.shape[-2]:
-            gr.append(transforms.quaternion_multiply(gr[parents[i]], lrot[..., i : i + 1, :]))
-
-    res = torch.cat(gr, dim=-2), torch.cat(gp, dim=-2)
+    res = quat_fk_torch_levels(lrot, lpos, parents)
 
     return res
 
+CAL_NORMALIZE_DATASET = None 
+
+def init_cal_normalize_worker():
+    # Forked workers only run on CPU, CUDA can not be used after fork. 
+    torch.set_num_threads(1)
+    CAL_NORMALIZE_DATASET.device = torch.device("cpu")
+
+def cal_normalize_seq_worker(seq_args):
+    return CAL_NORMALIZE_DATASET.cal_normalize_seq_windows(*seq_args)
+
 class CanoObjectTrajDataset(Dataset):
     def __init__(
         self,
@@ -125,11 +144,17 @@ class CanoObjectTrajDataset(Dataset):
         input_language_condition=False,
         use_random_frame_bps=False, 
         use_object_keypoints=False, 
+        device="cuda", 
+        use_window_store=False, 
+        num_preprocess_workers=0, 
+        use_preprocess_cache=False, 
     ):
         self.train = train
         
         self.window = window 
 
+        self.device = device 
+
         self.use_object_splits = use_object_splits 
         
         self.train_objects = ["largetable", "woodchair", "plasticbox", "largebox", "smallbox", "trashcan", "monitor", \
@@ -194,6 +219,15 @@ class CanoObjectTrajDataset(Dataset):
         
         self.prep_bps_data()
 
+        # Key the processed windows on the content of the input sequences, object geometry, BPS basis and 
+        # the processing parameters. The statistics come from the training windows, they use the training key. 
+        self.preprocess_cache = None 
+        if use_preprocess_cache:
+            self.preprocess_cache = PreprocessCache(os.path.join(data_root_folder, "preprocess_cache_joints24"))
+            train_seq_data_path = os.path.join(data_root_folder, "train_diffusion_manip_seq_joints24.p")
+            processed_data_path = self.preprocess_cache.get_windows_path(self.get_preprocess_key(seq_data_path))
+            min_max_mean_std_data_path = self.preprocess_cache.get_stats_path(self.get_preprocess_key(train_seq_data_path))
+
         if os.path.exists(processed_data_path):
             self.window_data_dict = joblib.load(processed_data_path)
 
@@ -205,7 +239,14 @@ class CanoObjectTrajDataset(Dataset):
 
             self.extract_rest_pose_object_geometry_and_rotation()
 
-            self.cal_normalize_data_input()
+            self.cal_normalize_data_input(num_workers=num_preprocess_workers)
+
+            # Missing rest pose geometry is written during the processing, key the result on the files it used. 
+            if self.preprocess_cache is not None:
+                processed_data_path = self.preprocess_cache.get_windows_path(self.get_preprocess_key(seq_data_path))
+                min_max_mean_std_data_path = self.preprocess_cache.get_stats_path( \
+                    self.get_preprocess_key(train_seq_data_path))
+
             joblib.dump(self.window_data_dict, processed_data_path)            
 
         if os.path.exists(min_max_mean_std_data_path):
@@ -236,6 +277,10 @@ class CanoObjectTrajDataset(Dataset):
         else:
             print("Total number of windows for validation:{0}".format(len(self.window_data_dict))) # all, 3224 
 
+        self.window_store = None 
+        if use_window_store:
+            self.prep_window_store()
+
         # Prepare SMPLX model 
         soma_work_base_dir = os.path.join(self.data_root_folder, 'smpl_all_models')
         support_base_dir = soma_work_base_dir 
@@ -263,8 +308,8 @@ class CanoObjectTrajDataset(Dataset):
         for p in self.female_bm.parameters():
             p.requires_grad = False 
 
-        self.male_bm = self.male_bm.cuda()
-        self.female_bm = self.female_bm.cuda()
+        self.male_bm = self.male_bm.to(self.device)
+        self.female_bm = self.female_bm.to(self.device)
         
         self.bm_dict = {'male' : self.male_bm, 'female' : self.female_bm}
 
@@ -277,6 +322,83 @@ class CanoObjectTrajDataset(Dataset):
 
         return text_anno 
 
+    def get_obj_bps_npy_path(self, index):
+        seq_name = self.window_data_dict[index]['seq_name'] 
+        object_name = seq_name.split("_")[1]
+
+        if self.use_random_frame_bps:
+            if self.preprocess_cache is not None and 'bps_hash' in self.window_data_dict[index]:
+                obj_bps_npy_path = self.preprocess_cache.get_bps_path(self.window_data_dict[index]['bps_hash'])
+            elif (not self.train) or self.use_object_splits or self.input_language_condition:
+                ori_w_idx = self.window_data_dict[index]['ori_w_idx']
+                obj_bps_npy_path = os.path.join(self.dest_obj_bps_npy_folder, seq_name+"_"+str(ori_w_idx)+".npy") 
+            else:
+                obj_bps_npy_path = os.path.join(self.dest_obj_bps_npy_folder, seq_name+"_"+str(index)+".npy") 
+        else:
+            obj_bps_npy_path = os.path.join(self.rest_object_geo_folder, object_name+".npy")
+
+        return obj_bps_npy_path 
+
+    def prep_window_store(self):
+        # Pack the per-item npy files and text into a few memory-mapped shards, built once and reused afterwards. 
+        if self.train:
+            store_folder = os.path.join(self.data_root_folder, "window_store_joints24_"+str(self.window))
+        else:
+            store_folder = os.path.join(self.data_root_folder, "window_store_for_test_joints24_"+str(self.window))
+
+        window_bps_npy_paths = {}
+        rest_bps_npy_paths = {}
+        contact_npy_paths = {}
+        text_dict = {}
+        for index in self.window_data_dict:
+            seq_name = self.window_data_dict[index]['seq_name']
+            object_name = seq_name.split("_")[1]
+
+            if self.use_random_frame_bps:
+                obj_bps_npy_path = self.get_obj_bps_npy_path(index)
+                window_bps_npy_paths[os.path.basename(obj_bps_npy_path)] = obj_bps_npy_path 
+
+            rest_bps_npy_paths[object_name] = os.path.join(self.rest_object_geo_folder, object_name+".npy")
+            contact_npy_paths[seq_name] = os.path.join(self.contact_npy_folder, seq_name+".npy")
+
+            if self.input_language_condition and seq_name not in text_dict:
+                text_dict[seq_name] = self.load_language_annotation(seq_name)
+
+        self.window_store = WindowStore(store_folder)
+        if not self.window_store.contains(window_bps_npy_paths, rest_bps_npy_paths, contact_npy_paths, text_dict):
+            print("Building window store in {0}".format(store_folder))
+            self.window_store.build(window_bps_npy_paths, rest_bps_npy_paths, contact_npy_paths, text_dict)
+
+    def load_contact_labels(self, seq_name):
+        if self.window_store is not None:
+            return self.window_store.get_contact_labels(seq_name) # T X 4 
+
+        contact_npy_path = os.path.join(self.contact_npy_folder, seq_name+".npy")
+        contact_npy_data = np.load(contact_npy_path) # T X 4 (lhand, rhand, lfoot, rfoot)
+
+        return contact_npy_data 
+
+    def load_obj_bps_data(self, index):
+        if self.window_store is not None:
+            if self.use_random_frame_bps:
+                return self.window_store.get_window_bps(os.path.basename(self.get_obj_bps_npy_path(index))) # T X N X 3 
+            else:
+                object_name = self.window_data_dict[index]['seq_name'].split("_")[1]
+                return self.window_store.get_rest_bps(object_name) # 1 X N X 3 
+
+        obj_bps_data = np.load(self.get_obj_bps_npy_path(index)) # T X N X 3 
+
+        return obj_bps_data 
+
+    def load_rest_obj_bps_data(self, object_name):
+        if self.window_store is not None:
+            return self.window_store.get_rest_bps(object_name) # 1 X 1024 X 3 
+
+        rest_obj_bps_npy_path = os.path.join(self.rest_object_geo_folder, object_name+".npy")
+        rest_obj_bps_data = np.load(rest_obj_bps_npy_path) # 1 X 1024 X 3 
+
+        return rest_obj_bps_data 
+
     def filter_out_short_sequences(self):
         new_cnt = 0
         new_window_data_dict = {}
@@ -462,8 +584,8 @@ class CanoObjectTrajDataset(Dataset):
         # obj_verts: T X Nv X 3, obj_trans: T X 3
         bps_object_geo = self.bps_torch.encode(x=obj_verts, \
                     feature_type=['deltas'], \
-                    custom_basis=self.obj_bps.repeat(obj_trans.shape[0], \
-                    1, 1)+obj_trans[:, None, :])['deltas'] # T X N X 3 
+                    custom_basis=self.obj_bps.to(obj_trans.device).repeat(obj_trans.shape[0], \
+                    1, 1)+obj_trans[:, None, :])['deltas'].to(obj_verts.device) # T X N X 3 
 
         return bps_object_geo
 
@@ -484,6 +606,8 @@ class CanoObjectTrajDataset(Dataset):
 
         self.bps_torch = bps_torch()
 
+        self.bps_service = ObjectBPSService(self)
+
         self.obj_bps = self.bps['obj']
 
     def extract_rest_pose_object_geometry_and_rotation(self):
@@ -508,8 +632,230 @@ class CanoObjectTrajDataset(Dataset):
                 self.rest_pose_object_dict[object_name]['ori_trans'] = rest_pose_ori_com_pos # 1 X 3 
                 self.rest_pose_object_dict[object_name]['obj_trans_to_com_pos'] = obj_trans_to_com_pos # 1 X 3 
 
-    def cal_normalize_data_input(self):
+    def get_rest_verts(self, object_name):
+        # Load each rest pose mesh once instead of once per sequence. 
+        if object_name not in self.rest_verts_dict:
+            rest_obj_path = os.path.join(self.rest_object_geo_folder, object_name+".ply")
+            mesh = trimesh.load_mesh(rest_obj_path)
+            rest_verts = np.asarray(mesh.vertices) # Nv X 3
+            self.rest_verts_dict[object_name] = torch.from_numpy(rest_verts).float() # Nv X 3
+
+        return self.rest_verts_dict[object_name]
+
+    def get_window_start_t_idx_list(self, num_steps):
+        start_t_idx_list = []
+        # for start_t_idx in range(0, num_steps, self.window//2):
+        for start_t_idx in range(0, num_steps, self.window//4):
+            end_t_idx = start_t_idx + self.window - 1
+            
+            # Skip the segment that has a length < 30 
+            if end_t_idx - start_t_idx < 30:
+                continue 
+
+            start_t_idx_list.append(start_t_idx)
+
+        return start_t_idx_list 
+
+    def get_preprocess_params(self):
+        preprocess_params = {}
+        preprocess_params['version'] = PREPROCESS_CACHE_VERSION 
+        preprocess_params['window'] = self.window 
+        preprocess_params['window_stride'] = self.window//4 
+        preprocess_params['obj_bps'] = self.obj_bps 
+
+        return preprocess_params 
+
+    def get_input_geometry_hash(self):
+        # Content of the BPS basis, the object meshes and the rest pose geometry files. 
+        file_paths = [self.bps_path]
+        for folder in [self.obj_geo_root_folder, self.rest_object_geo_folder]:
+            for f_name in sorted(os.listdir(folder)):
+                if os.path.splitext(f_name)[1] in [".obj", ".ply", ".json"]:
+                    file_paths.append(os.path.join(folder, f_name))
+
+        return hash_data([[os.path.basename(f_path), self.preprocess_cache.hash_file(f_path)] for f_path in file_paths])
+
+    def get_preprocess_key(self, seq_data_path):
+        return hash_data(self.preprocess_cache.hash_file(seq_data_path), self.get_preprocess_params(), \
+            self.get_input_geometry_hash())
+
+    def get_seq_cache_key(self, index):
+        # Everything the windows of this sequence depend on: the sequence itself, the object geometry and the parameters. 
+        seq_name = self.data_dict[index]['seq_name']
+        object_name = seq_name.split("_")[1]
+
+        obj_mesh_path = os.path.join(self.obj_geo_root_folder, object_name+"_cleaned_simplified.obj")
+
+        return hash_data(self.get_preprocess_params(), self.data_dict[index], \
+            self.preprocess_cache.hash_file(obj_mesh_path), self.get_rest_verts(object_name), \
+            self.rest_pose_object_dict[object_name]) 
+
+    def cal_normalize_seq_windows(self, index, s_idx_start, seq_key=None):
+        # Canonicalize all windows of one sequence together. 
+        # Returns the window data and the canonicalized object poses of windows whose BPS file is missing. 
+        seq_name = self.data_dict[index]['seq_name']
+        object_name = seq_name.split("_")[1]
+
+        rest_pose_obj_data = self.rest_pose_object_dict[object_name]
+        rest_pose_rot_mat = rest_pose_obj_data['ori_rotation'] # 3 X 3
+
+        rest_verts = self.get_rest_verts(object_name) # Nv X 3
+
+        betas = self.data_dict[index]['betas'] # 1 X 16 
+        gender = self.data_dict[index]['gender']
+
+        seq_root_trans = self.data_dict[index]['trans'] # T X 3 
+        seq_root_orient = self.data_dict[index]['root_orient'] # T X 3 
+        seq_pose_body = self.data_dict[index]['pose_body'].reshape(-1, 21, 3) # T X 21 X 3
+
+        rest_human_offsets = self.data_dict[index]['rest_offsets'] # 22 X 3/24 X 3
+        trans2joint = self.data_dict[index]['trans2joint'] # 3 
+
+        # Used in old version without defining rest object geometry. 
+        seq_obj_trans = self.data_dict[index]['obj_trans'][:, :, 0] # T X 3
+        seq_obj_rot = self.data_dict[index]['obj_rot'] # T X 3 X 3 
+        seq_obj_scale = self.data_dict[index]['obj_scale'] # T  
+
+        seq_obj_verts, tmp_obj_faces = self.load_object_geometry(object_name, seq_obj_scale, \
+                    seq_obj_trans, seq_obj_rot) # T X Nv X 3, tensor
+        seq_obj_com_pos = seq_obj_verts.mean(dim=1) # T X 3 
+
+        obj_trans = seq_obj_com_pos.clone().detach().cpu().numpy() 
+
+        rest_pose_rot_mat_rep = torch.from_numpy(rest_pose_rot_mat).float()[None, :, :] # 1 X 3 X 3 
+        obj_rot = torch.from_numpy(self.data_dict[index]['obj_rot']) # T X 3 X 3 
+        obj_rot = torch.matmul(obj_rot, rest_pose_rot_mat_rep.repeat(obj_rot.shape[0], 1, 1).transpose(1, 2)) # T X 3 X 3  
+        obj_rot = obj_rot.detach().cpu().numpy() 
+
+        num_steps = seq_root_trans.shape[0]
+        start_t_idx_list = self.get_window_start_t_idx_list(num_steps)
+        if len(start_t_idx_list) == 0:
+            return [], []
+
+        # Gather all windows at once, frames after the sequence end repeat the last frame and are removed afterwards. 
+        frame_idx = np.minimum(np.asarray(start_t_idx_list)[:, None] + np.arange(self.window)[None], num_steps-1) # N X W 
+
+        joint_aa_rep = torch.cat((torch.from_numpy(seq_root_orient).float()[:, None, :], \
+            torch.from_numpy(seq_pose_body).float()), dim=1) # T X J X 3 
+        X = torch.from_numpy(rest_human_offsets).float()[None].repeat(joint_aa_rep.shape[0], 1, 1).detach().cpu().numpy() # T X J X 3 
+        X[:, 0, :] = seq_root_trans 
+        local_rot_mat = transforms.axis_angle_to_matrix(joint_aa_rep) # T X J X 3 X 3 
+        Q = transforms.matrix_to_quaternion(local_rot_mat).detach().cpu().numpy() # T X J X 4 
+
+        obj_rot_mat = torch.from_numpy(obj_rot).float() # T X 3 X 3 
+        obj_q = transforms.matrix_to_quaternion(obj_rot_mat).detach().cpu().numpy() # T X 4 
+
+        # Canonicalize based on the first human pose's orientation of each window. 
+        X, Q, new_obj_x, new_obj_q = rotate_at_frame_w_obj(X[frame_idx], Q[frame_idx], \
+        obj_trans[frame_idx], obj_q[frame_idx], \
+        np.repeat(trans2joint[np.newaxis], len(start_t_idx_list), axis=0), self.parents, n_past=1, floor_z=True)
+        # N X W X J X 3, N X W X J X 4, N X W X 3, N X W X 4 
+
+        new_local_rot_mat = transforms.quaternion_to_matrix(torch.from_numpy(Q).float()) # N X W X J X 3 X 3 
+        new_local_aa_rep = transforms.matrix_to_axis_angle(new_local_rot_mat) # N X W X J X 3 
+        new_obj_rot_mat = transforms.quaternion_to_matrix(torch.from_numpy(new_obj_q).float()) # N X W X 3 X 3
+
+        window_list = []
+        bps_input_list = []
+        for w_idx, start_t_idx in enumerate(start_t_idx_list):
+            end_t_idx = start_t_idx + self.window - 1
+            num_frames = min(self.window, num_steps - start_t_idx) 
+
+            new_seq_root_trans = X[w_idx, :num_frames, 0, :] # T X 3 
+            new_seq_root_orient = new_local_aa_rep[w_idx, :num_frames, 0, :] # T X 3
+            new_seq_pose_body = new_local_aa_rep[w_idx, :num_frames, 1:, :] # T X 21 X 3 
+
+            curr_new_obj_x = new_obj_x[w_idx, :num_frames] # T X 3 
+            curr_new_obj_rot_mat = new_obj_rot_mat[w_idx, :num_frames] # T X 3 X 3
+            
+            cano_obj_mat = torch.matmul(curr_new_obj_rot_mat[0], obj_rot_mat[start_t_idx].transpose(0, 1)) # 3 X 3 
+           
+            obj_verts = self.load_object_geometry_w_rest_geo(curr_new_obj_rot_mat, \
+                    torch.from_numpy(curr_new_obj_x).float().to(curr_new_obj_rot_mat.device), rest_verts)
+
+            center_verts = obj_verts.mean(dim=1) # T X 3 
+            
+            query = self.process_window_data(rest_human_offsets, trans2joint, \
+                new_seq_root_trans, new_seq_root_orient.detach().cpu().numpy(), \
+                new_seq_pose_body.detach().cpu().numpy(),  \
+                curr_new_obj_x, curr_new_obj_rot_mat.detach().cpu().numpy(), center_verts)
+
+            # BPS representation for this window is computed later, together with the other windows. 
+            if seq_key is not None:
+                bps_hash = hash_data(seq_key, start_t_idx)
+                dest_obj_bps_npy_path = self.preprocess_cache.get_bps_path(bps_hash)
+            else:
+                s_idx = s_idx_start + w_idx 
+                dest_obj_bps_npy_path = os.path.join(self.dest_obj_bps_npy_folder, seq_name+"_"+str(s_idx)+".npy")
+            if not os.path.exists(dest_obj_bps_npy_path):
+                bps_input_list.append((dest_obj_bps_npy_path, curr_new_obj_rot_mat.detach().cpu().numpy(), curr_new_obj_x))
+
+            curr_global_jpos = query['global_jpos'].detach().cpu().numpy()
+            curr_global_jvel = query['global_jvel'].detach().cpu().numpy()
+            curr_global_rot_6d = query['global_rot_6d'].detach().cpu().numpy()
+
+            window_data = {}
+            window_data['cano_obj_mat'] = cano_obj_mat.detach().cpu().numpy() 
+
+            window_data['motion'] = np.concatenate((curr_global_jpos.reshape(-1, 24*3), \
+            curr_global_jvel.reshape(-1, 24*3), curr_global_rot_6d.reshape(-1, 22*6)), axis=1) # T X (24*3+24*3+22*6)
+           
+            window_data['seq_name'] = seq_name
+            window_data['start_t_idx'] = start_t_idx
+            window_data['end_t_idx'] = end_t_idx 
+
+            window_data['betas'] = betas 
+            window_data['gender'] = gender
+
+            window_data['trans2joint'] = trans2joint 
+
+            window_data['obj_rot_mat'] = query['obj_rot_mat'].detach().cpu().numpy()
+
+            window_data['window_obj_com_pos'] = query['window_obj_com_pos'].detach().cpu().numpy() 
+
+            window_data['rest_human_offsets'] = rest_human_offsets 
+
+            if seq_key is not None:
+                window_data['bps_hash'] = bps_hash 
+
+            window_list.append(window_data)
+
+        return window_list, bps_input_list 
+
+    def save_window_bps(self, object_name, bps_input_list, max_bps_frames=2048):
+        # Encode the BPS of several windows in one call, bounded by max_bps_frames. 
+        rest_verts = self.get_rest_verts(object_name) # Nv X 3
+
+        batch_list = []
+        num_batch_frames = 0
+        for b_idx in range(len(bps_input_list)):
+            batch_list.append(bps_input_list[b_idx])
+            num_batch_frames += bps_input_list[b_idx][1].shape[0]
+            if num_batch_frames < max_bps_frames and b_idx < len(bps_input_list) - 1:
+                continue 
+
+            window_obj_rot_mat = torch.from_numpy(np.concatenate([b[1] for b in batch_list], axis=0)).float() # (N*T) X 3 X 3 
+            window_obj_x = torch.from_numpy(np.concatenate([b[2] for b in batch_list], axis=0)).float() # (N*T) X 3 
+            obj_verts = self.load_object_geometry_w_rest_geo(window_obj_rot_mat, window_obj_x, rest_verts) # (N*T) X Nv X 3 
+            center_verts = obj_verts.mean(dim=1) # (N*T) X 3 
+
+            object_bps = self.compute_object_geo_bps(obj_verts, center_verts).data.cpu().numpy() # (N*T) X 1024 X 3 
+
+            t_idx = 0
+            for dest_obj_bps_npy_path, curr_obj_rot_mat, _ in batch_list:
+                np.save(dest_obj_bps_npy_path, object_bps[t_idx:t_idx+curr_obj_rot_mat.shape[0]]) 
+                t_idx += curr_obj_rot_mat.shape[0]
+
+            batch_list = []
+            num_batch_frames = 0
+
+    def cal_normalize_data_input(self, num_workers=0):
         self.window_data_dict = {}
+        self.rest_verts_dict = {}
+
+        # Window indices only depend on sequence lengths, assign each sequence its first window index up front. 
+        seq_args = []
+        cached_seq_args = []
         s_idx = 0 
         for index in self.data_dict:
             seq_name = self.data_dict[index]['seq_name']
@@ -520,122 +866,53 @@ class CanoObjectTrajDataset(Dataset):
             if object_name in ["vacuum", "mop"]:
                 continue 
 
-            rest_pose_obj_data = self.rest_pose_object_dict[object_name]
-            rest_pose_rot_mat = rest_pose_obj_data['ori_rotation'] # 3 X 3
-
-            rest_obj_path = os.path.join(self.rest_object_geo_folder, object_name+".ply")
-            mesh = trimesh.load_mesh(rest_obj_path)
-            rest_verts = np.asarray(mesh.vertices) # Nv X 3
-            rest_verts = torch.from_numpy(rest_verts).float() # Nv X 3
-
-            betas = self.data_dict[index]['betas'] # 1 X 16 
-            gender = self.data_dict[index]['gender']
-
-            seq_root_trans = self.data_dict[index]['trans'] # T X 3 
-            seq_root_orient = self.data_dict[index]['root_orient'] # T X 3 
-            seq_pose_body = self.data_dict[index]['pose_body'].reshape(-1, 21, 3) # T X 21 X 3
-
-            rest_human_offsets = self.data_dict[index]['rest_offsets'] # 22 X 3/24 X 3
-            trans2joint = self.data_dict[index]['trans2joint'] # 3 
-
-            # Used in old version without defining rest object geometry. 
-            seq_obj_trans = self.data_dict[index]['obj_trans'][:, :, 0] # T X 3
-            seq_obj_rot = self.data_dict[index]['obj_rot'] # T X 3 X 3 
-            seq_obj_scale = self.data_dict[index]['obj_scale'] # T  
-
-            seq_obj_verts, tmp_obj_faces = self.load_object_geometry(object_name, seq_obj_scale, \
-                        seq_obj_trans, seq_obj_rot) # T X Nv X 3, tensor
-            seq_obj_com_pos = seq_obj_verts.mean(dim=1) # T X 3 
-
-            obj_trans = seq_obj_com_pos.clone().detach().cpu().numpy() 
-
-            rest_pose_rot_mat_rep = torch.from_numpy(rest_pose_rot_mat).float()[None, :, :] # 1 X 3 X 3 
-            obj_rot = torch.from_numpy(self.data_dict[index]['obj_rot']) # T X 3 X 3 
-            obj_rot = torch.matmul(obj_rot, rest_pose_rot_mat_rep.repeat(obj_rot.shape[0], 1, 1).transpose(1, 2)) # T X 3 X 3  
-            obj_rot = obj_rot.detach().cpu().numpy() 
-
-            num_steps = seq_root_trans.shape[0]
-            # for start_t_idx in range(0, num_steps, self.window//2):
-            for start_t_idx in range(0, num_steps, self.window//4):
-                end_t_idx = start_t_idx + self.window - 1
-                
-                # Skip the segment that has a length < 30 
-                if end_t_idx - start_t_idx < 30:
-                    continue 
-
-                self.window_data_dict[s_idx] = {}
-                
-                joint_aa_rep = torch.cat((torch.from_numpy(seq_root_orient[start_t_idx:end_t_idx+1]).float()[:, None, :], \
-                    torch.from_numpy(seq_pose_body[start_t_idx:end_t_idx+1]).float()), dim=1) # T X J X 3 
-                X = torch.from_numpy(rest_human_offsets).float()[None].repeat(joint_aa_rep.shape[0], 1, 1).detach().cpu().numpy() # T X J X 3 
-                X[:, 0, :] = seq_root_trans[start_t_idx:end_t_idx+1] 
-                local_rot_mat = transforms.axis_angle_to_matrix(joint_aa_rep) # T X J X 3 X 3 
-                Q = transforms.matrix_to_quaternion(local_rot_mat).detach().cpu().numpy() # T X J X 4 
-
-                obj_x = obj_trans[start_t_idx:end_t_idx+1].copy() # T X 3 
-                obj_rot_mat = torch.from_numpy(obj_rot[start_t_idx:end_t_idx+1]).float()# T X 3 X 3 
-                obj_q = transforms.matrix_to_quaternion(obj_rot_mat).detach().cpu().numpy() # T X 4 
-
-                # Canonicalize based on the first human pose's orientation. 
-                X, Q, new_obj_x, new_obj_q = rotate_at_frame_w_obj(X[np.newaxis], Q[np.newaxis], \
-                obj_x[np.newaxis], obj_q[np.newaxis], \
-                trans2joint[np.newaxis], self.parents, n_past=1, floor_z=True)
-                # 1 X T X J X 3, 1 X T X J X 4, 1 X T X 3, 1 X T X 4 
-
-                new_seq_root_trans = X[0, :, 0, :] # T X 3 
-                new_local_rot_mat = transforms.quaternion_to_matrix(torch.from_numpy(Q[0]).float()) # T X J X 3 X 3 
-                new_local_aa_rep = transforms.matrix_to_axis_angle(new_local_rot_mat) # T X J X 3 
-                new_seq_root_orient = new_local_aa_rep[:, 0, :] # T X 3
-                new_seq_pose_body = new_local_aa_rep[:, 1:, :] # T X 21 X 3 
-                
-                new_obj_rot_mat = transforms.quaternion_to_matrix(torch.from_numpy(new_obj_q[0]).float()) # T X 3 X 3
-                
-                cano_obj_mat = torch.matmul(new_obj_rot_mat[0], obj_rot_mat[0].transpose(0, 1)) # 3 X 3 
-               
-                obj_verts = self.load_object_geometry_w_rest_geo(new_obj_rot_mat, \
-                        torch.from_numpy(new_obj_x[0]).float().to(new_obj_rot_mat.device), rest_verts)
-
-                center_verts = obj_verts.mean(dim=1) # T X 3 
-                
-                query = self.process_window_data(rest_human_offsets, trans2joint, \
-                    new_seq_root_trans, new_seq_root_orient.detach().cpu().numpy(), \
-                    new_seq_pose_body.detach().cpu().numpy(),  \
-                    new_obj_x[0], new_obj_rot_mat.detach().cpu().numpy(), center_verts)
-
-                # Compute BPS representation for this window
-                # Save to numpy file 
-                dest_obj_bps_npy_path = os.path.join(self.dest_obj_bps_npy_folder, seq_name+"_"+str(s_idx)+".npy")
-
-                if not os.path.exists(dest_obj_bps_npy_path):
-                    # object_bps = self.compute_object_geo_bps(obj_verts[0:1], center_verts[0:1]) # For the setting that only computes the first frame. 
-                    object_bps = self.compute_object_geo_bps(obj_verts, center_verts) 
-                    np.save(dest_obj_bps_npy_path, object_bps.data.cpu().numpy()) 
-
-                curr_global_jpos = query['global_jpos'].detach().cpu().numpy()
-                curr_global_jvel = query['global_jvel'].detach().cpu().numpy()
-                curr_global_rot_6d = query['global_rot_6d'].detach().cpu().numpy()
+            # Sequences found in the preprocessing cache are not processed again. 
+            seq_key = None 
+            if self.preprocess_cache is not None:
+                seq_key = self.get_seq_cache_key(index)
 
-                self.window_data_dict[s_idx]['cano_obj_mat'] = cano_obj_mat.detach().cpu().numpy() 
+            if seq_key is not None and self.preprocess_cache.has_seq(seq_key):
+                cached_seq_args.append((index, s_idx, seq_key))
+            else:
+                seq_args.append((index, s_idx, seq_key))
+            s_idx += len(self.get_window_start_t_idx_list(self.data_dict[index]['trans'].shape[0]))
+
+        if self.preprocess_cache is not None:
+            print("Reuse {0} cached sequences, process {1} sequences".format(len(cached_seq_args), len(seq_args)))
+
+        # Workers canonicalize sequences on CPU while this process encodes BPS, which may use the GPU. 
+        pool = None 
+        if num_workers > 0:
+            global CAL_NORMALIZE_DATASET 
+            CAL_NORMALIZE_DATASET = self 
+            pool = multiprocessing.get_context("fork").Pool(num_workers, initializer=init_cal_normalize_worker)
+            seq_res_iter = pool.imap(cal_normalize_seq_worker, seq_args)
+        else:
+            seq_res_iter = (self.cal_normalize_seq_windows(*curr_seq_args) for curr_seq_args in seq_args)
 
-                self.window_data_dict[s_idx]['motion'] = np.concatenate((curr_global_jpos.reshape(-1, 24*3), \
-                curr_global_jvel.reshape(-1, 24*3), curr_global_rot_6d.reshape(-1, 22*6)), axis=1) # T X (24*3+24*3+22*6)
-               
-                self.window_data_dict[s_idx]['seq_name'] = seq_name
-                self.window_data_dict[s_idx]['start_t_idx'] = start_t_idx
-                self.window_data_dict[s_idx]['end_t_idx'] = end_t_idx 
+        for (index, s_idx_start, seq_key), (window_list, bps_input_list) in zip(seq_args, seq_res_iter):
+            for w_idx in range(len(window_list)):
+                self.window_data_dict[s_idx_start+w_idx] = window_list[w_idx]
 
-                self.window_data_dict[s_idx]['betas'] = betas 
-                self.window_data_dict[s_idx]['gender'] = gender
+            if len(bps_input_list) > 0:
+                object_name = self.data_dict[index]['seq_name'].split("_")[1]
+                self.save_window_bps(object_name, bps_input_list)
 
-                self.window_data_dict[s_idx]['trans2joint'] = trans2joint 
+            # Only add the entry once its BPS files are written. 
+            if seq_key is not None:
+                self.preprocess_cache.dump_seq(seq_key, window_list)
 
-                self.window_data_dict[s_idx]['obj_rot_mat'] = query['obj_rot_mat'].detach().cpu().numpy()
-    
-                self.window_data_dict[s_idx]['window_obj_com_pos'] = query['window_obj_com_pos'].detach().cpu().numpy() 
+        if pool is not None:
+            pool.close()
+            pool.join()
+            CAL_NORMALIZE_DATASET = None 
 
-                self.window_data_dict[s_idx]['rest_human_offsets'] = rest_human_offsets 
+        for index, s_idx_start, seq_key in cached_seq_args:
+            window_list = self.preprocess_cache.load_seq(seq_key)
+            for w_idx in range(len(window_list)):
+                self.window_data_dict[s_idx_start+w_idx] = window_list[w_idx]
 
-                s_idx += 1 
+        self.window_data_dict = {k: self.window_data_dict[k] for k in sorted(self.window_data_dict.keys())}
        
     def extract_min_max_mean_std_from_data(self):
         all_global_jpos_data = []
@@ -734,12 +1011,12 @@ class CanoObjectTrajDataset(Dataset):
         random_t_idx = 0 
         end_t_idx = seq_root_trans.shape[0] - 1
 
-        window_root_trans = torch.from_numpy(seq_root_trans[random_t_idx:end_t_idx+1]).cuda()
-        window_root_orient = torch.from_numpy(seq_root_orient[random_t_idx:end_t_idx+1]).float().cuda()
-        window_pose_body  = torch.from_numpy(seq_pose_body[random_t_idx:end_t_idx+1]).float().cuda()
+        window_root_trans = torch.from_numpy(seq_root_trans[random_t_idx:end_t_idx+1]).to(self.device)
+        window_root_orient = torch.from_numpy(seq_root_orient[random_t_idx:end_t_idx+1]).float().to(self.device)
+        window_pose_body  = torch.from_numpy(seq_pose_body[random_t_idx:end_t_idx+1]).float().to(self.device)
 
-        window_obj_rot_mat = torch.from_numpy(obj_rot[random_t_idx:end_t_idx+1]).float().cuda() # T X 3 X 3 
-        window_obj_trans = torch.from_numpy(obj_trans[random_t_idx:end_t_idx+1]).float().cuda() # T X 3
+        window_obj_rot_mat = torch.from_numpy(obj_rot[random_t_idx:end_t_idx+1]).float().to(self.device) # T X 3 X 3 
+        window_obj_trans = torch.from_numpy(obj_trans[random_t_idx:end_t_idx+1]).float().to(self.device) # T X 3
 
         window_center_verts = center_verts[random_t_idx:end_t_idx+1].to(window_obj_trans.device)
 
@@ -761,8 +1038,8 @@ class CanoObjectTrajDataset(Dataset):
 
         curr_seq_pose_aa = torch.cat((window_root_orient[:, None, :], window_pose_body), dim=1) # T' X 22 X 3/T' X 24 X 3 
         rest_human_offsets = torch.from_numpy(rest_human_offsets).float()[None] 
-        curr_seq_local_jpos = rest_human_offsets.repeat(curr_seq_pose_aa.shape[0], 1, 1).cuda() # T' X 22 X 3/T' X 24 X 3  
-        curr_seq_local_jpos[:, 0, :] = window_root_trans - torch.from_numpy(trans2joint).cuda()[None] # T' X 22/24 X 3 
+        curr_seq_local_jpos = rest_human_offsets.repeat(curr_seq_pose_aa.shape[0], 1, 1).to(self.device) # T' X 22 X 3/T' X 24 X 3  
+        curr_seq_local_jpos[:, 0, :] = window_root_trans - torch.from_numpy(trans2joint).to(self.device)[None] # T' X 22/24 X 3 
 
         local_joint_rot_mat = transforms.axis_angle_to_matrix(curr_seq_pose_aa)
         _, human_jnts = quat_fk_torch(local_joint_rot_mat, curr_seq_local_jpos)
@@ -831,8 +1108,7 @@ class CanoObjectTrajDataset(Dataset):
         window_obj_rot_mat = torch.from_numpy(window_obj_rot_mat).float()
         obj_com_pos = torch.from_numpy(obj_com_pos).float()
 
-        rest_obj_bps_npy_path = os.path.join(self.rest_object_geo_folder, object_name+".npy")
-        rest_obj_bps_data = np.load(rest_obj_bps_npy_path) # 1 X 1024 X 3 
+        rest_obj_bps_data = self.load_rest_obj_bps_data(object_name) # 1 X 1024 X 3 
         nn_pts_on_mesh = self.obj_bps + torch.from_numpy(rest_obj_bps_data).float().to(self.obj_bps.device) # 1 X 1024 X 3 
         nn_pts_on_mesh = nn_pts_on_mesh.squeeze(0) # 1024 X 3 
 
@@ -854,8 +1130,7 @@ class CanoObjectTrajDataset(Dataset):
         
         window_s_idx = self.window_data_dict[index]['start_t_idx']
         window_e_idx = self.window_data_dict[index]['end_t_idx']
-        contact_npy_path = os.path.join(self.contact_npy_folder, seq_name+".npy")
-        contact_npy_data = np.load(contact_npy_path) # T X 4 (lhand, rhand, lfoot, rfoot)
+        contact_npy_data = self.load_contact_labels(seq_name) # T X 4 (lhand, rhand, lfoot, rfoot)
         contact_labels = contact_npy_data[window_s_idx:window_e_idx+1] # W 
         contact_labels = torch.from_numpy(contact_labels).float() 
 
@@ -863,16 +1138,7 @@ class CanoObjectTrajDataset(Dataset):
 
         rest_human_offsets = self.window_data_dict[index]['rest_human_offsets']  
 
-        if self.use_random_frame_bps:
-            if (not self.train) or self.use_object_splits or self.input_language_condition:
-                ori_w_idx = self.window_data_dict[index]['ori_w_idx']
-                obj_bps_npy_path = os.path.join(self.dest_obj_bps_npy_folder, seq_name+"_"+str(ori_w_idx)+".npy") 
-            else:
-                obj_bps_npy_path = os.path.join(self.dest_obj_bps_npy_folder, seq_name+"_"+str(index)+".npy") 
-        else:
-            obj_bps_npy_path = os.path.join(self.rest_object_geo_folder, object_name+".npy")
-
-        obj_bps_data = np.load(obj_bps_npy_path) # T X N X 3 
+        obj_bps_data = self.load_obj_bps_data(index) # T X N X 3 
 
         if self.use_random_frame_bps:
             random_sampled_t_idx = random.sample(list(range(obj_bps_data.shape[0])), 1)[0]
@@ -904,8 +1170,7 @@ class CanoObjectTrajDataset(Dataset):
         # Prepare object keypoints for each frame. 
         if self.use_object_keypoints:
             # Load rest pose BPS and compute nn points on the object. 
-            rest_obj_bps_npy_path = os.path.join(self.rest_object_geo_folder, object_name+".npy")
-            rest_obj_bps_data = np.load(rest_obj_bps_npy_path) # 1 X 1024 X 3 
+            rest_obj_bps_data = self.load_rest_obj_bps_data(object_name) # 1 X 1024 X 3 
             nn_pts_on_mesh = self.obj_bps + torch.from_numpy(rest_obj_bps_data).float().to(self.obj_bps.device) # 1 X 1024 X 3 
             nn_pts_on_mesh = nn_pts_on_mesh.squeeze(0) # 1024 X 3 
 
@@ -1004,7 +1269,10 @@ class CanoObjectTrajDataset(Dataset):
         
         if self.input_language_condition:
             # Load language annotation 
-            seq_text_anno = self.load_language_annotation(seq_name) 
+            if self.window_store is not None:
+                seq_text_anno = self.window_store.get_text(seq_name)
+            else:
+                seq_text_anno = self.load_language_annotation(seq_name) 
             data_input_dict['text'] = seq_text_anno # a string 
 
         if self.use_object_keypoints:
@@ -36,10 +36,13 @@ class LongCanoObjectTrajDataset(Dataset):
         use_first_frame_bps=False, 
         use_random_frame_bps=False, 
         test_object_name="largebox",
+        device="cuda", 
     ):
         
         self.window = window 
 
+        self.device = device 
+
         self.use_object_splits = use_object_splits 
         self.train_objects = ["largetable", "woodchair", "plasticbox", "largebox", "smallbox", "trashcan", "monitor", \
                     "floorlamp", "clothesstand"] 
@@ -170,9 +173,9 @@ class LongCanoObjectTrajDataset(Dataset):
         for p in self.neutral_bm.parameters():
             p.requires_grad = False 
 
-        self.male_bm = self.male_bm.cuda()
-        self.female_bm = self.female_bm.cuda()
-        self.neutral_bm = self.neutral_bm.cuda() 
+        self.male_bm = self.male_bm.to(self.device)
+        self.female_bm = self.female_bm.to(self.device)
+        self.neutral_bm = self.neutral_bm.to(self.device) 
         
         self.bm_dict = {'male' : self.male_bm, 'female' : self.female_bm, 'neutral': self.neutral_bm}
 
@@ -314,8 +317,8 @@ class LongCanoObjectTrajDataset(Dataset):
         # obj_verts: T X Nv X 3, obj_trans: T X 3
         bps_object_geo = self.bps_torch.encode(x=obj_verts, \
                     feature_type=['deltas'], \
-                    custom_basis=self.obj_bps.repeat(obj_trans.shape[0], \
-                    1, 1)+obj_trans[:, None, :])['deltas'] # T X N X 3 
+                    custom_basis=self.obj_bps.to(obj_trans.device).repeat(obj_trans.shape[0], \
+                    1, 1)+obj_trans[:, None, :])['deltas'].to(obj_verts.device) # T X N X 3 
 
         return bps_object_geo
 
@@ -558,13 +561,13 @@ class LongCanoObjectTrajDataset(Dataset):
         random_t_idx = 0 
         end_t_idx = seq_root_trans.shape[0] - 1
 
-        window_root_trans = torch.from_numpy(seq_root_trans[random_t_idx:end_t_idx+1]).cuda()
-        window_root_orient = torch.from_numpy(seq_root_orient[random_t_idx:end_t_idx+1]).float().cuda()
-        window_pose_body  = torch.from_numpy(seq_pose_body[random_t_idx:end_t_idx+1]).float().cuda()
+        window_root_trans = torch.from_numpy(seq_root_trans[random_t_idx:end_t_idx+1]).to(self.device)
+        window_root_orient = torch.from_numpy(seq_root_orient[random_t_idx:end_t_idx+1]).float().to(self.device)
+        window_pose_body  = torch.from_numpy(seq_pose_body[random_t_idx:end_t_idx+1]).float().to(self.device)
 
         # window_obj_scale = torch.from_numpy(obj_scale[random_t_idx:end_t_idx+1]).float().cuda() # T
-        window_obj_rot_mat = torch.from_numpy(obj_rot[random_t_idx:end_t_idx+1]).float().cuda() # T X 3 X 3 
-        window_obj_trans = torch.from_numpy(obj_trans[random_t_idx:end_t_idx+1]).float().cuda() # T X 3
+        window_obj_rot_mat = torch.from_numpy(obj_rot[random_t_idx:end_t_idx+1]).float().to(self.device) # T X 3 X 3 
+        window_obj_trans = torch.from_numpy(obj_trans[random_t_idx:end_t_idx+1]).float().to(self.device) # T X 3
 
         window_center_verts = center_verts[random_t_idx:end_t_idx+1].to(window_obj_trans.device)
 
@@ -586,8 +589,8 @@ class LongCanoObjectTrajDataset(Dataset):
 
         curr_seq_pose_aa = torch.cat((window_root_orient[:, None, :], window_pose_body), dim=1) # T' X 22 X 3/T' X 24 X 3 
         rest_human_offsets = torch.from_numpy(rest_human_offsets).float()[None] 
-        curr_seq_local_jpos = rest_human_offsets.repeat(curr_seq_pose_aa.shape[0], 1, 1).cuda() # T' X 22 X 3/T' X 24 X 3  
-        curr_seq_local_jpos[:, 0, :] = window_root_trans - torch.from_numpy(trans2joint).cuda()[None] # T' X 22/24 X 3 
+        curr_seq_local_jpos = rest_human_offsets.repeat(curr_seq_pose_aa.shape[0], 1, 1).to(self.device) # T' X 22 X 3/T' X 24 X 3  
+        curr_seq_local_jpos[:, 0, :] = window_root_trans - torch.from_numpy(trans2joint).to(self.device)[None] # T' X 22/24 X 3 
 
         local_joint_rot_mat = transforms.axis_angle_to_matrix(curr_seq_pose_aa)
         _, human_jnts = quat_fk_torch(local_joint_rot_mat, curr_seq_local_jpos)
@@ -0,0 +1,226 @@
+import numpy as np
+
+from manip.lafan1.utils import quat_between, quat_normalize, quat_mul_vec, normalize
+
+
+# Paths of different lengths are packed into one array of points, path p is points[offsets[p]:offsets[p+1]].
+# All the functions below work on a whole set of packed paths at once.
+
+def pack_paths(path_list):
+    # path_list: list of K_i X D arrays, returns sum(K_i) X D points and N+1 offsets
+    offsets = np.zeros(len(path_list)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([path.shape[0] for path in path_list])
+    if len(path_list) == 0:
+        return np.zeros((0, 3)), offsets
+
+    return np.concatenate(path_list, axis=0), offsets
+
+def unpack_paths(points, offsets):
+    return [points[offsets[p_idx]:offsets[p_idx+1]] for p_idx in range(len(offsets)-1)]
+
+def get_path_ids(offsets):
+    # Returns the path index of each packed point.
+    return np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+
+def compute_segment_lengths(points, offsets):
+    # Returns sum(K_i)-1 lengths between consecutive packed points, 0 between the end of a path and the next start.
+    path_ids = get_path_ids(offsets)
+    seg_lengths = np.linalg.norm(np.diff(points, axis=0), axis=-1)
+    seg_lengths[path_ids[1:] != path_ids[:-1]] = 0
+
+    return seg_lengths
+
+def compute_path_lengths(points, offsets):
+    # Returns N total lengths.
+    path_ids = get_path_ids(offsets)
+    return np.bincount(path_ids[1:], weights=compute_segment_lengths(points, offsets), \
+        minlength=len(offsets)-1)
+
+def select_paths(points, offsets, keep_mask):
+    # keep_mask: N bool, returns the packed points and offsets of the kept paths.
+    point_mask = np.repeat(keep_mask, np.diff(offsets))
+    new_offsets = np.zeros(keep_mask.sum()+1, dtype=np.int64)
+    new_offsets[1:] = np.cumsum(np.diff(offsets)[keep_mask])
+
+    return points[point_mask], new_offsets
+
+def filter_paths(points, offsets, floor_heights, min_length=3., max_length=None, max_start_height=0.2, height_dim=1):
+    # floor_heights: N, floor height of each path's scene
+    # Discard short (or long) paths and paths that do not start on the floor, returns an N bool mask.
+    path_lengths = compute_path_lengths(points, offsets)
+    keep_mask = path_lengths >= min_length
+    if max_length is not None:
+        keep_mask &= path_lengths <= max_length
+
+    start_heights = points[offsets[:-1], height_dim]
+    keep_mask &= start_heights <= floor_heights + max_start_height
+
+    return keep_mask
+
+def convert_habitat_coord_to_model(habitat_coord):
+    # habitat_coord: ... X 3, y is up in Habitat, z is up in the model frame
+    return np.stack((habitat_coord[..., 0], -habitat_coord[..., 2], habitat_coord[..., 1]), axis=-1)
+
+def resample_paths_by_distance(points, offsets, num_samples_per_seg=20, dist_range=(0.7, 0.8)):
+    # Same as apply_heuristics_to_planned_path for all the paths: every segment is sampled uniformly, then starting from
+    # the first point, the next sample whose distance along the path to the last selected point is in dist_range is
+    # selected. A path stops once that distance jumps over the range.
+    # points: sum(K_i) X D, returns the packed selected points and offsets.
+    path_ids = get_path_ids(offsets)
+    seg_mask = path_ids[1:] == path_ids[:-1] # Segments inside a path
+    seg_start = points[:-1][seg_mask] # S X D
+    seg_end = points[1:][seg_mask]
+    seg_path_ids = path_ids[1:][seg_mask]
+
+    alpha = np.arange(num_samples_per_seg+1) / num_samples_per_seg # Both ends of each segment are sampled
+    samples = (1 - alpha[None, :, None]) * seg_start[:, None] + alpha[None, :, None] * seg_end[:, None]
+    samples = samples.reshape(-1, points.shape[1]) # (S*(n+1)) X D
+    sample_path_ids = np.repeat(seg_path_ids, num_samples_per_seg+1)
+
+    # Distance along the path, kept increasing across paths so one searchsorted serves all of them.
+    step_dists = np.linalg.norm(np.diff(samples, axis=0), axis=-1)
+    step_dists[sample_path_ids[1:] != sample_path_ids[:-1]] = 0
+    cum_dists = np.concatenate(([0.], np.cumsum(step_dists)))
+
+    num_paths = len(offsets) - 1
+    sample_offsets = np.zeros(num_paths+1, dtype=np.int64)
+    sample_offsets[1:] = np.cumsum(np.bincount(sample_path_ids, minlength=num_paths))
+
+    active_paths = np.nonzero(np.diff(sample_offsets) > 0)[0]
+    last_idx = sample_offsets[active_paths]
+    selected_idx_list = [last_idx]
+    while active_paths.shape[0] > 0:
+        next_idx = np.searchsorted(cum_dists, cum_dists[last_idx] + dist_range[0], side='left')
+        valid = next_idx < sample_offsets[active_paths+1]
+        valid[valid] = cum_dists[next_idx[valid]] - cum_dists[last_idx[valid]] <= dist_range[1]
+
+        active_paths = active_paths[valid]
+        last_idx = next_idx[valid]
+        selected_idx_list.append(last_idx)
+
+    selected_idx = np.sort(np.concatenate(selected_idx_list))
+    new_offsets = np.zeros(num_paths+1, dtype=np.int64)
+    new_offsets[1:] = np.cumsum(np.bincount(sample_path_ids[selected_idx], minlength=num_paths))
+
+    return samples[selected_idx], new_offsets
+
+def densify_paths(points, offsets, step=0.7):
+    # Same as generate_dense_waypoints for all the paths: inside each segment, points every step from its start,
+    # then its end waypoint unless the last point landed on it. The first and last waypoints are repeated.
+    num_paths = len(offsets) - 1
+    path_ids = get_path_ids(offsets)
+    seg_mask = path_ids[1:] == path_ids[:-1]
+    seg_end_idx = np.nonzero(seg_mask)[0] + 1 # S, index of the end waypoint of each segment
+    seg_lengths = np.linalg.norm(points[seg_end_idx] - points[seg_end_idx-1], axis=-1)
+
+    # Distance of the k-th point from the segment start, accumulated the same way as the loop.
+    max_num = int(np.max(seg_lengths) // step) + 2 if seg_lengths.shape[0] > 0 else 1
+    acc_dists = np.cumsum(np.full(max_num, step))
+    num_inserted = np.searchsorted(acc_dists, seg_lengths, side='right') # S
+    last_dists = np.concatenate(([0.], acc_dists))[num_inserted]
+    num_items = num_inserted + (last_dists < seg_lengths) # Inserted points and the end waypoint
+
+    item_seg = np.repeat(np.arange(seg_end_idx.shape[0]), num_items)
+    k = np.arange(item_seg.shape[0]) - np.repeat(np.cumsum(num_items) - num_items, num_items) # 0-based
+    is_inserted = k < num_inserted[item_seg]
+    t = np.where(is_inserted, acc_dists[np.minimum(k, max_num-1)] / np.maximum(seg_lengths[item_seg], 1e-12), 1.)
+    seg_points = (1 - t[:, None]) * points[seg_end_idx[item_seg]-1] + t[:, None] * points[seg_end_idx[item_seg]]
+    seg_points[~is_inserted] = points[seg_end_idx[item_seg[~is_inserted]]]
+
+    # Order by the waypoint each point ends at, path start first and path end last.
+    nonempty = np.nonzero(np.diff(offsets) > 0)[0]
+    start_idx = offsets[nonempty]
+    end_idx = offsets[nonempty+1] - 1
+    all_points = np.concatenate((points[start_idx], seg_points, points[end_idx]), axis=0)
+    sort_idx = np.concatenate((start_idx, seg_end_idx[item_seg], end_idx))
+    sort_k = np.concatenate((np.full(start_idx.shape[0], -1), k, np.full(end_idx.shape[0], max_num+1)))
+    order = np.lexsort((sort_k, sort_idx))
+
+    new_offsets = np.zeros(num_paths+1, dtype=np.int64)
+    new_offsets[1:] = np.cumsum(np.bincount(path_ids[sort_idx], minlength=num_paths))
+
+    return all_points[order], new_offsets
+
+def trim_paths_to_windows(points, offsets, remainder=3):
+    # Same as adjust_waypoints for all the paths: drop the first points until the number of points is 4*n+remainder.
+    num_points = np.diff(offsets)
+    num_dropped = (num_points - remainder) % 4
+    point_rank = np.arange(points.shape[0]) - np.repeat(offsets[:-1], num_points)
+    point_mask = point_rank >= np.repeat(num_dropped, num_points)
+
+    new_offsets = np.zeros_like(offsets)
+    new_offsets[1:] = np.cumsum(np.maximum(num_points - num_dropped, 0))
+
+    return points[point_mask], new_offsets
+
+def canonicalize_paths(points, offsets):
+    # Rotate each path (D = 3) so that the direction from its 2nd to 3rd point is +x, same as canonizalize_planned_path.
+    # Returns the rotated packed points and N X 4 quaternions, paths need at least 3 points.
+    path_ids = get_path_ids(offsets)
+    forward = normalize(points[offsets[:-1]+2] - points[offsets[:-1]+1]) # N X 3
+    cano_quat = quat_normalize(quat_between(forward, np.array([1, 0, 0]))) # N X 4
+
+    return quat_mul_vec(cano_quat[path_ids], points), cano_quat
+
+def sample_dense_waypoints(waypoints, distance_range=(0.6, 0.8), remainder=1):
+    # waypoints: K X 2, inserts evenly spaced points in each segment so consecutive points are about
+    # distance_range apart, then removes the points closest to their predecessor until there are 4*n+remainder.
+    assert remainder in [0, 1, 2, 3], "Remainder must be one of [0, 1, 2, 3]."
+
+    segment_lengths = np.linalg.norm(np.diff(waypoints, axis=0), axis=-1)
+
+    # For each segment, compute the number of intermediate points to insert
+    num_points_per_segment = np.ceil(segment_lengths / distance_range[0]) - 1
+    num_points_per_segment = np.maximum(num_points_per_segment, \
+                        np.floor(segment_lengths / distance_range[1]) - 1).astype(int)
+    num_points_per_segment = np.maximum(num_points_per_segment, 0)
+
+    # Each segment contributes its intermediate points and its end waypoint.
+    seg_idx = np.repeat(np.arange(segment_lengths.shape[0]), num_points_per_segment+1)
+    j = np.arange(seg_idx.shape[0]) - np.repeat(np.cumsum(num_points_per_segment+1) - \
+        (num_points_per_segment+1), num_points_per_segment+1) + 1
+    t = j / (num_points_per_segment[seg_idx] + 1) # 1 for the end waypoint
+    dense_waypoints = (1 - t[:, None]) * waypoints[seg_idx] + t[:, None] * waypoints[seg_idx+1]
+    dense_waypoints[t == 1] = waypoints[seg_idx[t == 1]+1]
+    dense_waypoints = np.concatenate((waypoints[0:1], dense_waypoints), axis=0)
+
+    # Adjust number of waypoints to ensure it's of the desired form
+    while dense_waypoints.shape[0] % 4 != remainder:
+        # For simplicity, remove the point closest to its neighbor
+        min_dist_idx = np.argmin(np.linalg.norm(np.diff(dense_waypoints, axis=0), axis=-1)) + 1
+        dense_waypoints = np.delete(dense_waypoints, min_dist_idx, axis=0)
+
+    return dense_waypoints
+
+
+class PathStore:
+    # All the paths of an evaluation set in one npz file: packed points, offsets and the name of each path
+    # (e.g. scene/object/text_idx/file.npy), instead of one npy file per path.
+    def __init__(self, points, offsets, names, extra_data=None):
+        self.points = points
+        self.offsets = offsets
+        self.names = list(names)
+        self.extra_data = {} if extra_data is None else extra_data
+
+        self.name2idx = {name: p_idx for p_idx, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.name2idx
+
+    def get(self, name):
+        p_idx = self.name2idx[name]
+        return self.points[self.offsets[p_idx]:self.offsets[p_idx+1]]
+
+    def save(self, dest_store_path):
+        np.savez(dest_store_path, points=self.points, offsets=self.offsets, names=np.asarray(self.names), \
+            **self.extra_data)
+
+    @classmethod
+    def load(cls, store_path):
+        npz_data = np.load(store_path)
+        extra_data = {k: npz_data[k] for k in npz_data.files if k not in ['points', 'offsets', 'names']}
+
+        return cls(npz_data['points'], npz_data['offsets'], npz_data['names'].tolist(), extra_data=extra_data)
@@ -0,0 +1,101 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import joblib
+
+import torch
+
+# Bump when the window processing changes so that old entries are not reused.
+PREPROCESS_CACHE_VERSION = 1
+
+
+def update_hash(h, data):
+    if isinstance(data, dict):
+        h.update(b"dict")
+        for k in sorted(data.keys(), key=str):
+            update_hash(h, str(k))
+            update_hash(h, data[k])
+    elif isinstance(data, (list, tuple)):
+        h.update(b"list")
+        for v in data:
+            update_hash(h, v)
+    elif torch.is_tensor(data):
+        update_hash(h, data.detach().cpu().numpy())
+    elif isinstance(data, np.ndarray):
+        h.update(str(data.dtype).encode())
+        h.update(str(data.shape).encode())
+        h.update(np.ascontiguousarray(data).tobytes())
+    else:
+        h.update(type(data).__name__.encode())
+        h.update(str(data).encode())
+
+
+def hash_data(*data):
+    h = hashlib.sha1()
+    for v in data:
+        update_hash(h, v)
+
+    return h.hexdigest()
+
+
+class PreprocessCache:
+    # Content-addressed cache for the window preprocessing. Entries are keyed on hashes of the input data and the
+    # processing parameters, so a config change only recomputes the sequences and windows it affects.
+    def __init__(self, cache_folder):
+        self.cache_folder = cache_folder
+
+        self.seq_folder = os.path.join(self.cache_folder, "seq_windows")
+        self.bps_folder = os.path.join(self.cache_folder, "window_bps")
+        for folder in [self.seq_folder, self.bps_folder]:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+        # Content hashes of large input files, reused while their size and modification time do not change.
+        self.file_hash_path = os.path.join(self.cache_folder, "file_hashes.json")
+        self.file_hash_dict = {}
+        if os.path.exists(self.file_hash_path):
+            self.file_hash_dict = json.load(open(self.file_hash_path, 'r'))
+
+    def hash_file(self, file_path):
+        file_path = os.path.abspath(file_path)
+        file_stat = os.stat(file_path)
+        stat_key = [file_stat.st_size, file_stat.st_mtime_ns]
+
+        if file_path in self.file_hash_dict and self.file_hash_dict[file_path][0] == stat_key:
+            return self.file_hash_dict[file_path][1]
+
+        h = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(16*1024*1024), b""):
+                h.update(chunk)
+
+        self.file_hash_dict[file_path] = [stat_key, h.hexdigest()]
+        json.dump(self.file_hash_dict, open(self.file_hash_path, 'w'))
+
+        return h.hexdigest()
+
+    def get_windows_path(self, key):
+        return os.path.join(self.cache_folder, "windows_"+key+".p")
+
+    def get_stats_path(self, key):
+        return os.path.join(self.cache_folder, "min_max_mean_std_"+key+".p")
+
+    def get_seq_path(self, key):
+        return os.path.join(self.seq_folder, key+".p")
+
+    def get_bps_path(self, key):
+        return os.path.join(self.bps_folder, key+".npy")
+
+    def has_seq(self, key):
+        return os.path.exists(self.get_seq_path(key))
+
+    def load_seq(self, key):
+        return joblib.load(self.get_seq_path(key))
+
+    def dump_seq(self, key, window_list):
+        # Write to a temporary file first so that an interrupted run does not leave a broken entry.
+        tmp_path = self.get_seq_path(key)+".tmp"
+        joblib.dump(window_list, tmp_path)
+        os.replace(tmp_path, self.get_seq_path(key))
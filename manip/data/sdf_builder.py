@@ -0,0 +1,149 @@
+import json
+import time
+
+import numpy as np
+
+import trimesh
+from scipy.spatial import cKDTree
+
+
+class MeshSDFBuilder:
+    # Signed distance grids of a mesh in the normalized frame used by the SDF files: vertices are moved to the
+    # bounding box centroid and scaled by 2 / max extent, so the grid covers [-1, 1]^3.
+    # Distances are taken to a dense surface sample, the sign is voted by the normals of the nearest samples,
+    # same as mesh_to_sdf's sample/normal method. Grid points are evaluated in chunks with parallel KD-tree queries.
+    def __init__(self, mesh, sample_point_count=1000000, normal_sample_count=11, num_workers=-1, chunk_size=2**20):
+        self.centroid = np.copy(mesh.bounding_box.centroid)
+        self.extents = np.copy(mesh.bounding_box.extents)
+        scale = 2. / np.max(self.extents)
+
+        surface_pts, face_idx = trimesh.sample.sample_surface(mesh, sample_point_count)
+        self.surface_pts = (surface_pts - self.centroid) * scale # N X 3
+        self.surface_normals = mesh.face_normals[face_idx] # N X 3
+        self.kd_tree = cKDTree(self.surface_pts)
+
+        self.normal_sample_count = normal_sample_count
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+
+    def query(self, points):
+        # points: N X 3 in the normalized frame, returns N signed distances, negative inside.
+        sdf = np.zeros(points.shape[0], dtype=np.float32)
+        for c_idx in range(0, points.shape[0], self.chunk_size):
+            chunk_pts = points[c_idx:c_idx+self.chunk_size]
+            dists, nn_idx = self.kd_tree.query(chunk_pts, k=self.normal_sample_count, workers=self.num_workers)
+            if self.normal_sample_count == 1:
+                dists = dists[:, None]
+                nn_idx = nn_idx[:, None]
+
+            dir_from_surface = chunk_pts[:, None, :] - self.surface_pts[nn_idx] # N' X K X 3
+            inside_votes = np.einsum('ijk,ijk->ij', dir_from_surface, self.surface_normals[nn_idx]) < 0
+            inside = inside_votes.sum(axis=1) > self.normal_sample_count * 0.5
+
+            chunk_sdf = dists[:, 0]
+            chunk_sdf[inside] *= -1
+            sdf[c_idx:c_idx+self.chunk_size] = chunk_sdf
+
+        return sdf
+
+    def build_dense(self, grid_dim=256):
+        # Returns grid_dim X grid_dim X grid_dim, indexed by x, y, z, same layout as mesh_to_voxels.
+        lin = np.linspace(-1, 1, grid_dim)
+        slab_size = max(1, self.chunk_size // (grid_dim * grid_dim))
+
+        sdf = np.zeros((grid_dim, grid_dim, grid_dim), dtype=np.float32)
+        for x_idx in range(0, grid_dim, slab_size):
+            slab_pts = np.stack(np.meshgrid(lin[x_idx:x_idx+slab_size], lin, lin, indexing='ij'), axis=-1)
+            sdf[x_idx:x_idx+slab_size] = self.query(slab_pts.reshape(-1, 3)).reshape(slab_pts.shape[:3])
+
+        return sdf
+
+    def build_multi_res(self, num_blocks=32, block_size=8, band=None):
+        # Coarse grid with one point per block corner, plus fine blocks of (block_size+1)^3 points for the blocks
+        # that are within band of the surface. The fine grid has num_blocks*block_size+1 points per axis,
+        # neighboring blocks share their border points so each block can be interpolated on its own.
+        # band: in the normalized frame, defaults to one block size.
+        block_len = 2. / num_blocks
+        if band is None:
+            band = block_len
+
+        coarse_sdf = self.build_dense(num_blocks+1) # (B+1) X (B+1) X (B+1)
+
+        # SDF is 1-Lipschitz, a block only has points within band if one of its corners is within band + diagonal.
+        corner_min = np.abs(coarse_sdf)
+        for axis in range(3):
+            corner_min = np.minimum(np.take(corner_min, range(num_blocks), axis=axis), \
+                        np.take(corner_min, range(1, num_blocks+1), axis=axis))
+        block_idx = np.argwhere(corner_min < band + block_len * np.sqrt(3)).astype(np.int32) # K X 3
+
+        fine_dim = num_blocks * block_size + 1
+        fine_lin = np.linspace(-1, 1, fine_dim)
+        offsets = np.stack(np.meshgrid(*[np.arange(block_size+1)]*3, indexing='ij'), axis=-1).reshape(-1, 3)
+
+        blocks_per_chunk = max(1, self.chunk_size // offsets.shape[0])
+        block_sdf = np.zeros((block_idx.shape[0], block_size+1, block_size+1, block_size+1), dtype=np.float32)
+        for b_idx in range(0, block_idx.shape[0], blocks_per_chunk):
+            fine_idx = block_idx[b_idx:b_idx+blocks_per_chunk, None, :] * block_size + offsets[None] # K' X P X 3
+            block_pts = fine_lin[fine_idx].reshape(-1, 3)
+            block_sdf[b_idx:b_idx+blocks_per_chunk] = self.query(block_pts).reshape(-1, block_size+1, \
+                                                block_size+1, block_size+1)
+
+        return coarse_sdf, block_idx, block_sdf
+
+
+def save_multi_res_sdf(dest_sdf_path, centroid, extents, coarse_sdf, block_idx, block_sdf):
+    # dest_sdf_path: .npz, all the arrays of a multi-resolution SDF in one file.
+    np.savez(dest_sdf_path, centroid=centroid, extents=extents, coarse_sdf=coarse_sdf, \
+        block_idx=block_idx, block_sdf=block_sdf)
+
+
+def generate_sdf(mesh, dest_json_path, dest_sdf_path, dest_voxel_mesh_path="", grid_dim=256, print_time=False, \
+    dest_multi_res_sdf_path="", use_sdf_builder=False, num_workers=-1):
+    # Dense grid_dim^3 SDF of an object mesh and the json with the normalization used to query it.
+    # use_sdf_builder: evaluate the dense grid with MeshSDFBuilder (surface samples and normal votes) instead of
+    # mesh_to_voxels' default scan-based method, the values are not identical to the existing grids.
+    # dest_multi_res_sdf_path: if set, also save a coarse grid with fine blocks near the surface (.npz).
+    # Save centroid and extents data used for transforming vertices to [-1,1] while query
+    # vertices = mesh.vertices - mesh.bounding_box.centroid
+    # vertices *= 2 / np.max(mesh.bounding_box.extents)
+    centroid = mesh.bounding_box.centroid
+    extents = mesh.bounding_box.extents
+    # Save centroid and extents as SDF
+    json_dict = {}
+    json_dict['centroid'] = centroid.tolist()
+    json_dict['extents'] = extents.tolist()
+    json_dict['grid_dim'] = grid_dim
+    json.dump(json_dict, open(dest_json_path, 'w'))
+    
+    if print_time:
+        start_time = time.time() 
+    
+    if use_sdf_builder or dest_multi_res_sdf_path != "":
+        sdf_builder = MeshSDFBuilder(mesh, num_workers=num_workers)
+
+    if use_sdf_builder:
+        sdf = sdf_builder.build_dense(grid_dim)
+    else:
+        from mesh_to_sdf import mesh_to_voxels
+        sdf = mesh_to_voxels(mesh, voxel_resolution=grid_dim)
+
+    if dest_multi_res_sdf_path != "":
+        # Fine blocks have about the same spacing as the dense grid.
+        coarse_sdf, block_idx, block_sdf = sdf_builder.build_multi_res(num_blocks=grid_dim//8, block_size=8)
+        save_multi_res_sdf(dest_multi_res_sdf_path, centroid, extents, coarse_sdf, block_idx, block_sdf)
+    
+    if dest_voxel_mesh_path != "":
+        import skimage.measure
+        vertices, faces, normals, _ = skimage.measure.marching_cubes(sdf, level=0)
+        voxel_mesh = trimesh.Trimesh(vertices=vertices, faces=faces, vertex_normals=normals)
+        voxel_mesh.export(open(dest_voxel_mesh_path, 'w'), file_type='obj')
+    
+    if print_time:
+        print("Generating SDF took {0} seconds".format(time.time()-start_time))
+    
+    np.save(dest_sdf_path, sdf)
+    
+    centroid = np.copy(centroid)
+    extents = np.copy(extents)
+    
+    return centroid, extents, sdf
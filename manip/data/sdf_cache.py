@@ -0,0 +1,45 @@
+from collections import OrderedDict
+
+import torch
+
+from manip.data.sdf_grid import SparseSDFGrid
+
+
+class SDFGridCache:
+    # LRU cache of SDF grids keyed by object or scene name. Grids are kept on the device they were loaded to,
+    # least recently used entries are dropped once the total size exceeds max_bytes.
+    def __init__(self, max_bytes=2*1024**3, use_half=False):
+        self.max_bytes = max_bytes
+        self.use_half = use_half
+
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+
+    def get_entry_bytes(self, entry):
+        return sum([v.nbytes if isinstance(v, SparseSDFGrid) else v.numel() * v.element_size() for v in entry])
+
+    def get(self, key, load_fn):
+        # load_fn: returns sdf, sdf_centroid, sdf_extents, only called on a cache miss.
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            sdf, sdf_centroid, sdf_extents = self.cache[key]
+        else:
+            sdf, sdf_centroid, sdf_extents = load_fn()
+            if self.use_half:
+                sdf = sdf.half()
+
+            entry_bytes = self.get_entry_bytes((sdf, sdf_centroid, sdf_extents))
+            if entry_bytes <= self.max_bytes:
+                while self.cache_bytes + entry_bytes > self.max_bytes:
+                    _, old_entry = self.cache.popitem(last=False)
+                    self.cache_bytes -= self.get_entry_bytes(old_entry)
+
+                self.cache[key] = (sdf, sdf_centroid, sdf_extents)
+                self.cache_bytes += entry_bytes
+
+        # Half precision grids are returned as they are, sample_sdf only converts the values it reads. 
+        return sdf, sdf_centroid, sdf_extents
+
+    def clear(self):
+        self.cache.clear()
+        self.cache_bytes = 0
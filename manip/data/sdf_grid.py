@@ -0,0 +1,180 @@
+import os
+
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+
+
+def trilinear_gather(values, base_idx, strides, frac):
+    # values: flattened grid, base_idx: N, index of the lower corner of each point's cell
+    # strides: flat index offsets of x, y, z, frac: N X 3, position inside the cell in [0, 1]
+    # Only the gathered corner values are converted to the dtype of frac, so reduced precision grids stay as they are.
+    out = 0.
+    for dx in range(2):
+        wx = frac[:, 0] if dx else 1 - frac[:, 0]
+        for dy in range(2):
+            wy = frac[:, 1] if dy else 1 - frac[:, 1]
+            for dz in range(2):
+                wz = frac[:, 2] if dz else 1 - frac[:, 2]
+                corner_idx = base_idx + dx * strides[0] + dy * strides[1] + dz * strides[2]
+                out = out + wx * wy * wz * values[corner_idx].to(frac.dtype)
+
+    return out
+
+
+class SparseSDFGrid:
+    # Narrow-band SDF: full resolution blocks only where the surface is close, a coarse grid at the block corners
+    # everywhere else. Same normalized frame and [x, y, z] layout as the dense grids, neighboring blocks share
+    # their border points so a query only reads one block.
+    def __init__(self, coarse_sdf, block_idx, block_sdf, trunc_dist=None, block_lut=None):
+        # coarse_sdf: (B+1) X (B+1) X (B+1), block_idx: K X 3, block_sdf: K X (S+1) X (S+1) X (S+1)
+        # trunc_dist: if set, coarse values are clamped to [-trunc_dist, trunc_dist].
+        self.num_blocks = coarse_sdf.shape[0] - 1
+        self.block_size = block_sdf.shape[1] - 1
+        self.fine_dim = self.num_blocks * self.block_size + 1
+        self.trunc_dist = trunc_dist
+
+        if trunc_dist is not None:
+            coarse_sdf = torch.clamp(coarse_sdf, -trunc_dist, trunc_dist)
+        self.coarse_sdf = coarse_sdf
+        self.block_idx = block_idx.long()
+        self.block_sdf = block_sdf
+
+        # Block id of each block position, -1 for the blocks that are not stored.
+        if block_lut is None:
+            block_lut = torch.full((self.num_blocks,)*3, -1, dtype=torch.long, device=block_sdf.device)
+            block_lut[self.block_idx[:, 0], self.block_idx[:, 1], self.block_idx[:, 2]] = \
+                torch.arange(self.block_idx.shape[0], device=block_sdf.device)
+        self.block_lut = block_lut
+
+    @classmethod
+    def from_dense(cls, sdf, band=0.05, block_size=None, trunc_dist=None):
+        # sdf: D X D X D, band: blocks with a value within band of the surface are kept, in the normalized frame.
+        # block_size has to divide D-1, by default the divisor closest to 8.
+        sdf = sdf.reshape(sdf.shape[-3:])
+        grid_dim = sdf.shape[0]
+        if block_size is None:
+            divisors = [d for d in range(1, grid_dim) if (grid_dim - 1) % d == 0]
+            block_size = min(divisors, key=lambda d: abs(d - 8))
+
+        coarse_sdf = sdf[::block_size, ::block_size, ::block_size].clone()
+
+        all_blocks = sdf.unfold(0, block_size+1, block_size).unfold(1, block_size+1, block_size).unfold(2, \
+                    block_size+1, block_size) # B X B X B X (S+1) X (S+1) X (S+1)
+        keep_mask = all_blocks.abs().amin(dim=(-3, -2, -1)) < band # B X B X B
+        block_idx = torch.nonzero(keep_mask) # K X 3
+        block_sdf = all_blocks[keep_mask].clone() # K X (S+1) X (S+1) X (S+1)
+
+        return cls(coarse_sdf, block_idx, block_sdf, trunc_dist=trunc_dist)
+
+    @classmethod
+    def load(cls, sdf_npz_path, device="cpu", trunc_dist=None):
+        # Same arrays as save_multi_res_sdf.
+        npz_data = np.load(sdf_npz_path)
+        coarse_sdf = torch.from_numpy(npz_data['coarse_sdf']).float().to(device)
+        block_idx = torch.from_numpy(npz_data['block_idx']).long().to(device)
+        block_sdf = torch.from_numpy(npz_data['block_sdf']).float().to(device)
+
+        return cls(coarse_sdf, block_idx, block_sdf, trunc_dist=trunc_dist)
+
+    @property
+    def nbytes(self):
+        return sum([v.numel() * v.element_size() for v in (self.coarse_sdf, self.block_idx, \
+                    self.block_sdf, self.block_lut)])
+
+    def half(self):
+        return SparseSDFGrid(self.coarse_sdf.half(), self.block_idx, self.block_sdf.half(), block_lut=self.block_lut)
+
+    def float(self):
+        return SparseSDFGrid(self.coarse_sdf.float(), self.block_idx, self.block_sdf.float(), block_lut=self.block_lut)
+
+    def query(self, query_pts_norm):
+        # query_pts_norm: N X 3 in [-1, 1], x, y, z order, points outside are clamped to the border.
+        # Returns N values in the normalized frame, differentiable wrt the points.
+        query_pts_norm = torch.clamp(query_pts_norm, -1, 1)
+        fine_pts = (query_pts_norm + 1) / 2. * (self.fine_dim - 1) # N X 3
+
+        bs = self.block_size
+        block_pos = torch.clamp(torch.floor(fine_pts.detach() / bs).long(), 0, self.num_blocks-1) # N X 3
+        block_id = self.block_lut[block_pos[:, 0], block_pos[:, 1], block_pos[:, 2]] # N
+        in_band = block_id >= 0
+
+        # Far from the surface, interpolate the coarse grid.
+        coarse_pts = fine_pts / bs
+        coarse_dim = self.num_blocks + 1
+        coarse_strides = (coarse_dim * coarse_dim, coarse_dim, 1)
+        coarse_base = (block_pos * torch.as_tensor(coarse_strides, device=block_pos.device)).sum(dim=1)
+        dists = trilinear_gather(self.coarse_sdf.reshape(-1), coarse_base, \
+                coarse_strides, coarse_pts - block_pos)
+
+        if in_band.any():
+            local_pts = fine_pts[in_band] - block_pos[in_band] * bs # N' X 3, in [0, S]
+            cell_pos = torch.clamp(torch.floor(local_pts.detach()).long(), 0, bs-1)
+            block_strides = ((bs + 1) ** 2, bs + 1, 1)
+            block_base = block_id[in_band] * (bs + 1) ** 3 + \
+                (cell_pos * torch.as_tensor(block_strides, device=cell_pos.device)).sum(dim=1)
+            fine_dists = trilinear_gather(self.block_sdf.reshape(-1), block_base, \
+                    block_strides, local_pts - cell_pos)
+
+            dists = dists.masked_scatter(in_band, fine_dists)
+
+        return dists
+
+
+def sample_dense_sdf_corners(dense_sdf, query_pts_norm):
+    # dense_sdf: D X H X W indexed by x, y, z, query_pts_norm: N X 3 in [-1, 1]
+    # Same values as grid_sample with align_corners and border padding, reads the 8 corners of each point only.
+    grid_dims = torch.as_tensor(dense_sdf.shape, device=query_pts_norm.device)
+    grid_pts = (torch.clamp(query_pts_norm, -1, 1) + 1) / 2. * (grid_dims - 1) # N X 3
+    cell_pos = torch.minimum(torch.floor(grid_pts.detach()).long(), grid_dims - 2)
+    strides = (dense_sdf.shape[1] * dense_sdf.shape[2], dense_sdf.shape[2], 1)
+    base_idx = (cell_pos * torch.as_tensor(strides, device=cell_pos.device)).sum(dim=1)
+
+    return trilinear_gather(dense_sdf.reshape(-1), base_idx, strides, grid_pts - cell_pos)
+
+def sample_sdf(sdf, query_pts_norm):
+    # sdf: dense grid 1 X D X H X W (or D X H X W), or a SparseSDFGrid
+    # query_pts_norm: ... X 3 in [-1, 1], x, y, z order. Returns ... values in the normalized frame.
+    # Single entry point for SDF lookups, out of range points use the border values.
+    ori_shape = query_pts_norm.shape[:-1]
+    query_pts_norm = query_pts_norm.reshape(-1, 3)
+
+    if isinstance(sdf, SparseSDFGrid):
+        signed_dists = sdf.query(query_pts_norm)
+    elif sdf.dtype != query_pts_norm.dtype:
+        # e.g. half precision grids of the SDF cache, avoid converting the whole grid on every call. 
+        signed_dists = sample_dense_sdf_corners(sdf.reshape(sdf.shape[-3:]), query_pts_norm)
+    else:
+        dense_sdf = sdf.reshape((1, 1) + sdf.shape[-3:]) # 1 X 1 X D X H X W
+        grid_pts = query_pts_norm[:, [2, 1, 0]] # Switch the order to depth, height, width
+        signed_dists = F.grid_sample(dense_sdf, grid_pts[None, None, None], \
+                    padding_mode='border', align_corners=True).reshape(-1) # N
+
+    return signed_dists.reshape(ori_shape)
+
+def query_signed_distances(sdf, sdf_centroid, sdf_extents, query_points):
+    # sdf_centroid: 1 X 3, sdf_extents: 1 X 3, query_points: ... X 3
+    # Returns ... signed distances in the same unit as the points.
+    half_size = sdf_extents.max() / 2.
+    query_pts_norm = (query_points - sdf_centroid.reshape(3)) / half_size # Convert to range [-1, 1]
+
+    return sample_sdf(sdf, query_pts_norm) * half_size
+
+def get_multi_res_sdf_path(sdf_npy_path):
+    # Multi-resolution SDF saved next to a dense grid, e.g. object.ply.npy -> object.ply_multi_res.npz
+    return os.path.splitext(sdf_npy_path)[0] + "_multi_res.npz"
+
+def load_sdf_grid(sdf_npy_path, device="cpu", use_sparse=False, band=0.05):
+    # Returns a dense 1 X D X H X W tensor, or a SparseSDFGrid if use_sparse.
+    # A multi-resolution file saved next to the dense grid (get_multi_res_sdf_path) is used if it exists,
+    # otherwise the dense grid is converted.
+    multi_res_path = get_multi_res_sdf_path(sdf_npy_path)
+    if use_sparse and os.path.exists(multi_res_path):
+        return SparseSDFGrid.load(multi_res_path, device=device)
+
+    sdf = torch.from_numpy(np.load(sdf_npy_path)).float()[None].to(device) # 1 X D X H X W
+    if use_sparse:
+        return SparseSDFGrid.from_dense(sdf, band=band)
+
+    return sdf
@@ -0,0 +1,46 @@
+import torch
+
+from manip.data.sdf_grid import sample_sdf
+
+
+class ObjectSurfaceQuery:
+    # Nearest-surface queries against an object's precomputed SDF grid (rest pose frame). The cost only depends on the
+    # number of query points, not on the mesh size, and distances are differentiable wrt the points and the object pose.
+    def __init__(self, sdf, sdf_centroid, sdf_extents):
+        # sdf: 1 X D X H X W or a SparseSDFGrid, sdf_centroid: 1 X 3, sdf_extents: 1 X 3, same format as load_object_sdf_data.
+        self.sdf = sdf
+        self.sdf_centroid = sdf_centroid # 1 X 3
+
+        # The grid is a cube around the centroid with the largest extent as side length.
+        self.half_size = sdf_extents.max() / 2.
+
+    def query_rest_frame(self, rest_points):
+        # rest_points: ... X 3, in the rest pose object frame.
+        # Returns ... signed distances, negative inside the object.
+        ori_shape = rest_points.shape[:-1]
+        rest_points = rest_points.reshape(-1, 3) # N X 3
+
+        # Points outside the grid are clamped to its border, the distance to the border is added back.
+        lower = self.sdf_centroid - self.half_size
+        upper = self.sdf_centroid + self.half_size
+        clamped_points = torch.maximum(torch.minimum(rest_points, upper), lower) # N X 3
+        outside_dists = torch.norm(rest_points - clamped_points, dim=-1) # N
+
+        query_pts_norm = (clamped_points - self.sdf_centroid) / self.half_size # Convert to range [-1, 1]
+        signed_dists = sample_sdf(self.sdf, query_pts_norm) * self.half_size # N
+
+        signed_dists = signed_dists + outside_dists
+
+        return signed_dists.reshape(ori_shape)
+
+    def query(self, points, obj_rot_mat, obj_com_pos):
+        # points: BS X T X K X 3
+        # obj_rot_mat: BS X T X 3 X 3, obj_com_pos: BS X T X 3, object verts = obj_rot_mat @ rest verts + obj_com_pos.
+        # Returns BS X T X K signed distances.
+        rest_points = torch.matmul(obj_rot_mat[:, :, None, :, :].transpose(-1, -2), \
+                    (points - obj_com_pos[:, :, None, :])[..., None]).squeeze(-1) # BS X T X K X 3
+
+        return self.query_rest_frame(rest_points)
+
+    def query_unsigned(self, points, obj_rot_mat, obj_com_pos):
+        return self.query(points, obj_rot_mat, obj_com_pos).abs() # BS X T X K
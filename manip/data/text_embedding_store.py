@@ -0,0 +1,86 @@
+import os
+import json
+
+import numpy as np
+
+import torch
+
+
+def normalize_text(text):
+    # CLIP's tokenizer lower-cases and collapses whitespace, texts that only differ in these share one embedding.
+    return " ".join(text.split()).lower()
+
+
+class TextEmbeddingStore:
+    # Disk-backed store of text embeddings for one text encoder. Embeddings are kept as a single tensor on the device
+    # and looked up by normalized text, the encoder only runs for texts that are not in the store yet.
+    def __init__(self, store_folder, model_key, device="cpu"):
+        self.store_folder = store_folder
+        if not os.path.exists(self.store_folder):
+            os.makedirs(self.store_folder)
+
+        self.device = device
+
+        model_name = model_key.replace("/", "-")
+        self.text_json_path = os.path.join(self.store_folder, model_name+"_texts.json")
+        self.embedding_npy_path = os.path.join(self.store_folder, model_name+"_embeddings.npy")
+
+        self.text_idx_dict = {}
+        self.embeddings = None
+        if os.path.exists(self.text_json_path) and os.path.exists(self.embedding_npy_path):
+            text_list = json.load(open(self.text_json_path, 'r'))
+            embeddings = np.load(self.embedding_npy_path)
+            if len(text_list) == embeddings.shape[0]:
+                self.text_idx_dict = {text: t_idx for t_idx, text in enumerate(text_list)}
+                self.embeddings = torch.from_numpy(embeddings).float().to(self.device) # N X D
+
+    def __len__(self):
+        return len(self.text_idx_dict)
+
+    def add(self, raw_text_list, encode_fn, batch_size=256):
+        # encode_fn: list of strings -> BS X D tensor
+        new_text_list = []
+        for text in raw_text_list:
+            text = normalize_text(text)
+            if text not in self.text_idx_dict and text not in new_text_list:
+                new_text_list.append(text)
+
+        if len(new_text_list) == 0:
+            return
+
+        new_embedding_list = []
+        for b_idx in range(0, len(new_text_list), batch_size):
+            with torch.no_grad():
+                new_embedding_list.append(encode_fn(new_text_list[b_idx:b_idx+batch_size]).float().to(self.device))
+        new_embeddings = torch.cat(new_embedding_list, dim=0) # N' X D
+
+        for text in new_text_list:
+            self.text_idx_dict[text] = len(self.text_idx_dict)
+
+        if self.embeddings is None:
+            self.embeddings = new_embeddings
+        else:
+            self.embeddings = torch.cat((self.embeddings, new_embeddings), dim=0)
+
+        self.save()
+
+    def save(self):
+        text_list = sorted(self.text_idx_dict.keys(), key=lambda text: self.text_idx_dict[text])
+
+        # Write the embeddings first, the json is only updated once they are complete.
+        tmp_npy_path = self.embedding_npy_path+".tmp.npy"
+        np.save(tmp_npy_path, self.embeddings.detach().cpu().numpy())
+        os.replace(tmp_npy_path, self.embedding_npy_path)
+
+        json.dump(text_list, open(self.text_json_path, 'w'))
+
+    def get(self, raw_text, encode_fn):
+        # raw_text: a string or a list of strings, returns BS X D
+        if isinstance(raw_text, str):
+            raw_text = [raw_text]
+
+        self.add(raw_text, encode_fn)
+
+        text_idx = [self.text_idx_dict[normalize_text(text)] for text in raw_text]
+
+        return self.embeddings[torch.tensor(text_idx, device=self.embeddings.device)] # BS X D
@@ -23,6 +23,7 @@ from human_body_prior.body_model.body_model import BodyModel
 from manip.lafan1.utils import rotate_at_frame_w_obj 
 
 from manip.data.cano_traj_dataset import get_smpl_parents, quat_fk_torch, quat_ik_torch, local2global_pose 
+from manip.data.bps_service import ObjectBPSService 
 
 
 class UnseenCanoObjectTrajDataset(Dataset):
@@ -36,10 +37,13 @@ class UnseenCanoObjectTrajDataset(Dataset):
         use_first_frame_bps=False, 
         use_random_frame_bps=False, 
         test_long_seq=False, 
+        device="cuda", 
     ):
         
         self.window = window 
 
+        self.device = device 
+
         self.use_object_splits = use_object_splits 
         self.train_objects = ["largetable", "woodchair", "plasticbox", "largebox", "smallbox", "trashcan", "monitor", \
                     "floorlamp", "clothesstand", "vacuum"] # 10 objects 
@@ -162,9 +166,9 @@ class UnseenCanoObjectTrajDataset(Dataset):
         for p in self.neutral_bm.parameters():
             p.requires_grad = False 
 
-        self.male_bm = self.male_bm.cuda()
-        self.female_bm = self.female_bm.cuda()
-        self.neutral_bm = self.neutral_bm.cuda() 
+        self.male_bm = self.male_bm.to(self.device)
+        self.female_bm = self.female_bm.to(self.device)
+        self.neutral_bm = self.neutral_bm.to(self.device) 
         
         self.bm_dict = {'male' : self.male_bm, 'female' : self.female_bm, 'neutral': self.neutral_bm}
 
@@ -185,8 +189,8 @@ class UnseenCanoObjectTrajDataset(Dataset):
         # obj_verts: T X Nv X 3, obj_trans: T X 3
         bps_object_geo = self.bps_torch.encode(x=obj_verts, \
                     feature_type=['deltas'], \
-                    custom_basis=self.obj_bps.repeat(obj_trans.shape[0], \
-                    1, 1)+obj_trans[:, None, :])['deltas'] # T X N X 3 
+                    custom_basis=self.obj_bps.to(obj_trans.device).repeat(obj_trans.shape[0], \
+                    1, 1)+obj_trans[:, None, :])['deltas'].to(obj_verts.device) # T X N X 3 
 
         return bps_object_geo
 
@@ -198,6 +202,8 @@ class UnseenCanoObjectTrajDataset(Dataset):
 
         self.bps_torch = bps_torch()
 
+        self.bps_service = ObjectBPSService(self)
+
         self.obj_bps = self.bps['obj'] 
 
     def generate_data_for_unseen_objects(self):
@@ -0,0 +1,145 @@
+import os
+import json
+
+import numpy as np
+
+
+def read_npy_header(npy_path):
+    with open(npy_path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+    return shape, dtype
+
+def get_file_signature(file_path):
+    # Size and modification time, a regenerated source file invalidates its entry.
+    file_stat = os.stat(file_path)
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
+
+class WindowStore:
+    # Packs the small per-item npy files (window BPS, rest pose BPS, contact labels) and the language annotations
+    # into a few memory-mapped shards with a json index, so that items are served by slicing instead of file opens.
+    def __init__(self, store_folder, max_shard_bytes=4*1024**3):
+        self.store_folder = store_folder
+        self.max_shard_bytes = max_shard_bytes
+
+        self.index_path = os.path.join(self.store_folder, "index.json")
+
+        self.index = None
+        if os.path.exists(self.index_path):
+            self.index = json.load(open(self.index_path, 'r'))
+
+        # Opened lazily so that each data loader worker maps the shards by itself.
+        self.shards = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = {}
+
+        return state
+
+    def contains(self, window_bps_npy_paths, rest_bps_npy_paths, contact_npy_paths, text_dict):
+        # True if every item is in the store and was packed from the current version of its source file.
+        if self.index is None:
+            return False
+
+        for group_name, npy_path_dict in zip(["window_bps", "rest_bps", "contact"], \
+            [window_bps_npy_paths, rest_bps_npy_paths, contact_npy_paths]):
+            group_index = self.index[group_name]
+            for k in npy_path_dict:
+                if k not in group_index or len(group_index[k]) < 4 or \
+                    group_index[k][3] != get_file_signature(npy_path_dict[k]):
+                    return False
+
+        for k in text_dict:
+            if self.index['text'].get(k) != text_dict[k]:
+                return False
+
+        return True
+
+    def pack_npy_files(self, group_name, npy_path_dict):
+        # npy_path_dict: key -> npy path, all arrays in one group share the same trailing shape and are concatenated along dim 0.
+        group_index = {}
+        if len(npy_path_dict) == 0:
+            return group_index
+
+        # Read headers only to plan the shards.
+        keys = sorted(npy_path_dict.keys())
+        headers = [read_npy_header(npy_path_dict[k]) for k in keys] # (shape, dtype)
+
+        trailing_shape = tuple(headers[0][0][1:])
+        dtype = headers[0][1]
+        row_bytes = int(np.prod(trailing_shape)) * dtype.itemsize
+
+        shard_plan = [[]]
+        shard_rows = 0
+        for k_idx in range(len(keys)):
+            num_rows = headers[k_idx][0][0]
+            if len(shard_plan[-1]) > 0 and (shard_rows + num_rows) * row_bytes > self.max_shard_bytes:
+                shard_plan.append([])
+                shard_rows = 0
+            shard_plan[-1].append(k_idx)
+            shard_rows += num_rows
+
+        for shard_idx, k_idx_list in enumerate(shard_plan):
+            shard_name = group_name+"_"+str(shard_idx)+".npy"
+            num_rows = sum([headers[k_idx][0][0] for k_idx in k_idx_list])
+            shard_data = np.lib.format.open_memmap(os.path.join(self.store_folder, shard_name), mode='w+', \
+                        dtype=dtype, shape=(num_rows,)+trailing_shape)
+
+            offset = 0
+            for k_idx in k_idx_list:
+                curr_data = np.load(npy_path_dict[keys[k_idx]])
+                shard_data[offset:offset+curr_data.shape[0]] = curr_data
+                group_index[keys[k_idx]] = [shard_name, offset, int(curr_data.shape[0]), \
+                                        get_file_signature(npy_path_dict[keys[k_idx]])]
+                offset += curr_data.shape[0]
+
+            shard_data.flush()
+            del shard_data
+
+        return group_index
+
+    def build(self, window_bps_npy_paths, rest_bps_npy_paths, contact_npy_paths, text_dict):
+        if not os.path.exists(self.store_folder):
+            os.makedirs(self.store_folder)
+
+        # Remove the old index first so that an interrupted build is not picked up.
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        self.index = None
+        self.shards = {}
+
+        index = {}
+        index['window_bps'] = self.pack_npy_files("window_bps", window_bps_npy_paths)
+        index['rest_bps'] = self.pack_npy_files("rest_bps", rest_bps_npy_paths)
+        index['contact'] = self.pack_npy_files("contact", contact_npy_paths)
+        index['text'] = text_dict
+
+        json.dump(index, open(self.index_path, 'w'))
+
+        self.index = index
+
+    def get_array(self, group_name, key):
+        shard_name, offset, num_rows = self.index[group_name][key][:3]
+        if shard_name not in self.shards:
+            self.shards[shard_name] = np.load(os.path.join(self.store_folder, shard_name), mmap_mode='r')
+
+        # Copy the slice out of the read-only mapping.
+        return np.array(self.shards[shard_name][offset:offset+num_rows])
+
+    def get_window_bps(self, key):
+        return self.get_array("window_bps", key) # T X N X 3
+
+    def get_rest_bps(self, object_name):
+        return self.get_array("rest_bps", object_name) # 1 X N X 3
+
+    def get_contact_labels(self, seq_name):
+        return self.get_array("contact", seq_name) # T X 4
+
+    def get_text(self, seq_name):
+        return self.index['text'][seq_name]
@@ -87,6 +87,28 @@ def quat_inv(q):
     return res
 
 
+PARENT_LEVELS_CACHE = {}
+
+def get_parent_levels(parents):
+    """
+    Groups joint indices by their depth in the kinematic tree, level 0 only contains the root joint
+
+    :param parents: list of parents indices, parents always precede their children
+    :return: list of joint index arrays, one per depth level
+    """
+    key = tuple(int(p) for p in parents)
+    if key in PARENT_LEVELS_CACHE:
+        return PARENT_LEVELS_CACHE[key]
+
+    depths = np.zeros(len(key), dtype=np.int64)
+    for i in range(1, len(key)):
+        depths[i] = depths[key[i]] + 1
+
+    levels = [np.nonzero(depths == d)[0] for d in range(depths.max() + 1)]
+    PARENT_LEVELS_CACHE[key] = levels
+
+    return levels
+
 def quat_fk(lrot, lpos, parents):
     """
     Performs Forward Kinematics (FK) on local quaternions and local positions to retrieve global representations
@@ -96,15 +118,21 @@ def quat_fk(lrot, lpos, parents):
     :param parents: list of parents indices
     :return: tuple of tensors of global quaternion, global positions
     """
-    gp, gr = [lpos[..., :1, :]], [lrot[..., :1, :]]
-    for i in range(1, len(parents)):
-        gp.append(
-            quat_mul_vec(gr[parents[i]], lpos[..., i : i + 1, :]) + gp[parents[i]]
-        )
-        if i < lrot.shape[-2]: # Used for joint 24 setting 
-            gr.append(quat_mul(gr[parents[i]], lrot[..., i : i + 1, :]))
+    # Joints of the same depth only depend on the previous level, process them together. 
+    parents = np.asarray(parents)
+    num_rot = lrot.shape[-2] # Used for joint 24 setting, the extra joints only have positions 
+    batch_shape = np.broadcast_shapes(lrot.shape[:-2], lpos.shape[:-2])
+
+    gr = np.array(np.broadcast_to(lrot, batch_shape + lrot.shape[-2:]), dtype=np.result_type(lrot, lpos))
+    gp = np.array(np.broadcast_to(lpos[..., :len(parents), :], batch_shape + (len(parents), lpos.shape[-1])), \
+        dtype=np.result_type(lrot, lpos))
+    for level in get_parent_levels(parents)[1:]:
+        gp[..., level, :] = quat_mul_vec(gr[..., parents[level], :], lpos[..., level, :]) + gp[..., parents[level], :]
 
-    res = np.concatenate(gr, axis=-2), np.concatenate(gp, axis=-2)
+        rot_level = level[level < num_rot]
+        gr[..., rot_level, :] = quat_mul(gr[..., parents[rot_level], :], lrot[..., rot_level, :])
+
+    res = gr, gp
     return res
 
 def quat_fk_torch(lrot, lpos, parents):
@@ -116,14 +144,26 @@ def quat_fk_torch(lrot, lpos, parents):
     :param parents: list of parents indices
     :return: tuple of tensors of global quaternion, global positions
     """
-    gp, gr = [lpos[..., :1, :]], [lrot[..., :1, :]]
-    for i in range(1, len(parents)):
-        gp.append(
-            transforms.quaternion_apply(gr[parents[i]], lpos[..., i : i + 1, :]) + gp[parents[i]]
-        )
-        gr.append(transforms.quaternion_multiply(gr[parents[i]], lrot[..., i : i + 1, :]))
-
-    res = torch.cat(gr, dim=-2), torch.cat(gp, dim=-2)
+    # Joints of the same depth only depend on the previous level, process them together. 
+    # index_copy is out-of-place so the result stays differentiable. 
+    parents = np.asarray(parents)
+    num_rot = lrot.shape[-2] # Used for joint 24 setting, the extra joints only have positions 
+    batch_shape = torch.broadcast_shapes(lrot.shape[:-2], lpos.shape[:-2])
+
+    gr = lrot.expand(batch_shape + lrot.shape[-2:])
+    gp = lpos[..., :len(parents), :].expand(batch_shape + (len(parents), lpos.shape[-1]))
+    for level in get_parent_levels(parents)[1:]:
+        level_idx = torch.from_numpy(level).to(lpos.device)
+        curr_gp = transforms.quaternion_apply(gr[..., parents[level], :], lpos[..., level, :]) + gp[..., parents[level], :]
+        gp = gp.index_copy(-2, level_idx, curr_gp)
+
+        rot_level = level[level < num_rot]
+        if len(rot_level) > 0:
+            rot_level_idx = torch.from_numpy(rot_level).to(lrot.device)
+            curr_gr = transforms.quaternion_multiply(gr[..., parents[rot_level], :], lrot[..., rot_level, :])
+            gr = gr.index_copy(-2, rot_level_idx, curr_gr)
+
+    res = gr, gp
     return res
 
 def quat_ik(grot, gpos, parents):
@@ -170,7 +210,7 @@ def quat_ik_torch(grot, gpos, parents):
         torch.cat(
             [
                 grot[..., :1, :],
-                transforms.quaternion_multiply(transforms.quaternion_invert(grot[..., parents[1:], :]), grot[..., 1:, :]),
+                transforms.quaternion_multiply(transforms.quaternion_invert(grot[..., parents[1:grot.shape[-2]], :]), grot[..., 1:, :]),
             ],
             dim=-2,
         ),
@@ -547,6 +587,198 @@ def rotate_root_at_frame_w_obj(X, Q, obj_x, obj_q, trans2joint_list, n_past=1, f
 
     return new_glob_X[:, :, 0, :], new_glob_Q[:, :, 0, :], new_obj_x, new_obj_q
 
+def normalize_torch(x, dim=-1, eps=1e-8):
+    """
+    Normalizes a torch tensor over some dimension
+
+    :param x: data tensor
+    :param dim: dimension along which to compute the norm
+    :param eps: epsilon to prevent numerical instabilities
+    :return: The normalized tensor
+    """
+    res = x / (torch.sqrt(torch.sum(x * x, dim=dim, keepdim=True)) + eps)
+    return res
+
+def quat_inv_torch(q):
+    """
+    Inverts a torch tensor of quaternions
+
+    :param q: quaternion tensor
+    :return: tensor of inverted quaternions
+    """
+    res = q.new_tensor([1, -1, -1, -1]) * q
+    return res
+
+def quat_mul_torch(x, y):
+    """
+    Performs quaternion multiplication on torch tensors of quaternions, same convention as quat_mul
+
+    :param x: tensor of quaternions of shape (..., Nb of joints, 4)
+    :param y: tensor of quaternions of shape (..., Nb of joints, 4)
+    :return: The resulting quaternions
+    """
+    x0, x1, x2, x3 = x[..., 0:1], x[..., 1:2], x[..., 2:3], x[..., 3:4]
+    y0, y1, y2, y3 = y[..., 0:1], y[..., 1:2], y[..., 2:3], y[..., 3:4]
+
+    res = torch.cat(
+        [
+            y0 * x0 - y1 * x1 - y2 * x2 - y3 * x3,
+            y0 * x1 + y1 * x0 - y2 * x3 + y3 * x2,
+            y0 * x2 + y1 * x3 + y2 * x0 - y3 * x1,
+            y0 * x3 - y1 * x2 + y2 * x1 + y3 * x0,
+        ],
+        dim=-1,
+    )
+
+    return res
+
+def quat_mul_vec_torch(q, x):
+    """
+    Performs multiplication of a torch tensor of 3D vectors by a tensor of quaternions (rotation).
+
+    :param q: tensor of quaternions of shape (..., Nb of joints, 4)
+    :param x: tensor of vectors of shape (..., Nb of joints, 3)
+    :return: the resulting tensor of rotated vectors
+    """
+    q_xyz = q[..., 1:].expand(torch.broadcast_shapes(q[..., 1:].shape, x.shape))
+    t = 2.0 * torch.cross(q_xyz, x.expand(q_xyz.shape), dim=-1)
+    res = x + q[..., 0:1] * t + torch.cross(q_xyz, t, dim=-1)
+
+    return res
+
+def quat_between_torch(x, y):
+    """
+    Quaternion rotations between two torch tensors of 3D vectors
+
+    :param x: tensor of 3D vectors
+    :param y: tensor of 3D vetcors
+    :return: tensor of quaternions
+    """
+    x = x.expand(torch.broadcast_shapes(x.shape, y.shape))
+    y = y.expand(x.shape)
+    res = torch.cat(
+        [
+            torch.sqrt(torch.sum(x * x, dim=-1) * torch.sum(y * y, dim=-1))[..., None]
+            + torch.sum(x * y, dim=-1)[..., None],
+            torch.cross(x, y, dim=-1),
+        ],
+        dim=-1,
+    )
+    return res
+
+def get_forward_yrot_torch(key_glob_Q, floor_z=False):
+    # key_glob_Q: BS X 1 X 1 X 4, returns the rotation around the up axis that aligns the forward direction with x axis. 
+    if floor_z:
+        # The floor is on z = xxx. Project the forward direction to xy plane. 
+        forward = key_glob_Q.new_tensor([1, 1, 0]) * quat_mul_vec_torch(key_glob_Q, key_glob_Q.new_tensor([1, 0, 0]))
+    else:
+        # The floor is on y = xxx. Project the forward direction to xz plane. 
+        forward = key_glob_Q.new_tensor([1, 0, 1]) * quat_mul_vec_torch(key_glob_Q, key_glob_Q.new_tensor([1, 0, 0]))
+    # In rest pose, x direction is the body left direction, root joint point to left hip joint.  
+
+    forward = normalize_torch(forward)
+    yrot = normalize_torch(quat_between_torch(key_glob_Q.new_tensor([1, 0, 0]), forward))
+
+    return yrot 
+
+def rotate_at_frame_w_obj_torch(X, Q, obj_x, obj_q, trans2joint_list, parents, n_past=1, floor_z=False, use_global_human=False):
+    """
+    Torch version of rotate_at_frame_w_obj, runs batched on the device of the inputs.
+
+    :param X: tensor of local positions of shape (Batchsize, Timesteps, Joints, 3)
+    :param Q: tensor of local quaternions (Batchsize, Timesteps, Joints, 4)
+    :obj_x: N X T X 3
+    :obj_q: N X T X 4
+    :trans2joint_list: N X 3 
+    :param parents: list of parents' indices
+    :param n_past: number of frames in the past context
+    :return: The rotated positions X and quaternions Q
+    """
+    if use_global_human:
+        global_q = Q 
+        global_x = X 
+    else:
+        global_q, global_x = quat_fk_torch(Q, X, parents)
+
+    yrot = get_forward_yrot_torch(global_q[:, n_past - 1 : n_past, 0:1, :], floor_z=floor_z) # (B, 1, 1, 4)
+    new_glob_Q = quat_mul_torch(quat_inv_torch(yrot), global_q)
+    new_glob_X = quat_mul_vec_torch(quat_inv_torch(yrot), global_x)
+
+    # Process object rotation and translation 
+    new_obj_q = quat_mul_torch(quat_inv_torch(yrot[:, 0, :, :]), obj_q)
+
+    if use_global_human:
+        new_obj_x = quat_mul_vec_torch(quat_inv_torch(yrot[:, 0, :, :]), obj_x) # N X T X 3
+    else:
+        # Apply corresponding rotation to the object translation 
+        obj_trans = obj_x + trans2joint_list[:, None, :] # N X T X 3  
+        obj_trans = quat_mul_vec_torch(quat_inv_torch(yrot[:, 0, :, :]), obj_trans) # N X T X 3
+        new_obj_x = obj_trans - trans2joint_list[:, None, :] # N X T X 3 
+
+    if use_global_human:
+        Q = new_glob_Q
+        X = new_glob_X 
+    else:
+        # back to local quat-pos
+        Q, X = quat_ik_torch(new_glob_Q, new_glob_X, parents)
+
+    return X, Q, new_obj_x, new_obj_q
+
+def rotate_at_frame_w_obj_global_torch(obj_x, obj_q, parents, n_past=1, floor_z=False, global_q=None, global_x=None, use_global=False):
+    """
+    Torch version of rotate_at_frame_w_obj_global, runs batched on the device of the inputs.
+
+    :obj_x: N X T X 3
+    :obj_q: N X T X 4
+    :param parents: list of parents' indices
+    :param n_past: number of frames in the past context
+    :param global_q: tensor of global quaternions (Batchsize, Timesteps, Joints, 4)
+    :param global_x: tensor of global positions (Batchsize, Timesteps, Joints, 3)
+    :return: The rotated positions X and quaternions Q
+    """
+    yrot = get_forward_yrot_torch(global_q[:, n_past - 1 : n_past, 0:1, :], floor_z=floor_z) # (B, 1, 1, 4)
+    new_glob_Q = quat_mul_torch(quat_inv_torch(yrot), global_q)
+    new_glob_X = quat_mul_vec_torch(quat_inv_torch(yrot), global_x)
+
+    # Process object rotation and translation 
+    new_obj_q = quat_mul_torch(quat_inv_torch(yrot[:, 0, :, :]), obj_q)
+    new_obj_x = quat_mul_vec_torch(quat_inv_torch(yrot[:, 0, :, :]), obj_x) # N X T X 3
+
+    if use_global:
+        return new_glob_X, new_glob_Q, new_obj_x, new_obj_q 
+    else:
+        # back to local quat-pos
+        Q, X = quat_ik_torch(new_glob_Q, new_glob_X, parents)
+
+        return X, Q, new_obj_x, new_obj_q
+
+def rotate_root_at_frame_w_obj_torch(X, Q, obj_x, obj_q, trans2joint_list, n_past=1, floor_z=False):
+    """
+    Torch version of rotate_root_at_frame_w_obj, runs batched on the device of the inputs.
+
+    :param X: tensor of root positions of shape (Batchsize, Timesteps, 3)
+    :param Q: tensor of root quaternions (Batchsize, Timesteps, 4)
+    :obj_x: N X T X 3
+    :obj_q: N X T X 4
+    :trans2joint_list: N X 3 
+    :param n_past: number of frames in the past context
+    :return: The rotated positions X and quaternions Q
+    """
+    yrot = get_forward_yrot_torch(Q[:, n_past-1:n_past, None, :], floor_z=floor_z) # BS X 1 X 1 X 4 
+   
+    new_glob_Q = quat_mul_torch(quat_inv_torch(yrot), Q[:, :, None, :]) # BS X T X 1 X 4
+    new_glob_X = quat_mul_vec_torch(quat_inv_torch(yrot), X[:, :, None, :]) # BS X T X 1 X 3 
+
+    # Process object rotation and translation 
+    new_obj_q = quat_mul_torch(quat_inv_torch(yrot[:, 0, :, :]), obj_q) 
+
+    # Apply corresponding rotation to the object translation 
+    obj_trans = obj_x + trans2joint_list[:, None, :] # N X T X 3  
+    obj_trans = quat_mul_vec_torch(quat_inv_torch(yrot[:, 0, :, :]), obj_trans) # N X T X 3
+    new_obj_x = obj_trans - trans2joint_list[:, None, :] # N X T X 3 
+
+    return new_glob_X[:, :, 0, :], new_glob_Q[:, :, 0, :], new_obj_x, new_obj_q
+
 def extract_feet_contacts(pos, lfoot_idx, rfoot_idx, velfactor=0.02):
     """
     Extracts binary tensors of feet contacts
@@ -58,8 +58,9 @@ class MultiHeadAttention(nn.Module):
         
         self.dropout = nn.Dropout(0.1)
         
-    def forward(self, q, k, v, mask=None):
+    def forward(self, q, k, v, mask=None, return_attn=False):
         # q: BS X T X D, k: BS X T X D, v: BS X T X D, mask: BS X T X T 
+        # return_attn: materialize and return the attention maps, otherwise use the fused kernel and return None. 
         bs, n_q, _ = q.shape
         bs, n_k, _ = k.shape
         bs, n_v, _ = v.shape
@@ -68,6 +69,25 @@ class MultiHeadAttention(nn.Module):
 
         residual = q
 
+        if not return_attn and hasattr(F, "scaled_dot_product_attention"):
+            q = self.w_q(q).view(bs, n_q, self.n_head, self.d_k).transpose(1, 2) # BS X n_head X n_q X d_k
+            k = self.w_k(k).view(bs, n_k, self.n_head, self.d_k).transpose(1, 2) # BS X n_head X n_k X d_k
+            v = self.w_v(v).view(bs, n_v, self.n_head, self.d_v).transpose(1, 2) # BS X n_head X n_v X d_v
+
+            if mask is not None:
+                attn_mask = ~mask[:, None, :, :] # BS X 1 X n_q X n_k, True for positions that can be attended 
+            else:
+                attn_mask = None 
+
+            output = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, \
+                    dropout_p=self.attn_dropout.p if self.training else 0.) # BS X n_head X n_q X d_v
+            output = output.transpose(1, 2).contiguous().view(bs, n_q, -1) # BS X n_q X (n_head*D)
+
+            output = self.dropout(self.fc(output)) # BS X n_q X D
+            output = self.layer_norm(output + residual) # BS X n_q X D
+
+            return output, None 
+
         q = self.w_q(q).view(bs, n_q, self.n_head, self.d_k).permute(2, 0, 1, 3).contiguous().view(-1, n_q, self.d_k)
         k = self.w_k(k).view(bs, n_k, self.n_head, self.d_k).permute(2, 0, 1, 3).contiguous().view(-1, n_k, self.d_k)
         v = self.w_v(v).view(bs, n_v, self.n_head, self.d_v).permute(2, 0, 1, 3).contiguous().view(-1, n_v, self.d_v)
@@ -123,14 +143,14 @@ class DecoderLayer(nn.Module):
         self.self_attn = MultiHeadAttention(n_head, d_model, d_k, d_v)
         self.pos_ffn = PositionwiseFeedForward(d_model, d_model)
 
-    def forward(self, decoder_input, self_attn_time_mask, self_attn_padding_mask):
+    def forward(self, decoder_input, self_attn_time_mask, self_attn_padding_mask, return_attn=False):
         # decode_input: BS X T X D
         # time_mask: BS X T X T (padding postion are ones)
         # padding_mask: BS X T (padding position are zeros, diff usage from above)
         bs, dec_len, dec_hidden = decoder_input.shape
         
         decoder_out, dec_self_attn = self.self_attn(decoder_input, decoder_input, decoder_input, \
-                                mask=self_attn_time_mask)
+                                mask=self_attn_time_mask, return_attn=return_attn)
         # BS X T X D, BS X T X T
         decoder_out *= self_attn_padding_mask.unsqueeze(-1).float()
         # BS X T X D
@@ -158,11 +178,12 @@ class Decoder(nn.Module):
 
         self.use_full_attention = use_full_attention 
 
-    def forward(self, decoder_input, padding_mask, decoder_pos_vec, obj_embedding=None):
+    def forward(self, decoder_input, padding_mask, decoder_pos_vec, obj_embedding=None, return_attn=False):
         # decoder_input: BS X D X T 
         # padding_mask: BS X 1 X T
         # decoder_pos_vec: BS X 1 X T
         # obj_embedding: BS X 1 X D
+        # return_attn: collect attention maps of all the layers, dec_self_attn_list is empty otherwise. 
 
         dec_self_attn_list = []
 
@@ -191,9 +212,11 @@ class Decoder(nn.Module):
             dec_output, dec_self_attn = dec_layer(
                 dec_output, # BS X T X D
                 self_attn_time_mask=time_mask, # BS X T X T
-                self_attn_padding_mask=padding_mask) # BS X T
+                self_attn_padding_mask=padding_mask, # BS X T
+                return_attn=return_attn) 
 
-            dec_self_attn_list += [dec_self_attn]
+            if return_attn:
+                dec_self_attn_list += [dec_self_attn]
 
         return dec_output, dec_self_attn_list
         # BS X T X D, list
@@ -1,5 +1,6 @@
 import math 
 import numpy as np
+from functools import partial 
 
 import os 
 import matplotlib.pyplot as plt
@@ -20,6 +21,7 @@ from manip.data.cano_traj_dataset import quat_fk_torch, quat_ik_torch
 
 from manip.model.transformer_module import Decoder 
 from manip.lafan1.utils import rotate_at_frame_w_obj_global, rotate_at_frame_w_obj, quat_slerp 
+from manip.lafan1.utils import rotate_at_frame_w_obj_global_torch, rotate_at_frame_w_obj_torch 
 
 import time as PyTime 
 
@@ -270,6 +272,8 @@ class ObjectCondGaussianDiffusion(nn.Module):
         p2_loss_weight_k = 1,
         input_first_human_pose=False, 
         use_object_keypoints=False, 
+        sampler='ddpm', 
+        sampling_steps=20, 
     ):
         super().__init__()
 
@@ -354,6 +358,23 @@ class ObjectCondGaussianDiffusion(nn.Module):
 
         register_buffer('p2_loss_weight', (p2_loss_weight_k + alphas_cumprod / (1 - alphas_cumprod)) ** -p2_loss_weight_gamma)
 
+        # Sampler registry used by sample() when no guidance is applied. Guidance is only implemented 
+        # for ancestral sampling, sample() raises an error for guidance with other samplers. 
+        # 'ddpm': ancestral sampling over all the timesteps. 
+        # 'ddim': deterministic DDIM, same as first order DPM-Solver++. 
+        # 'dpm_solver++': second order multistep DPM-Solver++ (2M). 
+        self.sampler = sampler 
+        self.sampling_steps = sampling_steps 
+        self.samplers = {}
+        self.register_sampler('ddpm', self.p_sample_loop)
+        self.register_sampler('ddim', partial(self.dpm_solver_pp_sample_loop, order=1))
+        self.register_sampler('dpm_solver++', partial(self.dpm_solver_pp_sample_loop, order=2))
+
+    def register_sampler(self, name, sample_loop_fn):
+        # sample_loop_fn(shape, x_cond, language_embedding=None, padding_mask=None, cond_mask=None, \
+        # ori_pose_cond=None, return_diff_level_res=False) -> BS X T X D 
+        self.samplers[name] = sample_loop_fn 
+
     def predict_start_from_noise(self, x_t, t, noise):
         return (
             extract(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t -
@@ -555,6 +576,70 @@ class ObjectCondGaussianDiffusion(nn.Module):
             padding_mask=padding_mask)    
 
         return x # BS X T X D
+
+    def model_predict_start(self, x, t, x_cond, language_embedding=None, padding_mask=None, clip_denoised=True):
+        model_output = self.denoise_fn(x, t, x_cond, language_embedding, padding_mask)
+
+        if self.objective == 'pred_noise':
+            x_start = self.predict_start_from_noise(x, t = t, noise = model_output)
+        elif self.objective == 'pred_x0':
+            x_start = model_output
+        else:
+            raise ValueError(f'unknown objective {self.objective}')
+
+        if clip_denoised:
+            x_start.clamp_(-1., 1.)
+
+        return x_start 
+
+    @torch.no_grad()
+    def dpm_solver_pp_sample_loop(self, shape, x_cond, language_embedding=None, padding_mask=None, \
+                cond_mask=None, ori_pose_cond=None, return_diff_level_res=False, sampling_steps=None, order=2):
+        # Multistep DPM-Solver++ (https://arxiv.org/abs/2211.01095) in data prediction form, 
+        # using the discrete alphas_cumprod of the training schedule. 
+        # Conditions are passed through x_cond in the same way as p_sample_loop. 
+        device = self.betas.device
+
+        b = shape[0]
+        x = torch.randn(shape, device=device)
+
+        # One model evaluation per step, the last one at t = 0 gives the returned x_start prediction. 
+        num_steps = default(sampling_steps, self.sampling_steps)
+        num_steps = max(min(num_steps, self.num_timesteps), 2)
+        times = torch.linspace(self.num_timesteps - 1, 0, num_steps, device=device).round().long() # [T-1, ..., 0]
+
+        # Use double precision for the log-SNR, alphas_cumprod is close to 1 near t = 0. 
+        alphas = self.sqrt_alphas_cumprod.double()[times] # K 
+        sigmas = self.sqrt_one_minus_alphas_cumprod.double()[times] # K 
+        lambdas = torch.log(alphas) - torch.log(sigmas) # K 
+
+        prev_x_start = None 
+        for i in tqdm(range(num_steps), desc='sampling loop time step', total=num_steps):
+            time_cond = torch.full((b,), int(times[i]), device=device, dtype=torch.long)
+            x_start = self.model_predict_start(x, time_cond, x_cond, language_embedding=language_embedding, \
+                        padding_mask=padding_mask)
+
+            if i == num_steps - 1:
+                x = x_start 
+                break 
+
+            h = lambdas[i+1] - lambdas[i]
+
+            # Fall back to first order at the first step and, for few steps, at the last step for stability. 
+            use_first_order = order == 1 or prev_x_start is None or \
+                (i == num_steps - 2 and num_steps < 15)
+            if use_first_order:
+                d = x_start 
+            else:
+                r = (lambdas[i] - lambdas[i-1]) / h 
+                d = (1. + 1. / (2. * r)) * x_start - (1. / (2. * r)) * prev_x_start 
+                d = d.float() 
+
+            x = (sigmas[i+1] / sigmas[i]).float() * x - (alphas[i+1] * torch.expm1(-h)).float() * d 
+
+            prev_x_start = x_start 
+
+        return x # BS X T X D
     
     # @torch.no_grad()
     def p_sample_loop_sliding_window_w_canonical(self, ds, object_names, trans2joint, \
@@ -666,24 +751,21 @@ class ObjectCondGaussianDiffusion(nn.Module):
                 obj_q = transforms.matrix_to_quaternion(obj_rot_mat) # BS X 10 X 4 
                 # The object rotation here is not wrt rest pose geometry, but the first frame's object rotation. 
 
+                # Canonicalization stays on the sampling device, no round trip through numpy between windows. 
                 # This code is used for inputting first human pose. 
                 if self.input_first_human_pose:
                     new_glob_jpos, new_glob_q, new_obj_com_pos, new_obj_q = \
-                    rotate_at_frame_w_obj(global_human_jpos.data.cpu().numpy(), global_human_q.data.cpu().numpy(), \
-                    obj_com_pos.data.cpu().numpy(), obj_q.data.cpu().numpy(), \
-                    trans2joint.data.cpu().numpy(), ds.parents, n_past=1, floor_z=True, use_global_human=True)
+                    rotate_at_frame_w_obj_torch(global_human_jpos.data, global_human_q.data, \
+                    obj_com_pos.data, obj_q.data, \
+                    trans2joint.data.float().to(prev_sample_res.device), ds.parents, n_past=1, floor_z=True, use_global_human=True)
                     # 1 X T X J X 3, 1 X T X J X 4, 1 X T X 3, 1 X T X 4 
                 else:
                     # This code is used for not inputting first human pose. 
-                    new_glob_jpos, new_glob_q, new_obj_com_pos, new_obj_q = rotate_at_frame_w_obj_global( \
-                    obj_com_pos.data.cpu().numpy(), obj_q.data.cpu().numpy(), ds.parents, n_past=1, floor_z=True, \
-                    global_q=global_human_q.data.cpu().numpy(), global_x=global_human_jpos.data.cpu().numpy(), use_global=True) 
+                    new_glob_jpos, new_glob_q, new_obj_com_pos, new_obj_q = rotate_at_frame_w_obj_global_torch( \
+                    obj_com_pos.data, obj_q.data, ds.parents, n_past=1, floor_z=True, \
+                    global_q=global_human_q.data, global_x=global_human_jpos.data, use_global=True) 
                     # BS X T X J X 3, BS X T X J X 4, BS X T X 3, BS X T X 4 
-
-                new_glob_jpos = torch.from_numpy(new_glob_jpos).float().to(prev_sample_res.device)
-                new_glob_q = torch.from_numpy(new_glob_q).float().to(prev_sample_res.device) 
-                new_obj_com_pos = torch.from_numpy(new_obj_com_pos).float().to(prev_sample_res.device)
-                new_obj_q = torch.from_numpy(new_obj_q).float().to(prev_sample_res.device) # wrd rest pose's rotation. 
+                # new_obj_q is wrd rest pose's rotation. 
 
                 global_human_root_jpos = new_glob_jpos[:, :, 0, :].clone() # BS X T X 3
                 global_human_root_trans = global_human_root_jpos + trans2joint[:, None, :].to(global_human_root_jpos.device) # BS X T X 3 
@@ -730,32 +812,12 @@ class ObjectCondGaussianDiffusion(nn.Module):
                 # gt_obj_com_pos = ds.de_normalize_obj_pos_min_max(gt_obj_normalized_com_pos)
                 # gt_obj_x = ds.com_to_obj_trans(gt_obj_com_pos, first_frame_obj_com2trans) # BS X 1 X 3 
 
-                curr_obj_bps_list = []
-                new_obj_com_pos_list = []
-                for bs_idx in range(b):
-                    # Compute the first frame's objec BPS representation in the current window. 
-                    # obj_verts, tmp_obj_faces = ds.load_object_geometry(object_names[bs_idx], obj_scales[bs_idx, t_idx:t_idx+1], \
-                    #             new_obj_x[bs_idx], new_obj_rot_mat[bs_idx]) # 10 X Nv X 3, tensor
-                    # obj_verts, tmp_obj_faces = ds.load_object_geometry(object_names[bs_idx], obj_scales[bs_idx, 0:1], \
-                    #             new_obj_x[bs_idx], new_obj_rot_mat[bs_idx]) # 10 X Nv X 3, tensor
-                    # obj_rest_verts, obj_mesh_faces = ds.convert_rest_pose_obj_geometry(object_names[bs_idx], \
-                    #     obj_scales[bs_idx, 0:1].cuda(), \
-                    #     gt_obj_x[bs_idx].cuda(), obj_rot_mat[bs_idx, 0:1].cuda())
-
-                    obj_rest_verts, obj_mesh_faces = ds.load_rest_pose_object_geometry(object_names[bs_idx])
-                    obj_rest_verts = torch.from_numpy(obj_rest_verts).to(new_obj_rot_mat.device)
-                    obj_verts = ds.load_object_geometry_w_rest_geo(new_obj_rot_mat[bs_idx], \
-                        new_obj_com_pos[bs_idx], obj_rest_verts.float())
-                
-                    center_verts = obj_verts.mean(dim=1) # 10 X 3 
-
-                    object_bps = ds.compute_object_geo_bps(obj_verts[0:1].cpu(), center_verts[0:1].cpu()) # 1 X 1024 X 3 
-
-                    curr_obj_bps_list.append(object_bps) 
-                    new_obj_com_pos_list.append(center_verts) 
+                # Compute the first frame's object BPS representation in the current window for all batch items together. 
+                curr_obj_bps, curr_obj_com_pos = ds.bps_service.compute_window_bps(object_names, \
+                    new_obj_rot_mat, new_obj_com_pos) # BS X 1024 X 3, BS X 10 X 3 
 
-                curr_obj_bps = torch.stack(curr_obj_bps_list)[:, None, :, :].cuda() # BS X 1 X 1024 X 3 
-                curr_obj_com_pos = torch.stack(new_obj_com_pos_list).cuda() # BS X 10 X 3 
+                curr_obj_bps = curr_obj_bps[:, None, :, :].to(device) # BS X 1 X 1024 X 3 
+                curr_obj_com_pos = curr_obj_com_pos.to(device) # BS X 10 X 3 
 
                 # curr_x_cond = torch.cat((curr_obj_com_pos[:, 0:1, :], \
                 #             self.bps_encoder(curr_obj_bps.reshape(b, 1, -1))), dim=-1) # BS X 1 X (3+256) 
@@ -968,6 +1030,9 @@ class ObjectCondGaussianDiffusion(nn.Module):
             language_embedding = None 
         
         if guidance_fn is not None:
+            if self.sampler != 'ddpm':
+                raise ValueError(f'guidance is only supported with the ddpm sampler, got {self.sampler}')
+
             sample_res = self.p_sample_loop_guided(x_start.shape, \
                     x_cond, guidance_fn, opt_fn=opt_fn, \
                     language_embedding=language_embedding, rest_human_offsets=rest_human_offsets, \
@@ -975,7 +1040,10 @@ class ObjectCondGaussianDiffusion(nn.Module):
                     cond_mask=cond_mask, padding_mask=padding_mask)
             # BS X T X D
         else:
-            sample_res = self.p_sample_loop(x_start.shape, x_cond, \
+            if self.sampler not in self.samplers:
+                raise ValueError(f'unknown sampler {self.sampler}')
+
+            sample_res = self.samplers[self.sampler](x_start.shape, x_cond, \
                     language_embedding=language_embedding, padding_mask=padding_mask, \
                     cond_mask=cond_mask, ori_pose_cond=x_start, return_diff_level_res=return_diff_level_res)
             # BS X T X D
@@ -1265,7 +1333,7 @@ class ObjectCondGaussianDiffusion(nn.Module):
             # static_idx = model_contact > 0.95  # BS x T x 4
 
             # FK to get joint positions. rest_human_offsets: BS X 24 X 3 
-            curr_seq_local_jpos = rest_human_offsets[:, None].repeat(1, num_steps, 1, 1).cuda() # BS X T X 24 X 3  
+            curr_seq_local_jpos = rest_human_offsets[:, None].repeat(1, num_steps, 1, 1).to(model_out.device) # BS X T X 24 X 3  
             curr_seq_local_jpos = curr_seq_local_jpos.reshape(bs*num_steps, 24, 3) # (BS*T) X 24 X 3 
             curr_seq_local_jpos[:, 0, :] = global_jpos.reshape(bs*num_steps, 24, 3)[:, 0, :] # (BS*T) X 3 
             
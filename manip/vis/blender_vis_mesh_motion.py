@@ -1,10 +1,11 @@
 import os 
 import subprocess 
-import trimesh 
 import imageio 
 import numpy as np 
 import shutil 
 
+from manip.vis.mesh_writer import write_ply, write_mesh_sequence_w_object 
+
 BLENDER_PATH = "blender-3.6.3-linux-x64/blender" # Put your blender path here 
 BLENDER_UTILS_ROOT_FOLDER = "chois_release/manip/vis" # Put the manip/vis folder absolute path here 
 BLENDER_SCENE_FOLDER = "./processed_data/blender_files" # Put the blender_files folder (where your store .blend files) absolute path here
@@ -127,28 +128,13 @@ def save_verts_faces_to_mesh_file(mesh_verts, mesh_faces, save_mesh_folder, save
 
     num_meshes = mesh_verts.shape[0]
     for idx in range(num_meshes):
-        mesh = trimesh.Trimesh(vertices=mesh_verts[idx],
-                        faces=mesh_faces)
         if save_gt:
             curr_mesh_path = os.path.join(save_mesh_folder, "%05d"%(idx)+"_gt.ply")
         else:
             curr_mesh_path = os.path.join(save_mesh_folder, "%05d"%(idx)+".ply")
-        mesh.export(curr_mesh_path)
+        write_ply(mesh_verts[idx], mesh_faces, curr_mesh_path)
 
 def save_verts_faces_to_mesh_file_w_object(mesh_verts, mesh_faces, obj_verts, obj_faces, save_mesh_folder):
     # mesh_verts: T X Nv X 3 
     # mesh_faces: Nf X 3 
-    if not os.path.exists(save_mesh_folder):
-        os.makedirs(save_mesh_folder)
-
-    num_meshes = mesh_verts.shape[0]
-    for idx in range(num_meshes):
-        mesh = trimesh.Trimesh(vertices=mesh_verts[idx],
-                        faces=mesh_faces)
-        curr_mesh_path = os.path.join(save_mesh_folder, "%05d"%(idx)+".ply")
-        mesh.export(curr_mesh_path)
-
-        obj_mesh = trimesh.Trimesh(vertices=obj_verts[idx],
-                        faces=obj_faces)
-        curr_obj_mesh_path = os.path.join(save_mesh_folder, "%05d"%(idx)+"_object.ply")
-        obj_mesh.export(curr_obj_mesh_path)
+    write_mesh_sequence_w_object(mesh_verts, mesh_faces, obj_verts, obj_faces, save_mesh_folder)
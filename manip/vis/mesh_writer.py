@@ -0,0 +1,103 @@
+import os
+import queue
+import threading
+
+import numpy as np
+
+
+def write_ply(verts, faces, mesh_path):
+    # verts: Nv X 3, faces: Nf X 3 or None for a point cloud
+    # Writes a binary little endian PLY, same layout as trimesh's default export.
+    verts = np.ascontiguousarray(verts, dtype='<f4')
+
+    header = "ply\nformat binary_little_endian 1.0\n"
+    header += "element vertex {0}\nproperty float x\nproperty float y\nproperty float z\n".format(verts.shape[0])
+    if faces is not None:
+        header += "element face {0}\nproperty list uchar int vertex_indices\n".format(faces.shape[0])
+    header += "end_header\n"
+
+    with open(mesh_path, 'wb') as ply_file:
+        ply_file.write(header.encode('ascii'))
+        ply_file.write(verts.tobytes())
+
+        if faces is not None:
+            # Each face is stored as its vertex count followed by the indices.
+            face_data = np.empty(faces.shape[0], dtype=[('count', 'u1'), ('vertex_indices', '<i4', (3,))])
+            face_data['count'] = 3
+            face_data['vertex_indices'] = faces
+            ply_file.write(face_data.tobytes())
+
+def write_obj(verts, faces, mesh_path):
+    # verts: Nv X 3, faces: Nf X 3, OBJ is a text format, format all the lines with a single call.
+    verts = np.asarray(verts, dtype=np.float64)
+    with open(mesh_path, 'w') as obj_file:
+        obj_file.write(("v %.6f %.6f %.6f\n" * verts.shape[0]) % tuple(verts.reshape(-1)))
+        if faces is not None:
+            faces = np.asarray(faces, dtype=np.int64) + 1 # OBJ indices start from 1
+            obj_file.write(("f %d %d %d\n" * faces.shape[0]) % tuple(faces.reshape(-1)))
+
+def write_mesh_sequence_w_object(mesh_verts, mesh_faces, obj_verts, obj_faces, save_mesh_folder):
+    # mesh_verts: T X Nv X 3
+    # mesh_faces: Nf X 3
+    # Same file names as save_verts_faces_to_mesh_file_w_object.
+    if not os.path.exists(save_mesh_folder):
+        os.makedirs(save_mesh_folder)
+
+    num_meshes = mesh_verts.shape[0]
+    for idx in range(num_meshes):
+        write_ply(mesh_verts[idx], mesh_faces, os.path.join(save_mesh_folder, "%05d"%(idx)+".ply"))
+        write_ply(obj_verts[idx], obj_faces, os.path.join(save_mesh_folder, "%05d"%(idx)+"_object.ply"))
+
+
+class AsyncMeshWriter:
+    # Writes mesh files from a background thread so that sampling does not wait for the disk.
+    # Queued arrays are limited to max_pending_bytes, submit blocks once the limit is reached.
+    def __init__(self, max_pending_bytes=1024**3):
+        self.max_pending_bytes = max_pending_bytes
+        self.pending_bytes = 0
+        self.pending_cond = threading.Condition()
+
+        self.job_queue = queue.Queue()
+        self.error = None
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def run(self):
+        while True:
+            write_fn, args, job_bytes = self.job_queue.get()
+            try:
+                write_fn(*args)
+            except Exception as e:
+                self.error = e
+
+            with self.pending_cond:
+                self.pending_bytes -= job_bytes
+                self.pending_cond.notify_all()
+            self.job_queue.task_done()
+
+    def submit(self, write_fn, *args):
+        # args: numpy arrays are copied, the caller can reuse its buffers right away.
+        self.check_error()
+
+        args = [arg.copy() if isinstance(arg, np.ndarray) else arg for arg in args]
+        job_bytes = sum([arg.nbytes for arg in args if isinstance(arg, np.ndarray)])
+
+        with self.pending_cond:
+            # A job larger than the limit still runs, once the queue is empty.
+            while self.pending_bytes > 0 and self.pending_bytes + job_bytes > self.max_pending_bytes:
+                self.pending_cond.wait()
+            self.pending_bytes += job_bytes
+
+        self.job_queue.put((write_fn, args, job_bytes))
+
+    def flush(self):
+        # Wait until all the submitted files are on disk, e.g. before rendering them.
+        self.job_queue.join()
+        self.check_error()
+
+    def check_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
@@ -0,0 +1,123 @@
+import os
+
+import cv2
+import imageio
+import numpy as np
+
+
+class PreviewRenderer:
+    # CPU-only preview of human-object motion. Triangles are flat shaded and drawn back to front (painter's algorithm)
+    # from a fixed camera, frames are streamed to the video encoder without writing meshes or images to disk.
+    def __init__(self, img_width=640, img_height=480, fov=50., \
+        human_color=(70, 130, 230), obj_color=(230, 150, 60), floor_color=(200, 200, 200), \
+        condition_color=(22, 173, 100)):
+        self.img_width = img_width
+        self.img_height = img_height
+        self.focal = 0.5 * img_width / np.tan(np.deg2rad(fov) / 2.)
+
+        self.human_color = np.asarray(human_color, dtype=np.float32)
+        self.obj_color = np.asarray(obj_color, dtype=np.float32)
+        self.floor_color = np.asarray(floor_color, dtype=np.float32)
+        self.condition_color = tuple(int(c) for c in condition_color)
+
+        light_dir = np.asarray([0.3, -0.6, 0.8], dtype=np.float32)
+        self.light_dir = light_dir / np.linalg.norm(light_dir)
+
+    def set_camera(self, all_verts):
+        # all_verts: N X 3, vertices of all the frames, z is up.
+        # Look at the center of the motion from the front side, far enough to keep everything in view.
+        bbox_min = all_verts.min(axis=0)
+        bbox_max = all_verts.max(axis=0)
+        center = (bbox_min + bbox_max) / 2.
+        radius = np.linalg.norm(bbox_max - bbox_min) / 2.
+
+        view_dir = np.asarray([0., -1., 0.5])
+        view_dir = view_dir / np.linalg.norm(view_dir)
+        dist = radius * self.focal / (0.5 * min(self.img_width, self.img_height)) + radius
+
+        self.cam_pos = center + view_dir * dist
+        forward = (center - self.cam_pos) / np.linalg.norm(center - self.cam_pos)
+        right = np.cross(forward, np.asarray([0., 0., 1.]))
+        right = right / np.linalg.norm(right)
+        up = np.cross(right, forward)
+        self.cam_rot = np.stack((right, up, forward), axis=0) # 3 X 3, world to camera
+
+        self.floor_height = bbox_min[2]
+        self.floor_corners = np.asarray([[bbox_min[0]-radius, bbox_min[1]-radius, self.floor_height], \
+                        [bbox_max[0]+radius, bbox_min[1]-radius, self.floor_height], \
+                        [bbox_max[0]+radius, bbox_max[1]+radius, self.floor_height], \
+                        [bbox_min[0]-radius, bbox_max[1]+radius, self.floor_height]])
+
+    def project(self, verts):
+        # verts: N X 3, returns pixel coordinates N X 2 and depths N
+        cam_verts = (verts - self.cam_pos).dot(self.cam_rot.T) # N X 3
+        depth = np.maximum(cam_verts[:, 2], 1e-3)
+        u = self.focal * cam_verts[:, 0] / depth + self.img_width / 2.
+        v = self.img_height / 2. - self.focal * cam_verts[:, 1] / depth
+
+        return np.stack((u, v), axis=1), cam_verts[:, 2]
+
+    def shade_faces(self, verts, faces, base_color):
+        # Returns Nf X 3 colors, two sided Lambertian shading since face winding is not consistent across objects.
+        tri_verts = verts[faces] # Nf X 3 X 3
+        normals = np.cross(tri_verts[:, 1] - tri_verts[:, 0], tri_verts[:, 2] - tri_verts[:, 0])
+        normals = normals / np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+        intensity = 0.35 + 0.65 * np.abs(normals.dot(self.light_dir)) # Nf
+
+        return intensity[:, None] * base_color[None, :]
+
+    def render_frame(self, mesh_list, condition_pts=None):
+        # mesh_list: list of (verts Nv X 3, faces Nf X 3, base color)
+        # condition_pts: K X 3, drawn as dots on top of the meshes.
+        img = np.full((self.img_height, self.img_width, 3), 255, dtype=np.uint8)
+
+        floor_pixels, _ = self.project(self.floor_corners)
+        cv2.fillConvexPoly(img, np.round(floor_pixels * 16).astype(np.int32), \
+                    tuple(int(c) for c in self.floor_color), lineType=cv2.LINE_AA, shift=4)
+
+        pixel_list = []
+        depth_list = []
+        color_list = []
+        for verts, faces, base_color in mesh_list:
+            pixels, depths = self.project(verts)
+            pixel_list.append(pixels[faces]) # Nf X 3 X 2
+            depth_list.append(depths[faces].mean(axis=1)) # Nf
+            color_list.append(self.shade_faces(verts, faces, base_color))
+
+        tri_pixels = np.concatenate(pixel_list, axis=0)
+        tri_depths = np.concatenate(depth_list, axis=0)
+        tri_colors = np.concatenate(color_list, axis=0).astype(np.int32)
+
+        # Far triangles first, skip the ones behind the camera.
+        order = np.argsort(-tri_depths)
+        order = order[tri_depths[order] > 1e-2]
+
+        tri_pixels = np.round(tri_pixels[order] * 16).astype(np.int32) # Subpixel precision with shift=4
+        tri_colors = tri_colors[order].tolist()
+        for t_idx in range(tri_pixels.shape[0]):
+            cv2.fillConvexPoly(img, tri_pixels[t_idx], tri_colors[t_idx], shift=4)
+
+        if condition_pts is not None:
+            cond_pixels, _ = self.project(condition_pts)
+            for pixel in np.round(cond_pixels).astype(np.int32).tolist():
+                cv2.circle(img, tuple(pixel), 5, self.condition_color, -1, lineType=cv2.LINE_AA)
+
+        return img
+
+    def render_to_video(self, human_verts, human_faces, obj_verts, obj_faces, out_vid_path, \
+        condition_pts=None, fps=30):
+        # human_verts: T X Nv X 3, obj_verts: T X No X 3, numpy arrays
+        # condition_pts: K X 3 or None
+        vid_folder = os.path.dirname(out_vid_path)
+        if vid_folder != "" and not os.path.exists(vid_folder):
+            os.makedirs(vid_folder)
+
+        all_verts = np.concatenate((human_verts.reshape(-1, 3), obj_verts.reshape(-1, 3)), axis=0)
+        self.set_camera(all_verts)
+
+        writer = imageio.get_writer(out_vid_path, fps=fps)
+        for t_idx in range(human_verts.shape[0]):
+            img = self.render_frame([(human_verts[t_idx], human_faces, self.human_color), \
+                            (obj_verts[t_idx], obj_faces, self.obj_color)], condition_pts=condition_pts)
+            writer.append_data(img)
+        writer.close()
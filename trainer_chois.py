@@ -27,14 +27,24 @@ from ema_pytorch import EMA
 from manip.data.cano_traj_dataset import CanoObjectTrajDataset, quat_ik_torch, quat_fk_torch
 from manip.data.long_cano_traj_dataset import LongCanoObjectTrajDataset 
 from manip.data.unseen_obj_long_cano_traj_dataset import UnseenCanoObjectTrajDataset 
+from manip.data.sdf_cache import SDFGridCache 
+from manip.data.text_embedding_store import TextEmbeddingStore 
+from manip.data.body_proxy import BodyJointProxy 
+from manip.data.body_model_layer import BatchedSMPLXLayer 
+from manip.data.surface_query import ObjectSurfaceQuery 
+from manip.data.sdf_grid import query_signed_distances, load_sdf_grid 
+from manip.data.path_processing import sample_dense_waypoints, PathStore 
 
 from manip.model.transformer_object_motion_cond_diffusion import ObjectCondGaussianDiffusion 
 
 from manip.vis.blender_vis_mesh_motion import run_blender_rendering_and_save2video, save_verts_faces_to_mesh_file_w_object
+from manip.vis.mesh_writer import write_ply, AsyncMeshWriter 
+from manip.vis.preview_renderer import PreviewRenderer 
 
 from manip.lafan1.utils import quat_inv, quat_mul, quat_between, normalize, quat_normalize 
 
-from evaluation_metrics import compute_metrics, determine_floor_height_and_contacts, compute_metrics_long_seq   
+from evaluation_metrics import compute_metrics_batch, determine_floor_height_and_contacts, compute_metrics_long_seq, \
+    compute_foot_sliding_metrics, MetricWorkerPool   
 
 import clip 
 
@@ -42,47 +52,29 @@ import random
 torch.manual_seed(1)
 random.seed(1)
 
+# Per-sequence evaluation metrics, named and ordered like the arguments of append_new_value_to_metrics_list. 
+SEQ_METRIC_NAMES = ["lhand_jpe", "rhand_jpe", "hand_jpe", "mpvpe", "mpjpe", "rot_dist", "trans_err", \
+    "gt_contact_percent", "contact_percent", "gt_foot_sliding_jnts", "foot_sliding_jnts", \
+    "contact_precision", "contact_recall", "contact_acc", "contact_f1_score", "obj_rot_dist", "obj_com_pos_err", \
+    "start_obj_com_pos_err", "end_obj_com_pos_err", "waypoints_xy_pos_err", "gt_penetration_score", \
+    "penetration_score", "gt_hand_penetration_score", "hand_penetration_score", "gt_floor_height", "pred_floor_height"]
+
+# Metrics returned by compute_foot_sliding_metrics, in its output order. 
+FOOT_SLIDING_METRIC_NAMES = ["gt_foot_sliding_jnts", "foot_sliding_jnts", "gt_floor_height", "pred_floor_height"]
+
 
 def export_to_ply(points, filename='output.ply'):
-    # Open the file in write mode
-    with open(filename, 'w') as ply_file:
-        # Write the PLY header
-        ply_file.write("ply\n")
-        ply_file.write("format ascii 1.0\n")
-        ply_file.write("comment Created by YourProgram\n")
-        ply_file.write(f"element vertex {len(points)}\n")
-        ply_file.write("property float x\n")
-        ply_file.write("property float y\n")
-        ply_file.write("property float z\n")
-        ply_file.write("end_header\n")
-        
-        # Write the points data
-        for point in points:
-            ply_file.write(f"{point[0]} {point[1]} {point[2]}\n")
+    # points: N X 3, written as a binary point cloud 
+    write_ply(points, None, filename)
 
 def compute_signed_distances(
     sdf, sdf_centroid, sdf_extents,
     query_points):
-    # sdf: 1 X 256 X 256 X 256 
+    # sdf: 1 X 256 X 256 X 256, or a SparseSDFGrid 
     # sdf_centroid: 1 X 3, center of the bounding box.  
     # sdf_extents: 1 X 3, width, height, depth of the box.  
     # query_points: T X Nv X 3 
-
-    # query_pts_norm = (query_points - sdf_centroid[None, :, :]) * 2 / sdf_extents[None, :, :] # Convert to range [-1, 1]
-    query_pts_norm = (query_points - sdf_centroid[None, :, :]) * 2 / sdf_extents.cpu().detach().numpy().max() # Convert to range [-1, 1]
-     
-    query_pts_norm = query_pts_norm[...,[2, 1, 0]] # Switch the order to depth, height, width
-    
-    num_steps, nv, _ = query_pts_norm.shape # T X Nv X 3 
-
-    query_pts_norm = query_pts_norm[None, :, None, :, :] # 1 X T X 1 X Nv X 3 
-
-    signed_dists = F.grid_sample(sdf[:, None, :, :, :], query_pts_norm, \
-    padding_mode='border', align_corners=True)
-    # F.grid_sample: N X C X D_in X H_in X W_in, N X D_out X H_out X W_out X 3, output: N X C X D_out X H_out X W_out 
-    # sdf: 1 X 1 X 256 X 256 X 256, query_pts: 1 X T X 1 X Nv X 3 -> 1 X 1 X T X 1 X Nv  
-
-    signed_dists = signed_dists[0, 0, :, 0, :] * sdf_extents.cpu().detach().numpy().max() / 2. # T X Nv 
+    signed_dists = query_signed_distances(sdf, sdf_centroid, sdf_extents.detach(), query_points) # T X Nv 
     
     return signed_dists
 
@@ -185,6 +177,7 @@ class Trainer(object):
         save_and_sample_every=40000,
         results_folder='./results',
         use_wandb=True,   
+        device=torch.device("cuda"),
     ):
         super().__init__()
 
@@ -217,6 +210,8 @@ class Trainer(object):
 
         self.opt = opt 
 
+        self.device = device 
+
         self.window = opt.window
 
         self.add_language_condition = self.opt.add_language_condition 
@@ -245,6 +240,54 @@ class Trainer(object):
 
         self.compute_metrics = self.opt.compute_metrics 
 
+        self.eval_batch_size = self.opt.eval_batch_size 
+
+        self.long_seq_batch_size = self.opt.long_seq_batch_size 
+
+        self.num_metric_workers = self.opt.num_metric_workers 
+        self.metric_queue_size = self.opt.metric_queue_size 
+
+        self.use_sdf_contact_guidance = self.opt.use_sdf_contact_guidance 
+
+        # Store SDFs at full resolution only near the surface, coarse elsewhere. 
+        self.use_sparse_sdf = self.opt.use_sparse_sdf 
+        self.sparse_sdf_band = self.opt.sparse_sdf_band 
+
+        # Keep loaded SDF grids on the device, penetration metrics query the same object several times per sequence. 
+        self.sdf_cache = SDFGridCache(max_bytes=self.opt.sdf_cache_mb*1024**2, use_half=self.opt.sdf_cache_half)
+
+        # Guidance losses only need a few joints, optionally regress them from the predicted rotations instead of 
+        # running the full SMPL-X forward and backward pass at every guided step. 
+        self.body_proxy = None 
+        if self.opt.use_body_proxy_guidance:
+            bm_folder = os.path.join(self.data_root_folder, 'smpl_all_models', 'smplx')
+            bm_fname_dict = {}
+            for gender_name in ['male', 'female', 'neutral']:
+                bm_fname_dict[gender_name] = os.path.join(bm_folder, "SMPLX_"+gender_name.upper()+".npz")
+            lmiddle_index = 28 
+            rmiddle_index = 43 
+            self.body_proxy = BodyJointProxy(bm_fname_dict, list(range(22))+[lmiddle_index, rmiddle_index], \
+                            device=self.device) # Same joints24 layout as run_smplx_model. 
+
+        # Write visualization meshes from a background thread, bounded by mesh_writer_queue_mb of queued arrays. 
+        self.mesh_writer = None 
+        if self.opt.use_async_mesh_writer:
+            self.mesh_writer = AsyncMeshWriter(max_pending_bytes=self.opt.mesh_writer_queue_mb*1024**2)
+
+        # Render quick previews on the CPU from the vertex arrays instead of running Blender. 
+        self.preview_renderer = None 
+        if self.opt.use_preview_renderer:
+            self.preview_renderer = PreviewRenderer()
+
+        # Run SMPL-X for whole batches grouped by gender, shape dependent terms are cached per subject. 
+        self.smplx_layer = None 
+        if self.opt.use_batched_smplx:
+            bm_folder = os.path.join(self.data_root_folder, 'smpl_all_models', 'smplx')
+            bm_fname_dict = {}
+            for gender_name in ['male', 'female', 'neutral']:
+                bm_fname_dict[gender_name] = os.path.join(bm_folder, "SMPLX_"+gender_name.upper()+".npz")
+            self.smplx_layer = BatchedSMPLXLayer(bm_fname_dict, device=self.device)
+
         self.loss_w_feet = self.opt.loss_w_feet 
         self.loss_w_fk = self.opt.loss_w_fk 
         self.loss_w_obj_pts = self.opt.loss_w_obj_pts 
@@ -253,6 +296,17 @@ class Trainer(object):
             clip_version = 'ViT-B/32'
             self.clip_model = self.load_and_freeze_clip(clip_version) 
 
+        # Serve CLIP text features from a persistent store, filled once with all annotations of the datasets. 
+        self.text_embedding_store = None 
+        if self.add_language_condition and self.opt.use_text_embedding_store:
+            self.text_embedding_store = TextEmbeddingStore(os.path.join(self.data_root_folder, "clip_text_embeddings"), \
+                clip_version+"_ctx32", device=self.device)
+            self.prep_text_embedding_store()
+
+        # Planned paths selected by filter_sampled_paths, loaded from its path store if there is one. 
+        self.planned_path_store = None 
+        self.planned_path_root_folder = None 
+
         self.use_long_planned_path = self.opt.use_long_planned_path 
         self.test_object_name = self.opt.test_object_name 
         self.test_scene_name = self.opt.test_scene_name 
@@ -261,7 +315,7 @@ class Trainer(object):
             window=opt.window, use_object_splits=self.use_object_split, \
             input_language_condition=self.add_language_condition, \
             use_first_frame_bps=False, use_random_frame_bps=self.use_random_frame_bps, \
-            test_object_name=self.test_object_name)
+            test_object_name=self.test_object_name, device=self.device)
 
             self.scene_sdf, self.scene_sdf_centroid, self.scene_sdf_extents = \
             self.load_scene_sdf_data(self.test_scene_name)
@@ -280,7 +334,7 @@ class Trainer(object):
                 input_language_condition=self.add_language_condition, \
                 use_first_frame_bps=False, \
                 use_random_frame_bps=self.use_random_frame_bps, \
-                test_long_seq=test_long_seq) 
+                test_long_seq=test_long_seq, device=self.device) 
 
     def load_hand_vertex_ids(self):
         data_folder = "data/part_vert_ids"
@@ -294,23 +348,26 @@ class Trainer(object):
 
         return hand_vids, left_hand_vids, right_hand_vids  
 
-    def load_scene_sdf_data(self, scene_name):
-        data_folder = os.path.join(self.data_root_folder, "replica_processed/replica_fixed_poisson_sdfs_res256")
-        sdf_npy_path = os.path.join(data_folder, scene_name+"_sdf.npy")
-        sdf_json_path = os.path.join(data_folder, scene_name+"_sdf_info.json")
-
-        sdf = np.load(sdf_npy_path) # 256 X 256 X 256 
+    def read_sdf_data(self, sdf_npy_path, sdf_json_path):
+        # 1 X 256 X 256 X 256, or a narrow-band SparseSDFGrid 
+        sdf = load_sdf_grid(sdf_npy_path, device=self.device, use_sparse=self.use_sparse_sdf, band=self.sparse_sdf_band)
         sdf_json_data = json.load(open(sdf_json_path, 'r'))
 
         sdf_centroid = np.asarray(sdf_json_data['centroid']) # a list with 3 items -> 3 
         sdf_extents = np.asarray(sdf_json_data['extents']) # a list with 3 items -> 3 
 
-        sdf = torch.from_numpy(sdf).float()[None].cuda()
-        sdf_centroid = torch.from_numpy(sdf_centroid).float()[None].cuda()
-        sdf_extents = torch.from_numpy(sdf_extents).float()[None].cuda() 
+        sdf_centroid = torch.from_numpy(sdf_centroid).float()[None].to(self.device)
+        sdf_extents = torch.from_numpy(sdf_extents).float()[None].to(self.device) 
 
         return sdf, sdf_centroid, sdf_extents
 
+    def load_scene_sdf_data(self, scene_name):
+        data_folder = os.path.join(self.data_root_folder, "replica_processed/replica_fixed_poisson_sdfs_res256")
+        sdf_npy_path = os.path.join(data_folder, scene_name+"_sdf.npy")
+        sdf_json_path = os.path.join(data_folder, scene_name+"_sdf_info.json")
+
+        return self.sdf_cache.get(("scene", scene_name), lambda: self.read_sdf_data(sdf_npy_path, sdf_json_path))
+
     def load_object_sdf_data(self, object_name):
         if self.test_unseen_objects:
             data_folder = os.path.join(self.data_root_folder, "unseen_objects_data/selected_rotated_zeroed_obj_sdf_256_npy_files")
@@ -321,20 +378,10 @@ class Trainer(object):
             sdf_npy_path = os.path.join(data_folder, object_name+".ply.npy")
             sdf_json_path = os.path.join(data_folder, object_name+".ply.json")
 
-        sdf = np.load(sdf_npy_path) # 256 X 256 X 256 
-        sdf_json_data = json.load(open(sdf_json_path, 'r'))
-
-        sdf_centroid = np.asarray(sdf_json_data['centroid']) # a list with 3 items -> 3 
-        sdf_extents = np.asarray(sdf_json_data['extents']) # a list with 3 items -> 3 
-
-        sdf = torch.from_numpy(sdf).float()[None].cuda()
-        sdf_centroid = torch.from_numpy(sdf_centroid).float()[None].cuda()
-        sdf_extents = torch.from_numpy(sdf_extents).float()[None].cuda() 
-
-        return sdf, sdf_centroid, sdf_extents
+        return self.sdf_cache.get(("object", sdf_npy_path), lambda: self.read_sdf_data(sdf_npy_path, sdf_json_path))
 
     def load_and_freeze_clip(self, clip_version):
-        clip_model, clip_preprocess = clip.load(clip_version, device='cuda',
+        clip_model, clip_preprocess = clip.load(clip_version, device=self.device,
                                 jit=False) 
         # Freeze CLIP weights
         clip_model.eval()
@@ -343,7 +390,26 @@ class Trainer(object):
 
         return clip_model
 
+    def prep_text_embedding_store(self):
+        text_list = []
+        for ds in [self.ds, self.val_ds]:
+            seq_name_list = set([ds.window_data_dict[k]['seq_name'] for k in ds.window_data_dict])
+            for seq_name in seq_name_list:
+                if os.path.exists(os.path.join(ds.language_anno_folder, seq_name+".json")):
+                    text_list.append(ds.load_language_annotation(seq_name))
+
+        num_texts = len(self.text_embedding_store)
+        self.text_embedding_store.add(text_list, self.clip_encode_text)
+        print("Text embedding store: {0} texts, {1} newly encoded".format(len(self.text_embedding_store), \
+            len(self.text_embedding_store)-num_texts))
+
     def encode_text(self, raw_text):
+        if self.text_embedding_store is not None:
+            return self.text_embedding_store.get(raw_text, self.clip_encode_text) # BS X 512 
+
+        return self.clip_encode_text(raw_text) # BS X 512 
+
+    def clip_encode_text(self, raw_text):
         # raw_text - list (batch_size length) of strings with input text prompts
         device = next(self.clip_model.parameters()).device
         max_text_len = 30  # Specific hardcoding for the current dataset
@@ -367,19 +433,23 @@ class Trainer(object):
             window=window_size, use_object_splits=self.use_object_split, \
             input_language_condition=self.add_language_condition, \
             use_random_frame_bps=self.use_random_frame_bps, \
-            use_object_keypoints=self.use_object_keypoints)
+            use_object_keypoints=self.use_object_keypoints, device=self.device, \
+            use_window_store=self.opt.use_window_store, num_preprocess_workers=self.opt.preprocess_workers, \
+            use_preprocess_cache=self.opt.use_preprocess_cache)
         val_dataset = CanoObjectTrajDataset(train=False, data_root_folder=self.data_root_folder, \
             window=window_size, use_object_splits=self.use_object_split, \
             input_language_condition=self.add_language_condition, \
             use_random_frame_bps=self.use_random_frame_bps, \
-            use_object_keypoints=self.use_object_keypoints)
+            use_object_keypoints=self.use_object_keypoints, device=self.device, \
+            use_window_store=self.opt.use_window_store, num_preprocess_workers=self.opt.preprocess_workers, \
+            use_preprocess_cache=self.opt.use_preprocess_cache)
 
         self.ds = train_dataset 
         self.val_ds = val_dataset
         self.dl = cycle(data.DataLoader(self.ds, batch_size=self.batch_size, \
-            shuffle=True, pin_memory=True, num_workers=4))
+            shuffle=True, pin_memory=(self.device.type == "cuda"), num_workers=4))
         self.val_dl = cycle(data.DataLoader(self.val_ds, batch_size=self.batch_size, \
-            shuffle=False, pin_memory=True, num_workers=4))
+            shuffle=False, pin_memory=(self.device.type == "cuda"), num_workers=4))
 
     def save(self, milestone):
         data = {
@@ -392,9 +462,10 @@ class Trainer(object):
 
     def load(self, milestone, pretrained_path=None):
         if pretrained_path is None:
-            data = torch.load(os.path.join(self.results_folder, 'model-'+str(milestone)+'.pt'))
+            data = torch.load(os.path.join(self.results_folder, 'model-'+str(milestone)+'.pt'), \
+                    map_location=self.device)
         else:
-            data = torch.load(pretrained_path)
+            data = torch.load(pretrained_path, map_location=self.device)
 
         self.step = data['step']
         self.model.load_state_dict(data['model'], strict=False)
@@ -466,12 +537,12 @@ class Trainer(object):
             for i in range(self.gradient_accumulate_every):
                 data_dict = next(self.dl)
                 
-                human_data = data_dict['motion'].cuda() # BS X T X (24*3 + 22*6)
-                obj_data = data_dict['obj_motion'].cuda() # BS X T X (3+9) 
+                human_data = data_dict['motion'].to(self.device) # BS X T X (24*3 + 22*6)
+                obj_data = data_dict['obj_motion'].to(self.device) # BS X T X (3+9) 
 
-                obj_bps_data = data_dict['input_obj_bps'].cuda().reshape(-1, 1, 1024*3) # BS X 1 X 1024 X 3 -> BS X 1 X (1024*3) 
+                obj_bps_data = data_dict['input_obj_bps'].to(self.device).reshape(-1, 1, 1024*3) # BS X 1 X 1024 X 3 -> BS X 1 X (1024*3) 
                 
-                rest_human_offsets = data_dict['rest_human_offsets'].cuda() # BS X 24 X 3 
+                rest_human_offsets = data_dict['rest_human_offsets'].to(self.device) # BS X 24 X 3 
 
                 ori_data_cond = obj_bps_data # BS X 1 X (1024*3) 
 
@@ -496,7 +567,7 @@ class Trainer(object):
                 cond_mask = torch.cat((cond_mask, human_cond_mask), dim=-1) # BS X T X (3+6+24*3+22*6)
 
                 with autocast(enabled = self.amp):    
-                    contact_data = data_dict['contact_labels'].cuda() # BS X T X 4 
+                    contact_data = data_dict['contact_labels'].to(self.device) # BS X T X 4 
                    
                     data = torch.cat((obj_data, human_data, contact_data), dim=-1) 
                     cond_mask = torch.cat((cond_mask, \
@@ -581,14 +652,14 @@ class Trainer(object):
 
                 with torch.no_grad():
                     val_data_dict = next(self.val_dl)
-                    val_human_data = val_data_dict['motion'].cuda() 
-                    val_obj_data = val_data_dict['obj_motion'].cuda()
+                    val_human_data = val_data_dict['motion'].to(self.device) 
+                    val_obj_data = val_data_dict['obj_motion'].to(self.device)
 
-                    obj_bps_data = val_data_dict['input_obj_bps'].cuda().reshape(-1, 1, 1024*3)
+                    obj_bps_data = val_data_dict['input_obj_bps'].to(self.device).reshape(-1, 1, 1024*3)
                    
                     ori_data_cond = obj_bps_data 
 
-                    rest_human_offsets = val_data_dict['rest_human_offsets'].cuda() # BS X 24 X 3 
+                    rest_human_offsets = val_data_dict['rest_human_offsets'].to(self.device) # BS X 24 X 3 
 
                     # Generate padding mask 
                     actual_seq_len = val_data_dict['seq_len'] + 1 # BS, + 1 since we need additional timestep for noise level 
@@ -607,7 +678,7 @@ class Trainer(object):
                     cond_mask = torch.cat((cond_mask, human_cond_mask), dim=-1) # BS X T X (3+6+24*3+22*6)
 
                     # Get validation loss 
-                    contact_data = val_data_dict['contact_labels'].cuda() # BS X T X 4 
+                    contact_data = val_data_dict['contact_labels'].to(self.device) # BS X T X 4 
                     
                     data = torch.cat((val_obj_data, val_human_data, contact_data), dim=-1) 
                     cond_mask = torch.cat((cond_mask, \
@@ -713,6 +784,24 @@ class Trainer(object):
         self.gt_hand_penetration_list.append(gt_hand_penetration_score)
         self.hand_penetration_list.append(hand_penetration_score) 
 
+    def save_seq_evaluation_metrics(self, metric_values, dest_metric_folder, curr_seq_name_tag):
+        # metric_values: one sequence's values, keyed by the argument names of append_new_value_to_metrics_list 
+        self.append_new_value_to_metrics_list(**metric_values)
+
+        # Print current seq's evaluation metrics. 
+        print("Current Sequence name:{0}".format(curr_seq_name_tag))
+        self.print_evaluation_metrics(*[[metric_values[name]] for name in SEQ_METRIC_NAMES], \
+                dest_metric_folder, curr_seq_name_tag)
+
+    def merge_foot_sliding_metrics(self, finished_list, pending_metrics_dict, dest_metric_folder):
+        # finished_list: (job index, output of compute_foot_sliding_metrics) from MetricWorkerPool 
+        for job_idx, foot_sliding_res in finished_list:
+            metric_values, curr_seq_name_tag = pending_metrics_dict.pop(job_idx)
+
+            metric_values.update(zip(FOOT_SLIDING_METRIC_NAMES, foot_sliding_res))
+
+            self.save_seq_evaluation_metrics(metric_values, dest_metric_folder, curr_seq_name_tag)
+
     def print_evaluation_metrics(self, lhand_jpe_list, rhand_jpe_list, hand_jpe_list, mpvpe_list, mpjpe_list, \
                 rot_dist_list, trans_err_list, gt_contact_percent_list, contact_percent_list, \
                 gt_foot_sliding_jnts_list, foot_sliding_jnts_list, contact_precision_list, contact_recall_list, \
@@ -1047,25 +1136,41 @@ class Trainer(object):
 
         self.ema.ema_model.eval()
 
+        # Pack multiple test windows into one batch when only evaluation metrics are needed. 
+        # Guidance loads a single object's SDF and visualization renders one sequence at a time, 
+        # so both of them still run with batch size 1. 
+        eval_batch_size = self.eval_batch_size 
+        if eval_batch_size > 1 and (self.use_guidance_in_denoising or not self.compute_metrics):
+            print("Batched evaluation requires compute_metrics without guidance, using batch size 1.")
+            eval_batch_size = 1 
+
         if self.test_on_train:
             test_loader = torch.utils.data.DataLoader(
-                self.ds, batch_size=1, shuffle=False,
-                num_workers=1, pin_memory=True, drop_last=False) 
+                self.ds, batch_size=eval_batch_size, shuffle=False,
+                num_workers=1, pin_memory=(self.device.type == "cuda"), drop_last=False) 
         else:
             if self.test_unseen_objects:
                 test_loader = torch.utils.data.DataLoader(
-                    self.unseen_seq_ds, batch_size=1, shuffle=False,
-                    num_workers=1, pin_memory=True, drop_last=False) 
+                    self.unseen_seq_ds, batch_size=eval_batch_size, shuffle=False,
+                    num_workers=1, pin_memory=(self.device.type == "cuda"), drop_last=False) 
             else:
                 test_loader = torch.utils.data.DataLoader(
-                    self.val_ds, batch_size=1, shuffle=False,
-                    num_workers=1, pin_memory=True, drop_last=False) 
+                    self.val_ds, batch_size=eval_batch_size, shuffle=False,
+                    num_workers=1, pin_memory=(self.device.type == "cuda"), drop_last=False) 
 
         self.prep_evaluation_metrics_list()
 
         dest_res_for_eval_npz_folder, dest_metric_folder, dest_out_vis_folder, \
         dest_out_gt_vis_folder, dest_out_obj_folder, dest_out_text_json_folder = self.prep_res_folders() 
 
+        # Floor heights and foot sliding only need the joint positions on CPU, optionally compute them 
+        # in worker processes so that sampling does not wait for them. 
+        metric_pool = None 
+        if self.compute_metrics and self.num_metric_workers > 0:
+            metric_pool = MetricWorkerPool(self.num_metric_workers, max_pending=self.metric_queue_size)
+        pending_metrics_dict = {}
+        metric_job_idx = 0 
+
         for s_idx, val_data_dict in enumerate(test_loader):
 
             seq_name_list = val_data_dict['seq_name']
@@ -1073,16 +1178,16 @@ class Trainer(object):
             start_frame_idx_list = val_data_dict['s_idx']
             end_frame_idx_list = val_data_dict['e_idx'] 
 
-            val_human_data = val_data_dict['motion'].cuda() 
-            val_obj_data = val_data_dict['obj_motion'].cuda()
+            val_human_data = val_data_dict['motion'].to(self.device) 
+            val_obj_data = val_data_dict['obj_motion'].to(self.device)
 
-            obj_bps_data = val_data_dict['input_obj_bps'].cuda().reshape(-1, 1, 1024*3)
+            obj_bps_data = val_data_dict['input_obj_bps'].to(self.device).reshape(-1, 1, 1024*3)
             ori_data_cond = obj_bps_data # BS X 1 X (1024*3) 
 
-            rest_human_offsets = val_data_dict['rest_human_offsets'].cuda() # BS X 24 X 3 
+            rest_human_offsets = val_data_dict['rest_human_offsets'].to(self.device) # BS X 24 X 3 
             
             if "contact_labels" in val_data_dict:
-                contact_labels = val_data_dict['contact_labels'].cuda() # BS X T X 4 
+                contact_labels = val_data_dict['contact_labels'].to(self.device) # BS X T X 4 
             else:
                 contact_labels = None 
 
@@ -1159,46 +1264,53 @@ class Trainer(object):
             if self.test_unseen_objects:
                 vis_tag = vis_tag + "_on_unseen_objects"
 
-            curr_seq_name_tag = seq_name_list[0] + "_" + object_name_list[0]+ "_sidx_" + \
-                        str(start_frame_idx_list[0].detach().cpu().numpy()) +\
-                        "_eidx_" + str(end_frame_idx_list[0].detach().cpu().numpy()) + \
-                        "_sample_cnt_" + str(sample_idx)
-
-            dest_text_json_path = os.path.join(dest_out_text_json_folder, curr_seq_name_tag+".json")
-            dest_text_json_dict = {}
-            dest_text_json_dict['text'] = val_data_dict['text'][0]
-            if not os.path.exists(dest_text_json_path):
-                json.dump(dest_text_json_dict, open(dest_text_json_path, 'w'))
-
+            tmp_bs = len(seq_name_list) 
+            for tmp_bs_idx in range(tmp_bs):
+                curr_seq_name_tag = seq_name_list[tmp_bs_idx] + "_" + object_name_list[tmp_bs_idx]+ "_sidx_" + \
+                            str(start_frame_idx_list[tmp_bs_idx].detach().cpu().numpy()) +\
+                            "_eidx_" + str(end_frame_idx_list[tmp_bs_idx].detach().cpu().numpy()) + \
+                            "_sample_cnt_" + str(sample_idx)
+
+                dest_text_json_path = os.path.join(dest_out_text_json_folder, curr_seq_name_tag+".json")
+                dest_text_json_dict = {}
+                dest_text_json_dict['text'] = val_data_dict['text'][tmp_bs_idx]
+                if not os.path.exists(dest_text_json_path):
+                    json.dump(dest_text_json_dict, open(dest_text_json_path, 'w'))
+
+            # Visualization paths are only used when evaluating one sequence at a time. 
             curr_dest_out_mesh_folder = os.path.join(dest_out_obj_folder, curr_seq_name_tag) 
             curr_dest_out_vid_path = os.path.join(dest_out_vis_folder, curr_seq_name_tag+".mp4")
             curr_dest_out_gt_vid_path = os.path.join(dest_out_gt_vis_folder, curr_seq_name_tag+".mp4")
 
+            if tmp_bs == 1:
+                curr_object_name = object_name_list[0]
+            else:
+                curr_object_name = None # Each sequence uses its own object in data_dict. 
+
             if self.use_object_keypoints:
                 all_res_list = all_res_list[:, :, :-4] 
 
             gt_human_verts_list, gt_human_jnts_list, gt_human_trans_list, gt_human_rot_list, \
             gt_obj_com_pos_list, gt_obj_rot_mat_list, gt_obj_verts_list, human_faces_list, obj_faces_list, _ = \
             self.gen_vis_res_generic(for_vis_gt_data, val_data_dict, milestone, cond_mask, vis_gt=True, \
-            curr_object_name=object_name_list[0], vis_tag=vis_tag, \
+            curr_object_name=curr_object_name, vis_tag=vis_tag, \
             dest_out_vid_path=curr_dest_out_gt_vid_path, \
             dest_mesh_vis_folder=curr_dest_out_mesh_folder) 
            
             pred_human_verts_list, pred_human_jnts_list, pred_human_trans_list, pred_human_rot_list, \
             pred_obj_com_pos_list, pred_obj_rot_mat_list, pred_obj_verts_list, _, _, _ = \
             self.gen_vis_res_generic(all_res_list, val_data_dict, milestone, cond_mask, \
-            curr_object_name=object_name_list[0], vis_tag=vis_tag, \
+            curr_object_name=curr_object_name, vis_tag=vis_tag, \
             dest_out_vid_path=curr_dest_out_vid_path, dest_mesh_vis_folder=curr_dest_out_mesh_folder)
 
             # Save results to npz files
             # Save global joint positions to npz files for evaluation (R_precition, FID, etc)
             # tmp_bs = val_obj_data.shape[0]
-            tmp_bs = len(seq_name_list) 
             for tmp_bs_idx in range(tmp_bs):
                 tmp_seq_name = seq_name_list[tmp_bs_idx]
                 tmp_obj_name = object_name_list[tmp_bs_idx]
             
-                curr_pred_global_jpos = pred_human_jnts_list[0].detach().cpu().numpy()
+                curr_pred_global_jpos = pred_human_jnts_list[tmp_bs_idx].detach().cpu().numpy()
                 if self.test_unseen_objects:
                     curr_seq_dest_res_npz_path = os.path.join(dest_res_for_eval_npz_folder, \
                                             tmp_seq_name+"_"+tmp_obj_name+".npz")
@@ -1208,65 +1320,72 @@ class Trainer(object):
                 np.savez(curr_seq_dest_res_npz_path, seq_name=tmp_seq_name, \
                         global_jpos=curr_pred_global_jpos) # T X 24 X 3 
 
-            for tmp_s_idx in range(num_samples_per_seq):
-                # Compute evaluation metrics 
+            # Compute evaluation metrics for all the sequences and samples at once. 
+            metrics_res_list = compute_metrics_batch(gt_human_verts_list, pred_human_verts_list, \
+                        gt_human_jnts_list, pred_human_jnts_list, \
+                        gt_human_trans_list, pred_human_trans_list, \
+                        gt_human_rot_list, pred_human_rot_list, \
+                        gt_obj_com_pos_list, pred_obj_com_pos_list, \
+                        gt_obj_rot_mat_list, pred_obj_rot_mat_list, \
+                        gt_obj_verts_list, pred_obj_verts_list, compute_foot_sliding=(metric_pool is None))
+
+            for tmp_s_idx in range(num_samples_per_seq * tmp_bs):
+                tmp_bs_idx = tmp_s_idx % tmp_bs 
+
                 lhand_jpe, rhand_jpe, hand_jpe, mpvpe, mpjpe, rot_dist, trans_err, \
                 gt_contact_percent, contact_percent, \
                 gt_foot_sliding_jnts, foot_sliding_jnts, \
                 contact_precision, contact_recall, contact_acc, contact_f1_score, \
                 obj_rot_dist, obj_com_pos_err, start_obj_com_pos_err, end_obj_com_pos_err, waypoints_xy_pos_err, \
-                gt_floor_height, pred_floor_height = \
-                        compute_metrics(gt_human_verts_list[tmp_s_idx], pred_human_verts_list[tmp_s_idx], \
-                        gt_human_jnts_list[tmp_s_idx], pred_human_jnts_list[tmp_s_idx], \
-                        human_faces_list[tmp_s_idx], \
-                        gt_human_trans_list[tmp_s_idx], pred_human_trans_list[tmp_s_idx], \
-                        gt_human_rot_list[tmp_s_idx], pred_human_rot_list[tmp_s_idx], \
-                        gt_obj_com_pos_list[tmp_s_idx], pred_obj_com_pos_list[tmp_s_idx], \
-                        gt_obj_rot_mat_list[tmp_s_idx], pred_obj_rot_mat_list[tmp_s_idx], \
-                        gt_obj_verts_list[tmp_s_idx], pred_obj_verts_list[tmp_s_idx], \
-                        obj_faces_list[tmp_s_idx], val_data_dict['seq_len'])
-
-                pred_hand_penetration_score = self.compute_hand_penetration_metric(object_name_list[0], \
+                gt_floor_height, pred_floor_height = metrics_res_list[tmp_s_idx]
+
+                pred_hand_penetration_score = self.compute_hand_penetration_metric(object_name_list[tmp_bs_idx], \
                                     pred_human_verts_list[tmp_s_idx], \
                                     pred_obj_com_pos_list[tmp_s_idx], pred_obj_rot_mat_list[tmp_s_idx])
-                gt_hand_penetration_score = self.compute_hand_penetration_metric(object_name_list[0], \
+                gt_hand_penetration_score = self.compute_hand_penetration_metric(object_name_list[tmp_bs_idx], \
                                     gt_human_verts_list[tmp_s_idx], \
                                     gt_obj_com_pos_list[tmp_s_idx], gt_obj_rot_mat_list[tmp_s_idx])
 
-                pred_penetration_score = self.compute_hand_penetration_metric(object_name_list[0], \
+                pred_penetration_score = self.compute_hand_penetration_metric(object_name_list[tmp_bs_idx], \
                                     pred_human_verts_list[tmp_s_idx], \
                                     pred_obj_com_pos_list[tmp_s_idx], pred_obj_rot_mat_list[tmp_s_idx], eval_fullbody=True)
-                gt_penetration_score = self.compute_hand_penetration_metric(object_name_list[0], \
+                gt_penetration_score = self.compute_hand_penetration_metric(object_name_list[tmp_bs_idx], \
                                     gt_human_verts_list[tmp_s_idx], \
                                     gt_obj_com_pos_list[tmp_s_idx], gt_obj_rot_mat_list[tmp_s_idx], eval_fullbody=True)
-               
-                self.append_new_value_to_metrics_list(lhand_jpe, rhand_jpe, hand_jpe, mpvpe, mpjpe, rot_dist, trans_err, \
-                gt_contact_percent, contact_percent, gt_foot_sliding_jnts, foot_sliding_jnts, \
+
+                curr_seq_name_tag = seq_name_list[tmp_bs_idx] + "_" + object_name_list[tmp_bs_idx]+ "_sidx_" + \
+                        str(start_frame_idx_list[tmp_bs_idx].detach().cpu().numpy()) +\
+                        "_eidx_" + str(end_frame_idx_list[tmp_bs_idx].detach().cpu().numpy()) + \
+                        "_sample_cnt_" + str(tmp_s_idx // tmp_bs)
+
+                metric_values = dict(zip(SEQ_METRIC_NAMES, [lhand_jpe, rhand_jpe, hand_jpe, mpvpe, mpjpe, \
+                rot_dist, trans_err, gt_contact_percent, contact_percent, gt_foot_sliding_jnts, foot_sliding_jnts, \
                 contact_precision, contact_recall, contact_acc, contact_f1_score, \
                 obj_rot_dist, obj_com_pos_err, \
                 start_obj_com_pos_err, end_obj_com_pos_err, waypoints_xy_pos_err, \
                 gt_penetration_score, pred_penetration_score, \
                 gt_hand_penetration_score, pred_hand_penetration_score, \
-                gt_floor_height, pred_floor_height) 
-
-                # Print current seq's evaluation metrics. 
-                curr_seq_name_tag = seq_name_list[0] + "_" + object_name_list[0]+ "_sidx_" + str(start_frame_idx_list[0].detach().cpu().numpy()) +\
-                        "_eidx_" + str(end_frame_idx_list[0].detach().cpu().numpy()) + "_sample_cnt_" + str(tmp_s_idx)
-                print("Current Sequence name:{0}".format(curr_seq_name_tag))
-                self.print_evaluation_metrics([lhand_jpe], [rhand_jpe], [hand_jpe], [mpvpe], [mpjpe], \
-                [rot_dist], [trans_err], \
-                [gt_contact_percent], [contact_percent], \
-                [gt_foot_sliding_jnts], [foot_sliding_jnts], \
-                [contact_precision], [contact_recall], [contact_acc], [contact_f1_score], \
-                [obj_rot_dist], [obj_com_pos_err], \
-                [start_obj_com_pos_err], [end_obj_com_pos_err], [waypoints_xy_pos_err], \
-                [gt_penetration_score], [pred_penetration_score], \
-                [gt_hand_penetration_score], [pred_hand_penetration_score], \
-                [gt_floor_height], [pred_floor_height], \
-                dest_metric_folder, curr_seq_name_tag) # Assume batch size = 1 
+                gt_floor_height, pred_floor_height]))
+
+                if metric_pool is None:
+                    self.save_seq_evaluation_metrics(metric_values, dest_metric_folder, curr_seq_name_tag)
+                else:
+                    # Foot sliding is finished by the workers, the next batch is denoised in the meantime. 
+                    pending_metrics_dict[metric_job_idx] = (metric_values, curr_seq_name_tag)
+                    finished_list = metric_pool.submit(metric_job_idx, compute_foot_sliding_metrics, \
+                                gt_human_jnts_list[tmp_s_idx].detach().cpu().numpy(), \
+                                pred_human_jnts_list[tmp_s_idx].detach().cpu().numpy())
+                    self.merge_foot_sliding_metrics(finished_list, pending_metrics_dict, dest_metric_folder)
+                    metric_job_idx += 1 
 
             torch.cuda.empty_cache()
 
+        if metric_pool is not None:
+            self.merge_foot_sliding_metrics(metric_pool.drain(), pending_metrics_dict, dest_metric_folder)
+            metric_pool.shutdown()
+
+        self.flush_mesh_writer()
+
         self.print_evaluation_metrics(self.lhand_jpe_list, self.rhand_jpe_list, self.hand_jpe_list, self.mpvpe_list, self.mpjpe_list, \
             self.rot_dist_list, self.trans_err_list, self.gt_contact_percent_list, self.contact_percent_list, \
             self.gt_foot_sliding_jnts_list, self.foot_sliding_jnts_list, \
@@ -1501,6 +1620,9 @@ class Trainer(object):
         seq_json_path = "utils/create_eval_dataset/selected_long_seq_names.json"
         json_data = json.load(open(seq_json_path, 'r'))
         npy_root_folder = os.path.join(self.data_root_folder, "replica_processed/replica_single_object_long_seq_data_selected")
+        if os.path.exists(npy_root_folder + ".npz"):
+            self.planned_path_store = PathStore.load(npy_root_folder + ".npz")
+            self.planned_path_root_folder = npy_root_folder 
 
         object_name_data_dict = {} 
 
@@ -1518,7 +1640,7 @@ class Trainer(object):
             # Otherwise, can just use floor height as the target position. 
             # The 9,10,13 target 3d position is the real table height position, shouldn't use the relative height wrt the first frame. The first frame's height is not equal to floor height. 
 
-            npy_data = np.load(npy_path)
+            npy_data = self.load_planned_path_npy(npy_path)
             if npy_data.shape[0] < 9: # Discard single window sequence, we want to generate long sequence here 
                 continue 
 
@@ -1605,12 +1727,21 @@ class Trainer(object):
         
         return cano_quat, canonicalized_path_pts 
 
+    def load_planned_path_npy(self, npy_path):
+        # Read the path from the path store if it has it, otherwise from its npy file. 
+        if self.planned_path_store is not None:
+            path_name = os.path.relpath(npy_path, self.planned_path_root_folder)
+            if path_name in self.planned_path_store:
+                return self.planned_path_store.get(path_name)
+
+        return np.load(npy_path)
+
     def load_planned_path_as_waypoints_new(self, long_seq_path, \
                                 use_canonicalization=True, return_scene_names=False):
        
         selected_npy_path = long_seq_path 
 
-        npy_data = np.load(selected_npy_path) # K X 3 (xyz, y represents the floor in Habitat) 
+        npy_data = self.load_planned_path_npy(selected_npy_path) # K X 3 (xyz, y represents the floor in Habitat) 
 
         planned_data = torch.from_numpy(npy_data).float() # T X 3  
         
@@ -1627,33 +1758,7 @@ class Trainer(object):
             return cano_planned_data
 
     def sample_dense_waypoints(self, waypoints, distance_range=(0.6, 0.8), remainder=1):
-        # Validate the remainder value
-        assert remainder in [0, 1, 2, 3], "Remainder must be one of [0, 1, 2, 3]."
-        
-        # Compute the distances between each consecutive pair of waypoints
-        segment_lengths = np.linalg.norm(np.diff(waypoints, axis=0), axis=-1)
-        
-        # For each segment, compute the number of intermediate points to insert
-        num_points_per_segment = np.ceil(segment_lengths / distance_range[0]) - 1
-        num_points_per_segment = np.maximum(num_points_per_segment, 
-                                            np.floor(segment_lengths / distance_range[1]) - 1).astype(int)
-
-        # Create dense waypoints by interpolating for each segment
-        dense_waypoints = [waypoints[0]]
-        for i, num_points in enumerate(num_points_per_segment):
-            for j in range(num_points):
-                t = (j + 1) / (num_points + 1)
-                interpolated_point = (1 - t) * waypoints[i] + t * waypoints[i+1]
-                dense_waypoints.append(interpolated_point)
-            dense_waypoints.append(waypoints[i+1])
-
-        # Adjust number of waypoints to ensure it's of the desired form
-        while len(dense_waypoints) % 4 != remainder:
-            # For simplicity, remove the point closest to its neighbor
-            min_dist_idx = np.argmin(np.linalg.norm(np.diff(dense_waypoints, axis=0), axis=-1)) + 1
-            del dense_waypoints[min_dist_idx]
-
-        return np.array(dense_waypoints)
+        return sample_dense_waypoints(waypoints, distance_range=distance_range, remainder=remainder)
     
     def load_planned_path_as_waypoints(self, long_seq_path, load_long_seq=True, \
                                 use_canonicalization=True, return_scene_names=False, \
@@ -1742,17 +1847,22 @@ class Trainer(object):
         return contact_labels 
 
     def gen_language_for_long_seq(self, num_windows, text):
-        text_list = []
-        for w_idx in range(num_windows):
-            text_list.append(text) 
+        # All windows share the same sentence, encode it once. 
+        language_input = self.encode_text(text) # 1 X 512 
 
         text_clip_feats_list = []
-        for window_text in text_list:
-            language_input = self.encode_text(window_text) # 1 X 512 
+        for w_idx in range(num_windows):
             text_clip_feats_list.append(language_input)
 
         return text_clip_feats_list  
 
+    def run_body_model(self, root_trans, aa_rot_rep, betas, gender, bm_dict):
+        # Same arguments and outputs as run_smplx_model with return_joints24=True. 
+        if self.smplx_layer is not None:
+            return self.smplx_layer(root_trans, aa_rot_rep, betas, gender, return_joints24=True)
+
+        return run_smplx_model(root_trans, aa_rot_rep, betas, gender, bm_dict, return_joints24=True)
+
     def get_object_mesh_from_prediction(self, all_res_list, data_dict, ds, \
             curr_window_ref_obj_rot_mat=None):
         num_seq = all_res_list.shape[0]
@@ -1789,6 +1899,17 @@ class Trainer(object):
             trans2joint = trans2joint.repeat(num_seq, 1) 
             seq_len = seq_len.repeat(num_seq) 
 
+        # All the samples share one subject, run SMPL-X for them together. 
+        if self.smplx_layer is not None:
+            batch_local_rot_mat = quat_ik_torch(global_rot_mat.reshape(-1, 22, 3, 3)) # (N*T) X 22 X 3 X 3 
+            batch_local_rot_aa_rep = transforms.matrix_to_axis_angle(batch_local_rot_mat).reshape(num_seq, \
+                                -1, 22, 3) # N X T X 22 X 3 
+            batch_root_trans = global_root_jpos + trans2joint[:, None, :].to(global_root_jpos.device) # N X T X 3 
+            batch_betas = data_dict['betas'][0].reshape(1, -1).repeat(num_seq, 1) # N X 16 
+            batch_mesh_jnts, batch_mesh_verts, batch_mesh_faces = \
+                self.smplx_layer(batch_root_trans.to(self.device), batch_local_rot_aa_rep.to(self.device), \
+                batch_betas.to(self.device), [data_dict['gender'][0]]*num_seq, return_joints24=True)
+
         human_mesh_verts_list = []
         human_mesh_jnts_list = []
         object_mesh_verts_list = []
@@ -1822,15 +1943,20 @@ class Trainer(object):
             object_name = data_dict['obj_name'][0]
           
             # Get human verts 
-            mesh_jnts, mesh_verts, mesh_faces = \
-                run_smplx_model(root_trans[None].cuda(), curr_local_rot_aa_rep[None].cuda(), \
-                betas.cuda(), [gender], ds.bm_dict, return_joints24=True)
+            if self.smplx_layer is not None:
+                mesh_jnts = batch_mesh_jnts[idx:idx+1] # 1 X T X 24 X 3 
+                mesh_verts = batch_mesh_verts[idx:idx+1] # 1 X T X Nv X 3 
+                mesh_faces = batch_mesh_faces 
+            else:
+                mesh_jnts, mesh_verts, mesh_faces = \
+                    run_smplx_model(root_trans[None].to(self.device), curr_local_rot_aa_rep[None].to(self.device), \
+                    betas.to(self.device), [gender], ds.bm_dict, return_joints24=True)
 
             # For generating all the vertices of the object 
             obj_rest_verts, obj_mesh_faces = ds.load_rest_pose_object_geometry(object_name) 
             obj_rest_verts = torch.from_numpy(obj_rest_verts).float().to(pred_seq_com_pos.device)
 
-            obj_mesh_verts = ds.load_object_geometry_w_rest_geo(curr_obj_rot_mat.cuda(), \
+            obj_mesh_verts = ds.load_object_geometry_w_rest_geo(curr_obj_rot_mat.to(self.device), \
                         pred_seq_com_pos[idx], obj_rest_verts) # T X Nv X 3 
 
             # For generating object keypoints 
@@ -1856,6 +1982,61 @@ class Trainer(object):
 
         return human_mesh_verts_list, human_mesh_jnts_list, mesh_faces, object_mesh_verts_list, obj_mesh_faces 
 
+    def get_guidance_mesh_from_prediction(self, all_res_list, data_dict, ds, \
+            curr_window_ref_obj_rot_mat=None):
+        if self.body_proxy is None:
+            return self.get_object_mesh_from_prediction(all_res_list, data_dict, ds, \
+                curr_window_ref_obj_rot_mat=curr_window_ref_obj_rot_mat)
+
+        # Only joints are used by the guidance losses, human vertices are not computed. 
+        num_seq = all_res_list.shape[0]
+
+        pred_normalized_obj_trans = all_res_list[:, :, :3] # N X T X 3 
+       
+        if self.use_random_frame_bps:
+            pred_obj_rel_rot_mat = all_res_list[:, :, 3:3+9].reshape(num_seq, -1, 3, 3) # N X T X 3 X 3
+            if curr_window_ref_obj_rot_mat is not None:
+                pred_obj_rot_mat = ds.rel_rot_to_seq(pred_obj_rel_rot_mat, curr_window_ref_obj_rot_mat)
+            else:
+                pred_obj_rot_mat = ds.rel_rot_to_seq(pred_obj_rel_rot_mat, data_dict['reference_obj_rot_mat']) 
+        else:
+            pred_obj_rot_mat = all_res_list[:, :, 3:3+9].reshape(num_seq, -1, 3, 3) # N X T X 3 X 3
+
+        pred_seq_com_pos = ds.de_normalize_obj_pos_min_max(pred_normalized_obj_trans) # N X T X 3 
+        
+        num_joints = 24
+    
+        normalized_global_jpos = all_res_list[:, :, 3+9:3+9+num_joints*3].reshape(num_seq, -1, num_joints, 3)
+        global_jpos = ds.de_normalize_jpos_min_max(normalized_global_jpos.reshape(-1, num_joints, 3))
+        global_jpos = global_jpos.reshape(num_seq, -1, num_joints, 3) # N X T X 24 X 3 
+        global_root_jpos = global_jpos[:, :, 0, :] # N X T X 3 
+
+        global_rot_6d = all_res_list[:, :, 3+9+num_joints*3:3+9+num_joints*3+22*6].reshape(num_seq, -1, 22, 6)
+        global_rot_mat = transforms.rotation_6d_to_matrix(global_rot_6d) # N X T X 22 X 3 X 3 
+
+        trans2joint = data_dict['trans2joint'].to(all_res_list.device) # N X 3
+        if trans2joint.shape[0] != num_seq:
+            trans2joint = trans2joint.repeat(num_seq, 1) 
+
+        root_trans = global_root_jpos + trans2joint[:, None, :] # N X T X 3 
+
+        betas = data_dict['betas'][0].to(all_res_list.device).repeat(num_seq, 1) # N X 16 
+        gender = [data_dict['gender'][0]] * num_seq 
+
+        human_jnts = self.body_proxy.get_joints(global_rot_mat, root_trans, betas, gender) # N X T X 24 X 3 
+
+        # Object vertices of all frames in one call. 
+        object_name = data_dict['obj_name'][0]
+        obj_rest_verts = ds.bps_service.get_rest_verts(object_name, all_res_list.device) # Nv X 3, kept on the device 
+
+        pred_obj_quat = transforms.matrix_to_quaternion(pred_obj_rot_mat)
+        pred_obj_rot_mat = transforms.quaternion_to_matrix(pred_obj_quat) # Potentially avoid some prediction not satisfying rotation matrix requirements.
+        obj_verts = ds.load_object_geometry_w_rest_geo(pred_obj_rot_mat.reshape(-1, 3, 3), \
+                    pred_seq_com_pos.reshape(-1, 3), obj_rest_verts) # (N*T) X Nv X 3 
+        obj_verts = obj_verts.reshape(num_seq, -1, obj_verts.shape[-2], 3) # N X T X Nv X 3 
+
+        return None, human_jnts[:, None], None, obj_verts, None 
+
     def rotation_matrix_from_two_vectors(self, vec1, vec2):
         # Find the rotation matrix that aligns vec1 to vec2 
         a, b = (vec1 / np.linalg.norm(vec1)).reshape(3), (vec2 / np.linalg.norm(vec2)).reshape(3)
@@ -1878,11 +2059,11 @@ class Trainer(object):
         
         if self.test_unseen_objects:
             human_verts, human_jnts, human_faces, obj_verts, obj_faces = \
-            self.get_object_mesh_from_prediction(pred_clean_x, data_dict, ds=self.unseen_seq_ds, \
+            self.get_guidance_mesh_from_prediction(pred_clean_x, data_dict, ds=self.unseen_seq_ds, \
             curr_window_ref_obj_rot_mat=curr_window_ref_obj_rot_mat) 
         else:
             human_verts, human_jnts, human_faces, obj_verts, obj_faces = \
-            self.get_object_mesh_from_prediction(pred_clean_x, data_dict, ds=self.val_ds, \
+            self.get_guidance_mesh_from_prediction(pred_clean_x, data_dict, ds=self.val_ds, \
             curr_window_ref_obj_rot_mat=curr_window_ref_obj_rot_mat) 
         # BS X 1 X T X Nv X 3, BS X 1 X T X 24 X 3, BS X T X Nv' X 3 
 
@@ -1973,20 +2154,14 @@ class Trainer(object):
 
         if self.test_unseen_objects:
             human_verts, human_jnts, human_faces, obj_verts, obj_faces = \
-            self.get_object_mesh_from_prediction(pred_clean_x, data_dict, ds=self.unseen_seq_ds, \
+            self.get_guidance_mesh_from_prediction(pred_clean_x, data_dict, ds=self.unseen_seq_ds, \
             curr_window_ref_obj_rot_mat=curr_window_ref_obj_rot_mat) 
         else:
             human_verts, human_jnts, human_faces, obj_verts, obj_faces = \
-            self.get_object_mesh_from_prediction(pred_clean_x, data_dict, ds=self.val_ds, \
+            self.get_guidance_mesh_from_prediction(pred_clean_x, data_dict, ds=self.val_ds, \
             curr_window_ref_obj_rot_mat=curr_window_ref_obj_rot_mat) 
         # # BS X 1 X T X Nv X 3, BS X 1 X T X 24 X 3, BS X T X Nv' X 3 ]
 
-        # Need to downsample object vertices sometimes. 
-        num_obj_verts = obj_verts.shape[2]
-        if num_obj_verts > 30000:
-            downsample_rate = num_obj_verts//30000 + 1 
-            obj_verts = obj_verts[:, :, ::downsample_rate, :] 
-
         # 1. Compute penetration loss between hand vertices and object vertices. 
         # hand_verts = human_verts.squeeze(1)[:, :, self.hand_vertex_idxs, :] # BS X T X N_hand X 3 
         pred_normalized_obj_trans = pred_clean_x[:, :, :3] # N X T X 3 
@@ -2015,10 +2190,23 @@ class Trainer(object):
                     right_palm_jpos[:, :, None, :]), dim=2) # BS X T X 2 X 3
         bs, seq_len, _, _ = contact_points.shape  
       
-        # print("Object # vertices:{0}".format(obj_verts.shape)) 
-        dists = torch.cdist(contact_points.reshape(bs*seq_len, 2, 3)[:, :, :], \
-                    obj_verts.reshape(bs*seq_len, -1, 3)) # (BS*T) X 2 X N_object 
-        dists, _ = torch.min(dists, 2) # (BS*T) X 2
+        if self.use_sdf_contact_guidance:
+            # Nearest-surface distances from the object's SDF, the cost does not depend on the mesh size. 
+            surface_query = ObjectSurfaceQuery(self.object_sdf, self.object_sdf_centroid, self.object_sdf_extents)
+            query_obj_rot_mat = transforms.quaternion_to_matrix(transforms.matrix_to_quaternion(pred_obj_rot_mat)) # Same rotation as object vertices. 
+            dists = surface_query.query_unsigned(contact_points, query_obj_rot_mat, pred_seq_com_pos) # BS X T X 2 
+            dists = dists.reshape(bs*seq_len, 2) # (BS*T) X 2
+        else:
+            # Need to downsample object vertices sometimes. 
+            num_obj_verts = obj_verts.shape[2]
+            if num_obj_verts > 30000:
+                downsample_rate = num_obj_verts//30000 + 1 
+                obj_verts = obj_verts[:, :, ::downsample_rate, :] 
+
+            # print("Object # vertices:{0}".format(obj_verts.shape)) 
+            dists = torch.cdist(contact_points.reshape(bs*seq_len, 2, 3)[:, :, :], \
+                        obj_verts.reshape(bs*seq_len, -1, 3)) # (BS*T) X 2 X N_object 
+            dists, _ = torch.min(dists, 2) # (BS*T) X 2
 
         pred_contact_semantic = pred_clean_x[:, :, -4:-2] # BS X T X 2
         contact_labels = pred_contact_semantic > 0.95 
@@ -2149,11 +2337,11 @@ class Trainer(object):
         if self.test_unseen_objects:
             test_loader = torch.utils.data.DataLoader(
                 self.unseen_seq_ds, batch_size=1, shuffle=False,
-                num_workers=0, pin_memory=True, drop_last=False) 
+                num_workers=0, pin_memory=(self.device.type == "cuda"), drop_last=False) 
         else:
             test_loader = torch.utils.data.DataLoader(
                 self.whole_seq_ds, batch_size=1, shuffle=False,
-                num_workers=0, pin_memory=True, drop_last=False) 
+                num_workers=0, pin_memory=(self.device.type == "cuda"), drop_last=False) 
             
         overlap_frame_num = 10
 
@@ -2227,13 +2415,11 @@ class Trainer(object):
 
             num_planned_path = len(planned_paths_list)
 
+            # Prepare the inputs of all planned paths first, then generate the paths with the same number of frames 
+            # together so that window k of all of them is denoised in one batched call. 
+            path_input_list = [] 
             for p_idx in range(num_planned_path):
 
-                video_paths = [] 
-
-                curr_seq_name_tag = self.test_scene_name + "_" + seq_name_list[0] + \
-                "_" + object_name_list[0]+ "_pidx_" + str(p_idx) + "_sample_cnt_0"
-
                 if ("lift" not in text_list[p_idx]) and ("Lift" not in text_list[p_idx]):
                     continue 
 
@@ -2245,7 +2431,7 @@ class Trainer(object):
                 # planned_obj_path: K X 3
                 # To convert the planned path back to the original one, need to apply inverse(cano_quat). 
 
-                rest_human_offsets = val_data_dict['rest_human_offsets'].cuda() # BS X 24 X 3 
+                rest_human_offsets = val_data_dict['rest_human_offsets'].to(self.device) # BS X 24 X 3 
 
                 # planned_path_floor_height = planned_obj_path[0, -1] # In visualization, put the interaction from floor z = 0 to this value. 
                 planned_path_floor_height = scene_floor_h_dict[self.test_scene_name] 
@@ -2260,24 +2446,21 @@ class Trainer(object):
                 waypoints2start_trans = planned_obj_path[1:, :] - planned_obj_path[0:1, :] # (K-1) X 3 
                 end2start_trans = planned_obj_path[-1:, :] - planned_obj_path[0:1, :] # 1 X 3 
 
-                val_human_data = val_data_dict['motion'].cuda() 
-                val_normalized_obj_data = val_data_dict['obj_motion'].cuda() # Only need the first frame. 
-                val_ori_obj_data = val_data_dict['ori_obj_motion'].cuda() # BS X T X (3+9)
+                val_human_data = val_data_dict['motion'].to(self.device) 
+                val_normalized_obj_data = val_data_dict['obj_motion'].to(self.device) # Only need the first frame. 
+                val_ori_obj_data = val_data_dict['ori_obj_motion'].to(self.device) # BS X T X (3+9)
 
                 start_obj_com_pos = val_ori_obj_data[:, 0:1, :3] # BS X 1 X 3 
                 move2aligned_planned_path = start_obj_pos_on_planned_path[None].to(start_obj_com_pos.device) - \
                         start_obj_com_pos # BS X 1 X 3 
                 move2aligned_planned_path[:, :, 2] = planned_path_floor_height 
 
-                self.move_to_planned_path_in_scene = move2aligned_planned_path.clone() 
-                self.cano_quat_in_scene = cano_quat.clone()  
-
-                end_obj_com_pos = start_obj_com_pos + end2start_trans[None, :, :].cuda() # BS X 1 X 3
+                end_obj_com_pos = start_obj_com_pos + end2start_trans[None, :, :].to(self.device) # BS X 1 X 3
 
-                seq_obj_com_pos = torch.zeros(start_obj_com_pos.shape[0], (planned_obj_path.shape[0]-1)*30, 3).cuda() 
+                seq_obj_com_pos = torch.zeros(start_obj_com_pos.shape[0], (planned_obj_path.shape[0]-1)*30, 3).to(self.device) 
                 seq_obj_com_pos[:, 0:1, :] = start_obj_com_pos.clone() 
                 
-                waypoints_com_pos = start_obj_com_pos + waypoints2start_trans[None, :, :].cuda() # BS X (K-1) X 3
+                waypoints_com_pos = start_obj_com_pos + waypoints2start_trans[None, :, :].to(self.device) # BS X (K-1) X 3
 
                 waypoints_com_pos_for_vis = waypoints_com_pos.clone()
 
@@ -2326,7 +2509,7 @@ class Trainer(object):
                 # Reaplce the first frame's object rotation. 
                 val_obj_data[:, 0:1, 3:] = val_normalized_obj_data[:, 0:1, 3:] 
 
-                obj_bps_data = val_data_dict['input_obj_bps'].cuda().reshape(-1, 1, 1024*3)
+                obj_bps_data = val_data_dict['input_obj_bps'].to(self.device).reshape(-1, 1, 1024*3)
              
                 ori_data_cond = obj_bps_data 
 
@@ -2340,7 +2523,7 @@ class Trainer(object):
                 tmp_mask = torch.arange(self.window+1).expand(val_human_data.shape[0], \
                         self.window+1) < actual_seq_len
                         # BS X max_timesteps
-                padding_mask = tmp_mask[:, None, :].cuda() # 1 X 1 X 121 
+                padding_mask = tmp_mask[:, None, :].to(self.device) # 1 X 1 X 121 
 
                 # padding_mask = None 
 
@@ -2357,147 +2540,215 @@ class Trainer(object):
                     human_cond_mask[:, 0, :] = 0 
                 cond_mask = torch.cat((cond_mask, human_cond_mask), dim=-1) # BS X T X (3+6+24*3+22*6)
 
-                if self.use_guidance_in_denoising:
-                    # Actually used. 
-                    self.object_sdf, self.object_sdf_centroid, self.object_sdf_extents = \
-                    self.load_object_sdf_data(val_data_dict['obj_name'][0])
-                    guidance_fn = self.apply_different_guidance_loss
+                tmp_val_human_data = torch.cat((val_human_data[:, 0:1, :], torch.zeros(val_human_data.shape[0], \
+                            val_obj_data.shape[1]-1, val_human_data.shape[-1]).to(val_obj_data.device)), dim=1)
+
+                if self.use_object_keypoints:
+                    contact_data = torch.zeros(val_obj_data.shape[0], \
+                            val_obj_data.shape[1], 4).to(val_obj_data.device) 
+                    data = torch.cat((val_obj_data, tmp_val_human_data, contact_data), dim=-1) 
+                    cond_mask = torch.cat((cond_mask, \
+                            torch.ones(cond_mask.shape[0], cond_mask.shape[1], \
+                            4).to(cond_mask.device)), dim=-1) 
                 else:
-                    guidance_fn = None 
+                    data = torch.cat((val_obj_data, tmp_val_human_data), dim=-1)
+
+                path_input_dict = {}
+                path_input_dict['p_idx'] = p_idx 
+                path_input_dict['data'] = data # 1 X T X D 
+                path_input_dict['cond_mask'] = cond_mask 
+                path_input_dict['padding_mask'] = padding_mask 
+                path_input_dict['ori_data_cond'] = ori_data_cond 
+                path_input_dict['contact_labels'] = contact_labels # 1 X T 
+                if self.add_language_condition:
+                    path_input_dict['text_clip_feats_list'] = text_clip_feats_list 
+                path_input_dict['seq_obj_com_pos'] = seq_obj_com_pos 
+                path_input_dict['cano_quat'] = cano_quat 
+                path_input_dict['planned_scene_names'] = planned_scene_names 
+                path_input_dict['planned_path_floor_height'] = planned_path_floor_height 
+                path_input_dict['move2aligned_planned_path'] = move2aligned_planned_path 
+                path_input_dict['end_obj_com_pos'] = end_obj_com_pos 
+                path_input_dict['waypoints_com_pos'] = waypoints_com_pos 
+                path_input_dict['waypoints_com_pos_for_vis'] = waypoints_com_pos_for_vis 
+                path_input_list.append(path_input_dict)
 
-                num_samples_per_seq = 1
-                for sample_idx in range(num_samples_per_seq):
-                    # data = torch.cat((val_obj_data, val_human_data), dim=-1)
-                    tmp_val_human_data = torch.cat((val_human_data[:, 0:1, :], torch.zeros(val_human_data.shape[0], \
-                                val_obj_data.shape[1]-1, val_human_data.shape[-1]).to(val_obj_data.device)), dim=1)
-                    # data = torch.cat((val_obj_data, torch.zeros(val_human_data.shape[0], \
-                                # val_obj_data.shape[1], val_human_data.shape[-1]).to(val_obj_data.device)), dim=-1)
-                
+            if self.use_guidance_in_denoising:
+                # Actually used. All the paths of this sequence share the same object. 
+                self.object_sdf, self.object_sdf_centroid, self.object_sdf_extents = \
+                self.load_object_sdf_data(val_data_dict['obj_name'][0])
+                guidance_fn = self.apply_different_guidance_loss
+            else:
+                guidance_fn = None 
 
-                    if self.use_object_keypoints:
-                        contact_data = torch.zeros(val_obj_data.shape[0], \
-                                val_obj_data.shape[1], 4).to(val_obj_data.device) 
-                        data = torch.cat((val_obj_data, tmp_val_human_data, contact_data), dim=-1) 
-                        cond_mask = torch.cat((cond_mask, \
-                                torch.ones(cond_mask.shape[0], cond_mask.shape[1], \
-                                4).to(cond_mask.device)), dim=-1) 
-                    else:
-                        data = torch.cat((val_obj_data, tmp_val_human_data), dim=-1)
+            path_group_dict = {} 
+            for path_input_dict in path_input_list:
+                num_frames = path_input_dict['data'].shape[1]
+                if num_frames not in path_group_dict:
+                    path_group_dict[num_frames] = []
+                path_group_dict[num_frames].append(path_input_dict)
+
+            batch_path_input_lists = [] 
+            for num_frames in path_group_dict:
+                curr_group_list = path_group_dict[num_frames]
+                for b_idx in range(0, len(curr_group_list), self.long_seq_batch_size):
+                    batch_path_input_lists.append(curr_group_list[b_idx:b_idx+self.long_seq_batch_size])
+
+            for batch_path_input_list in batch_path_input_lists:
+                num_paths = len(batch_path_input_list)
+
+                data = torch.cat([path_input_dict['data'] for path_input_dict in batch_path_input_list], dim=0) # N X T X D 
+                cond_mask = torch.cat([path_input_dict['cond_mask'] for path_input_dict in batch_path_input_list], dim=0) 
+                padding_mask = torch.cat([path_input_dict['padding_mask'] for path_input_dict in batch_path_input_list], dim=0) 
+                ori_data_cond = torch.cat([path_input_dict['ori_data_cond'] for path_input_dict in batch_path_input_list], dim=0) 
+                contact_labels = torch.cat([path_input_dict['contact_labels'] for path_input_dict in batch_path_input_list], dim=0) # N X T 
+
+                if self.add_language_condition:
+                    num_windows = len(batch_path_input_list[0]['text_clip_feats_list'])
+                    text_clip_feats_list = [] 
+                    for w_idx in range(num_windows):
+                        text_clip_feats_list.append(torch.cat([path_input_dict['text_clip_feats_list'][w_idx] \
+                                    for path_input_dict in batch_path_input_list], dim=0)) # N X 512 
 
+                # The paths share the sequence's object and human, repeat them along the batch. 
+                batch_obj_names = list(val_data_dict['obj_name']) * num_paths 
+                batch_trans2joint = val_data_dict['trans2joint'].repeat(num_paths, 1) # N X 3 
+                batch_rest_human_offsets = rest_human_offsets.repeat(num_paths, 1, 1) # N X 24 X 3 
 
+                num_samples_per_seq = 1
+                for sample_idx in range(num_samples_per_seq):
                     if self.add_language_condition: # Not ready yet. 
                         if self.test_unseen_objects:
                             input_ds = self.unseen_seq_ds
                         else:
                             input_ds = self.ds 
-                        all_res_list = self.ema.ema_model.sample_sliding_window_w_canonical(input_ds, \
-                            val_data_dict['obj_name'], val_data_dict['trans2joint'], \
+                        batch_res_list = self.ema.ema_model.sample_sliding_window_w_canonical(input_ds, \
+                            batch_obj_names, batch_trans2joint, \
                             data, ori_data_cond, cond_mask, padding_mask, overlap_frame_num, \
                             input_waypoints=True, language_input=text_clip_feats_list, \
                             contact_labels=contact_labels, \
-                            rest_human_offsets=rest_human_offsets, guidance_fn=guidance_fn, \
+                            rest_human_offsets=batch_rest_human_offsets, guidance_fn=guidance_fn, \
                             data_dict=val_data_dict)
+                    # N X T X D 
+
+                    for path_input_dict, all_res_list in zip(batch_path_input_list, batch_res_list):
+                        all_res_list = all_res_list[None] # 1 X T X D 
+
+                        video_paths = [] 
+
+                        p_idx = path_input_dict['p_idx']
+                        cond_mask = path_input_dict['cond_mask']
+                        seq_obj_com_pos = path_input_dict['seq_obj_com_pos']
+                        cano_quat = path_input_dict['cano_quat']
+                        planned_scene_names = path_input_dict['planned_scene_names']
+                        planned_path_floor_height = path_input_dict['planned_path_floor_height']
+                        move2aligned_planned_path = path_input_dict['move2aligned_planned_path']
+                        end_obj_com_pos = path_input_dict['end_obj_com_pos']
+                        waypoints_com_pos = path_input_dict['waypoints_com_pos']
+                        waypoints_com_pos_for_vis = path_input_dict['waypoints_com_pos_for_vis']
+
+                        self.move_to_planned_path_in_scene = move2aligned_planned_path.clone() 
+                        self.cano_quat_in_scene = cano_quat.clone()  
+
+                        # vis_tag = str(milestone)+"_final_long_seq_w_planned_waypoints_"+"_sidx_"+str(s_idx)+"_sample_cnt_"+str(sample_idx)
                     
-                    # vis_tag = str(milestone)+"_final_long_seq_w_planned_waypoints_"+"_sidx_"+str(s_idx)+"_sample_cnt_"+str(sample_idx)
-                    
-                    vis_tag = str(milestone)+"_"+self.test_scene_name+"_sidx_"+str(s_idx)+"_long_seq_"+"_pidx_"+str(p_idx)+"_sample_cnt_"+str(sample_idx)
-                    if self.test_on_train:
-                        vis_tag = vis_tag + "_on_train"
+                        vis_tag = str(milestone)+"_"+self.test_scene_name+"_sidx_"+str(s_idx)+"_long_seq_"+"_pidx_"+str(p_idx)+"_sample_cnt_"+str(sample_idx)
+                        if self.test_on_train:
+                            vis_tag = vis_tag + "_on_train"
 
-                    if self.use_guidance_in_denoising:
-                        vis_tag = vis_tag + "_all_guidance"
+                        if self.use_guidance_in_denoising:
+                            vis_tag = vis_tag + "_all_guidance"
 
-                    if self.test_unseen_objects:
-                        vis_tag = vis_tag + "_unseen_object"
+                        if self.test_unseen_objects:
+                            vis_tag = vis_tag + "_unseen_object"
 
-                    if self.use_object_keypoints:
-                        all_res_list = all_res_list[:, :, :-4]
-
-
-                    curr_seq_name_tag = self.test_scene_name + "_" + seq_name_list[0] + "_" + object_name_list[0]+ "_pidx_" + str(p_idx) + "_sample_cnt_" + str(sample_idx)
-
-                    dest_text_json_path = os.path.join(dest_out_text_json_folder, curr_seq_name_tag+".json")
-                    dest_text_json_dict = {}
-                    dest_text_json_dict['text'] = text_list[p_idx]
-                    if not os.path.exists(dest_text_json_path):
-                        json.dump(dest_text_json_dict, open(dest_text_json_path, 'w'))
-
-                    curr_dest_out_mesh_folder = os.path.join(dest_out_obj_folder, curr_seq_name_tag)
-                    curr_dest_out_mesh_topview_folder = os.path.join(dest_out_obj_folder, curr_seq_name_tag+"_topview")
-
-                    curr_dest_out_vid_path = os.path.join(dest_out_vis_folder, curr_seq_name_tag+".mp4")
-                    curr_dest_out_vid_topview_path = os.path.join(dest_out_vis_folder, curr_seq_name_tag+"_topview.mp4")
-
-                    # For visualization on 3D scene. 
-                    if not self.compute_metrics:
-                        self.gen_vis_res_generic(all_res_list, val_data_dict, milestone, cond_mask, \
-                                    vis_tag=vis_tag, planned_end_obj_com=end_obj_com_pos+move2aligned_planned_path, \
-                                    move_to_planned_path=move2aligned_planned_path, \
-                                    planned_waypoints_pos=waypoints_com_pos+move2aligned_planned_path, \
-                                    planned_scene_names=planned_scene_names, \
-                                    planned_path_floor_height=planned_path_floor_height, \
-                                    cano_quat=cano_quat, dest_out_vid_path=curr_dest_out_vid_topview_path, \
-                                    dest_mesh_vis_folder=curr_dest_out_mesh_topview_folder, save_obj_only=True) 
-
-                    # For visualization on empty floor. 
-                    pred_human_verts_list, pred_human_jnts_list, pred_human_trans_list, pred_human_rot_list, \
-                    pred_obj_com_pos_list, pred_obj_rot_mat_list, pred_obj_verts_list, \
-                    _, _, _ = self.gen_vis_res_generic(all_res_list, val_data_dict, milestone, cond_mask, \
-                            vis_tag=vis_tag, planned_end_obj_com=end_obj_com_pos, \
-                            planned_waypoints_pos=waypoints_com_pos_for_vis, \
-                            vis_wo_scene=True, gen_long_seq=True, dest_out_vid_path=curr_dest_out_vid_path, \
-                            dest_mesh_vis_folder=curr_dest_out_mesh_folder, save_obj_only=False)  
-
-                    video_paths.append(curr_dest_out_vid_path)
-
-                    mesh_save_folders_str = "&".join([curr_dest_out_mesh_folder])
-                    # initial_obj_paths = "&".join(initial_obj_paths)
-                    use_guidance_str = "1" if self.use_guidance_in_denoising else "0"
-                    interaction_epoch = milestone
-                    video_save_dir_name = os.path.join(self.save_res_folder, "long_seq_res_videos")
-                    if not os.path.exists(video_save_dir_name):
-                        os.makedirs(video_save_dir_name) 
-                    # video_save_dir_name = os.path.join("visualizer_results", opt.vis_wdir)
-
-                    ori_seq_obj_com_pos = self.val_ds.de_normalize_obj_pos_min_max(seq_obj_com_pos)
-                    foot_sliding_jnts, floor_height, contact_percent, \
-                    start_obj_com_pos_err, end_obj_com_pos_err, waypoints_xy_pos_err = \
-                            compute_metrics_long_seq(pred_human_jnts_list[0], \
-                            pred_obj_com_pos_list[0], pred_obj_rot_mat_list[0], \
-                            pred_obj_verts_list[0], \
-                            ori_seq_obj_com_pos[0], cond_mask)
-
-                    pred_hand_penetration_score = self.compute_hand_penetration_metric(object_name_list[0], \
-                                    pred_human_verts_list[0], \
-                                    pred_obj_com_pos_list[0], pred_obj_rot_mat_list[0])
-               
-                    pred_penetration_score = self.compute_hand_penetration_metric(object_name_list[0], \
+                        if self.use_object_keypoints:
+                            all_res_list = all_res_list[:, :, :-4]
+
+
+                        curr_seq_name_tag = self.test_scene_name + "_" + seq_name_list[0] + "_" + object_name_list[0]+ "_pidx_" + str(p_idx) + "_sample_cnt_" + str(sample_idx)
+
+                        dest_text_json_path = os.path.join(dest_out_text_json_folder, curr_seq_name_tag+".json")
+                        dest_text_json_dict = {}
+                        dest_text_json_dict['text'] = text_list[p_idx]
+                        if not os.path.exists(dest_text_json_path):
+                            json.dump(dest_text_json_dict, open(dest_text_json_path, 'w'))
+
+                        curr_dest_out_mesh_folder = os.path.join(dest_out_obj_folder, curr_seq_name_tag)
+                        curr_dest_out_mesh_topview_folder = os.path.join(dest_out_obj_folder, curr_seq_name_tag+"_topview")
+
+                        curr_dest_out_vid_path = os.path.join(dest_out_vis_folder, curr_seq_name_tag+".mp4")
+                        curr_dest_out_vid_topview_path = os.path.join(dest_out_vis_folder, curr_seq_name_tag+"_topview.mp4")
+
+                        # For visualization on 3D scene. 
+                        if not self.compute_metrics:
+                            self.gen_vis_res_generic(all_res_list, val_data_dict, milestone, cond_mask, \
+                                        vis_tag=vis_tag, planned_end_obj_com=end_obj_com_pos+move2aligned_planned_path, \
+                                        move_to_planned_path=move2aligned_planned_path, \
+                                        planned_waypoints_pos=waypoints_com_pos+move2aligned_planned_path, \
+                                        planned_scene_names=planned_scene_names, \
+                                        planned_path_floor_height=planned_path_floor_height, \
+                                        cano_quat=cano_quat, dest_out_vid_path=curr_dest_out_vid_topview_path, \
+                                        dest_mesh_vis_folder=curr_dest_out_mesh_topview_folder, save_obj_only=True) 
+
+                        # For visualization on empty floor. 
+                        pred_human_verts_list, pred_human_jnts_list, pred_human_trans_list, pred_human_rot_list, \
+                        pred_obj_com_pos_list, pred_obj_rot_mat_list, pred_obj_verts_list, \
+                        _, _, _ = self.gen_vis_res_generic(all_res_list, val_data_dict, milestone, cond_mask, \
+                                vis_tag=vis_tag, planned_end_obj_com=end_obj_com_pos, \
+                                planned_waypoints_pos=waypoints_com_pos_for_vis, \
+                                vis_wo_scene=True, gen_long_seq=True, dest_out_vid_path=curr_dest_out_vid_path, \
+                                dest_mesh_vis_folder=curr_dest_out_mesh_folder, save_obj_only=False)  
+
+                        video_paths.append(curr_dest_out_vid_path)
+
+                        mesh_save_folders_str = "&".join([curr_dest_out_mesh_folder])
+                        # initial_obj_paths = "&".join(initial_obj_paths)
+                        use_guidance_str = "1" if self.use_guidance_in_denoising else "0"
+                        interaction_epoch = milestone
+                        video_save_dir_name = os.path.join(self.save_res_folder, "long_seq_res_videos")
+                        if not os.path.exists(video_save_dir_name):
+                            os.makedirs(video_save_dir_name) 
+                        # video_save_dir_name = os.path.join("visualizer_results", opt.vis_wdir)
+
+                        ori_seq_obj_com_pos = self.val_ds.de_normalize_obj_pos_min_max(seq_obj_com_pos)
+                        foot_sliding_jnts, floor_height, contact_percent, \
+                        start_obj_com_pos_err, end_obj_com_pos_err, waypoints_xy_pos_err = \
+                                compute_metrics_long_seq(pred_human_jnts_list[0], \
+                                pred_obj_com_pos_list[0], pred_obj_rot_mat_list[0], \
+                                pred_obj_verts_list[0], \
+                                ori_seq_obj_com_pos[0], cond_mask)
+
+                        pred_hand_penetration_score = self.compute_hand_penetration_metric(object_name_list[0], \
                                         pred_human_verts_list[0], \
-                                        pred_obj_com_pos_list[0], pred_obj_rot_mat_list[0], \
-                                        eval_fullbody=True)
-
-                    # (Pdb) pred_human_verts_list[0].shape
-                    # torch.Size([230, 10475, 3])
-                    # pred_obj_verts_list[0].shape  T X Nv X 3 
-                    pred_human_verts_sampled = pred_human_verts_list[0][:, ::10, :].reshape(-1, 3)[None] # 1 X (T*Nv) X 3 
-                    pred_obj_verts_sampled = pred_obj_verts_list[0].reshape(-1, 3)[None] # 1 X (T*No) X 3 
-                    scene_human_penetration_score = self.compute_scene_penetration_score(pred_human_verts_sampled.detach()).detach().cpu().numpy() 
-                    scene_object_penetration_score = self.compute_scene_penetration_score(pred_obj_verts_sampled.detach()).detach().cpu().numpy()
-
-                    self.append_new_value_to_metrics_list_for_long_seq(foot_sliding_jnts, \
-                        floor_height, contact_percent, \
-                        start_obj_com_pos_err, end_obj_com_pos_err, waypoints_xy_pos_err, \
-                        pred_penetration_score, pred_hand_penetration_score, \
-                        scene_human_penetration_score, scene_object_penetration_score) 
-
-                    # curr_seq_name_tag = seq_name_list[0] + "_" + object_name_list[0] + "_sample_cnt_" + str(sample_idx)
-                    print("Current Sequence name:{0}".format(curr_seq_name_tag))
-                    self.print_evaluation_metrics_for_long_seq([foot_sliding_jnts], \
-                    [floor_height], [contact_percent], \
-                    [start_obj_com_pos_err], [end_obj_com_pos_err], [waypoints_xy_pos_err], \
-                    [pred_penetration_score], [pred_hand_penetration_score], \
-                    [scene_human_penetration_score], [scene_object_penetration_score], \
-                    dest_metric_folder, curr_seq_name_tag)
+                                        pred_obj_com_pos_list[0], pred_obj_rot_mat_list[0])
+               
+                        pred_penetration_score = self.compute_hand_penetration_metric(object_name_list[0], \
+                                            pred_human_verts_list[0], \
+                                            pred_obj_com_pos_list[0], pred_obj_rot_mat_list[0], \
+                                            eval_fullbody=True)
+
+                        # (Pdb) pred_human_verts_list[0].shape
+                        # torch.Size([230, 10475, 3])
+                        # pred_obj_verts_list[0].shape  T X Nv X 3 
+                        pred_human_verts_sampled = pred_human_verts_list[0][:, ::10, :].reshape(-1, 3)[None] # 1 X (T*Nv) X 3 
+                        pred_obj_verts_sampled = pred_obj_verts_list[0].reshape(-1, 3)[None] # 1 X (T*No) X 3 
+                        scene_human_penetration_score = self.compute_scene_penetration_score(pred_human_verts_sampled.detach()).detach().cpu().numpy() 
+                        scene_object_penetration_score = self.compute_scene_penetration_score(pred_obj_verts_sampled.detach()).detach().cpu().numpy()
+
+                        self.append_new_value_to_metrics_list_for_long_seq(foot_sliding_jnts, \
+                            floor_height, contact_percent, \
+                            start_obj_com_pos_err, end_obj_com_pos_err, waypoints_xy_pos_err, \
+                            pred_penetration_score, pred_hand_penetration_score, \
+                            scene_human_penetration_score, scene_object_penetration_score) 
+
+                        # curr_seq_name_tag = seq_name_list[0] + "_" + object_name_list[0] + "_sample_cnt_" + str(sample_idx)
+                        print("Current Sequence name:{0}".format(curr_seq_name_tag))
+                        self.print_evaluation_metrics_for_long_seq([foot_sliding_jnts], \
+                        [floor_height], [contact_percent], \
+                        [start_obj_com_pos_err], [end_obj_com_pos_err], [waypoints_xy_pos_err], \
+                        [pred_penetration_score], [pred_hand_penetration_score], \
+                        [scene_human_penetration_score], [scene_object_penetration_score], \
+                        dest_metric_folder, curr_seq_name_tag)
 
         self.print_evaluation_metrics_for_long_seq(self.foot_sliding_jnts_list_long_seq, \
                 self.floor_height_list_long_seq, \
@@ -2509,6 +2760,8 @@ class Trainer(object):
                 self.scene_human_penetration_list_long_seq, self.scene_object_penetration_list_long_seq, \
                 dest_metric_folder)  
 
+        self.flush_mesh_writer()
+
     def create_ball_mesh(self, center_pos, ball_mesh_path):
         # center_pos: K X 3  
         ball_color = np.asarray([22, 173, 100]) # green 
@@ -2529,15 +2782,39 @@ class Trainer(object):
             output_file.close()
     
     def export_to_mesh(self, mesh_verts, mesh_faces, mesh_path):
-        dest_mesh = trimesh.Trimesh(
-            vertices=mesh_verts,
-            faces=mesh_faces,
-            process=False)
+        if torch.is_tensor(mesh_verts):
+            mesh_verts = mesh_verts.detach().cpu().numpy()
+
+        if self.mesh_writer is not None:
+            self.mesh_writer.submit(write_ply, mesh_verts, mesh_faces, mesh_path)
+        else:
+            write_ply(mesh_verts, mesh_faces, mesh_path)
+
+    def save_mesh_sequence(self, mesh_verts, mesh_faces, obj_verts, obj_faces, save_mesh_folder):
+        # Same as save_verts_faces_to_mesh_file_w_object, written in the background when the writer is enabled. 
+        if self.mesh_writer is not None:
+            self.mesh_writer.submit(save_verts_faces_to_mesh_file_w_object, mesh_verts, mesh_faces, \
+                        obj_verts, obj_faces, save_mesh_folder)
+        else:
+            save_verts_faces_to_mesh_file_w_object(mesh_verts, mesh_faces, obj_verts, obj_faces, save_mesh_folder)
+
+    def render_vis_video(self, mesh_save_folder, out_rendered_img_folder, out_vid_path, condition_folder, \
+            scene_blend_path, human_verts, human_faces, obj_verts, obj_faces, condition_pts):
+        # human_verts: T X Nv X 3, obj_verts: T X No X 3, numpy arrays, the same meshes that are saved to mesh_save_folder. 
+        # condition_pts: K X 3, the waypoints saved to condition_folder. 
+        if self.preview_renderer is not None:
+            if torch.is_tensor(condition_pts):
+                condition_pts = condition_pts.detach().cpu().numpy()
+            self.preview_renderer.render_to_video(human_verts, human_faces, obj_verts, obj_faces, out_vid_path, \
+                condition_pts=condition_pts)
+        else:
+            run_blender_rendering_and_save2video(mesh_save_folder, out_rendered_img_folder, out_vid_path, \
+                condition_folder=condition_folder, vis_object=True, vis_condition=True, \
+                scene_blend_path=scene_blend_path)
 
-        result = trimesh.exchange.ply.export_ply(dest_mesh, encoding='ascii')
-        output_file = open(mesh_path, "wb+")
-        output_file.write(result)
-        output_file.close()
+    def flush_mesh_writer(self):
+        if self.mesh_writer is not None:
+            self.mesh_writer.flush()
 
     def plot_arr(self, t_vec, pred_val, gt_val, dest_path):
         plt.plot(t_vec, gt_val, color='green', label="gt")
@@ -2596,7 +2873,25 @@ class Trainer(object):
             seq_len = seq_len.repeat(num_seq) # N 
         seq_len = seq_len.detach().cpu().numpy() # N 
 
+        num_data = data_dict['betas'].shape[0] # BS, N = BS * num_samples_per_seq 
+
+        # When only evaluation meshes are needed, run SMPL-X for all the sequences at once. 
+        # Both run_smplx_model and the batched layer group the frames by gender internally. 
+        use_batch_smplx = (self.compute_metrics or self.smplx_layer is not None) and num_seq > 1 \
+                and num_seq == trans2joint.shape[0]
+        if use_batch_smplx:
+            batch_local_rot_mat = quat_ik_torch(global_rot_mat.reshape(-1, 22, 3, 3)) # (N*T) X 22 X 3 X 3 
+            batch_local_rot_aa_rep = transforms.matrix_to_axis_angle(batch_local_rot_mat).reshape(num_seq, \
+                                -1, 22, 3) # N X T X 22 X 3 
+            batch_root_trans = global_root_jpos + trans2joint[:, None, :].to(global_root_jpos.device) # N X T X 3 
+            batch_betas = data_dict['betas'][:, 0] # N X 16 
+            batch_gender = [data_dict['gender'][tmp_idx] for tmp_idx in range(num_seq)]
+            batch_mesh_jnts, batch_mesh_verts, batch_mesh_faces = \
+                self.run_body_model(batch_root_trans.to(self.device), batch_local_rot_aa_rep.to(self.device), \
+                batch_betas.to(self.device), batch_gender, self.ds.bm_dict)
+
         for idx in range(num_seq):
+            data_idx = idx % num_data 
             curr_global_rot_mat = global_rot_mat[idx] # T X 22 X 3 X 3 
             curr_local_rot_mat = quat_ik_torch(curr_global_rot_mat) # T X 22 X 3 X 3 
             curr_local_rot_aa_rep = transforms.matrix_to_axis_angle(curr_local_rot_mat) # T X 22 X 3 
@@ -2609,11 +2904,11 @@ class Trainer(object):
 
             # Generate global joint position 
             bs = 1
-            betas = data_dict['betas'][0]
-            gender = data_dict['gender'][0]
+            betas = data_dict['betas'][data_idx]
+            gender = data_dict['gender'][data_idx]
             
-            curr_gt_obj_rot_mat = data_dict['obj_rot_mat'][0] # T X 3 X 3
-            curr_gt_obj_com_pos = data_dict['obj_com_pos'][0] # T X 3 
+            curr_gt_obj_rot_mat = data_dict['obj_rot_mat'][data_idx] # T X 3 X 3
+            curr_gt_obj_com_pos = data_dict['obj_com_pos'][data_idx] # T X 3 
             
             curr_obj_rot_mat = pred_obj_rot_mat[idx] # T X 3 X 3 
             curr_obj_quat = transforms.matrix_to_quaternion(curr_obj_rot_mat)
@@ -2622,13 +2917,18 @@ class Trainer(object):
             if curr_object_name is not None: 
                 object_name = curr_object_name 
             else:
-                curr_seq_name = data_dict['seq_name'][0]
-                object_name = data_dict['obj_name'][0]
+                curr_seq_name = data_dict['seq_name'][data_idx]
+                object_name = data_dict['obj_name'][data_idx]
           
             # Get human verts 
-            mesh_jnts, mesh_verts, mesh_faces = \
-                run_smplx_model(root_trans[None].cuda(), curr_local_rot_aa_rep[None].cuda(), \
-                betas.cuda(), [gender], self.ds.bm_dict, return_joints24=True)
+            if use_batch_smplx:
+                mesh_jnts = batch_mesh_jnts[idx:idx+1] # 1 X T X 24 X 3 
+                mesh_verts = batch_mesh_verts[idx:idx+1] # 1 X T X Nv X 3 
+                mesh_faces = batch_mesh_faces 
+            else:
+                mesh_jnts, mesh_verts, mesh_faces = \
+                    self.run_body_model(root_trans[None].to(self.device), curr_local_rot_aa_rep[None].to(self.device), \
+                    betas.to(self.device), [gender], self.ds.bm_dict)
 
             if self.test_unseen_objects:
                 # Get object verts 
@@ -2776,17 +3076,24 @@ class Trainer(object):
                 mesh_verts = transforms.quaternion_apply(cano_quat_for_human.to(mesh_verts.device), mesh_verts[0])
                 obj_mesh_verts = transforms.quaternion_apply(cano_quat_for_obj.to(obj_mesh_verts.device), obj_mesh_verts) 
 
-                save_verts_faces_to_mesh_file_w_object(mesh_verts.detach().cpu().numpy(), mesh_faces.detach().cpu().numpy(), \
-                        obj_mesh_verts.detach().cpu().numpy(), obj_mesh_faces, mesh_save_folder)
+                vis_human_verts = mesh_verts.detach().cpu().numpy()
+                vis_obj_verts = obj_mesh_verts.detach().cpu().numpy()
             else:
                 if gen_long_seq:
-                    save_verts_faces_to_mesh_file_w_object(mesh_verts.detach().cpu().numpy()[0], \
-                            mesh_faces.detach().cpu().numpy(), \
-                            obj_mesh_verts.detach().cpu().numpy(), obj_mesh_faces, mesh_save_folder)
+                    vis_human_verts = mesh_verts.detach().cpu().numpy()[0]
+                    vis_obj_verts = obj_mesh_verts.detach().cpu().numpy()
                 else: # For single window
-                    save_verts_faces_to_mesh_file_w_object(mesh_verts.detach().cpu().numpy()[0][:seq_len[idx]], \
-                            mesh_faces.detach().cpu().numpy(), \
-                            obj_mesh_verts.detach().cpu().numpy()[:seq_len[idx]], obj_mesh_faces, mesh_save_folder)
+                    vis_human_verts = mesh_verts.detach().cpu().numpy()[0][:seq_len[idx]]
+                    vis_obj_verts = obj_mesh_verts.detach().cpu().numpy()[:seq_len[idx]]
+            vis_human_faces = mesh_faces.detach().cpu().numpy()
+
+            # The preview renderer works on the arrays directly, mesh files are only needed for Blender. 
+            if self.preview_renderer is None or save_obj_only:
+                self.save_mesh_sequence(vis_human_verts, vis_human_faces, vis_obj_verts, obj_mesh_faces, mesh_save_folder)
+
+            # Blender reads the mesh files back, wait for the pending writes. 
+            if not save_obj_only:
+                self.flush_mesh_writer()
 
             # continue 
             if move_to_planned_path is not None:
@@ -2797,9 +3104,9 @@ class Trainer(object):
                 curr_scene_blend_path = os.path.join(root_blend_file_folder, self.test_scene_name+"_topview.blend")
                 # if not os.path.exists(dest_out_vid_path):
                 if not save_obj_only:
-                    run_blender_rendering_and_save2video(mesh_save_folder, out_rendered_img_folder, out_vid_file_path, \
-                            condition_folder=ball_mesh_save_folder, vis_object=True, vis_condition=True, \
-                            scene_blend_path=curr_scene_blend_path) 
+                    self.render_vis_video(mesh_save_folder, out_rendered_img_folder, out_vid_file_path, \
+                            ball_mesh_save_folder, curr_scene_blend_path, \
+                            vis_human_verts, vis_human_faces, vis_obj_verts, obj_mesh_faces, ball_for_vis_data) 
                 
             else:
                 floor_blend_path = os.path.join(self.data_root_folder, "blender_files/floor_colorful_mat.blend")
@@ -2809,9 +3116,9 @@ class Trainer(object):
 
                     if not os.path.exists(dest_out_vid_path):
                         if not save_obj_only:
-                            run_blender_rendering_and_save2video(mesh_save_folder, out_rendered_img_folder, dest_out_vid_path, \
-                                condition_folder=ball_mesh_save_folder, vis_object=True, vis_condition=True, \
-                                scene_blend_path=floor_blend_path)
+                            self.render_vis_video(mesh_save_folder, out_rendered_img_folder, dest_out_vid_path, \
+                                ball_mesh_save_folder, floor_blend_path, \
+                                vis_human_verts, vis_human_faces, vis_obj_verts, obj_mesh_faces, ball_for_vis_data)
                     
                 else:
                     if dest_out_vid_path is None:
@@ -2819,15 +3126,15 @@ class Trainer(object):
                     if not os.path.exists(dest_out_vid_path):
                         if not vis_gt: # Skip GT visualiation 
                             if not save_obj_only:
-                                run_blender_rendering_and_save2video(mesh_save_folder, out_rendered_img_folder, dest_out_vid_path, \
-                                        condition_folder=ball_mesh_save_folder, vis_object=True, vis_condition=True, \
-                                        scene_blend_path=floor_blend_path)
+                                self.render_vis_video(mesh_save_folder, out_rendered_img_folder, dest_out_vid_path, \
+                                        ball_mesh_save_folder, floor_blend_path, \
+                                        vis_human_verts, vis_human_faces, vis_obj_verts, obj_mesh_faces, ball_for_vis_data)
 
                     if vis_gt: 
                         if not save_obj_only:
-                            run_blender_rendering_and_save2video(mesh_save_folder, out_rendered_img_folder, dest_out_vid_path, \
-                                    condition_folder=ball_mesh_save_folder, vis_object=True, vis_condition=True, \
-                                    scene_blend_path=floor_blend_path)
+                            self.render_vis_video(mesh_save_folder, out_rendered_img_folder, dest_out_vid_path, \
+                                    ball_mesh_save_folder, floor_blend_path, \
+                                    vis_human_verts, vis_human_faces, vis_obj_verts, obj_mesh_faces, ball_for_vis_data)
                     
 
             if idx > 1:
@@ -2908,8 +3215,8 @@ class Trainer(object):
           
             # Get human verts 
             mesh_jnts, mesh_verts, mesh_faces = \
-                run_smplx_model(root_trans[None].cuda(), curr_local_rot_aa_rep[None].cuda(), \
-                betas.cuda(), [gender], self.ds.bm_dict, return_joints24=True)
+                self.run_body_model(root_trans[None].to(self.device), curr_local_rot_aa_rep[None].to(self.device), \
+                betas.to(self.device), [gender], self.ds.bm_dict)
 
             # Get object verts 
             obj_rest_verts, obj_mesh_faces = self.ds.load_rest_pose_object_geometry(object_name)
@@ -2999,22 +3306,27 @@ class Trainer(object):
             # mesh_verts = mesh_verts[:, ::30, :, :] # 1 X T X Nv X 3
             # obj_mesh_verts = obj_mesh_verts[::30, :, :] # T X Nv X 3 
 
-            save_verts_faces_to_mesh_file_w_object(mesh_verts.detach().cpu().numpy()[0][:seq_len[idx]], \
-                    mesh_faces.detach().cpu().numpy(), \
-                    obj_mesh_verts.detach().cpu().numpy()[:seq_len[idx]], obj_mesh_faces, mesh_save_folder)
+            vis_human_verts = mesh_verts.detach().cpu().numpy()[0][:seq_len[idx]]
+            vis_obj_verts = obj_mesh_verts.detach().cpu().numpy()[:seq_len[idx]]
+            vis_human_faces = mesh_faces.detach().cpu().numpy()
+            if self.preview_renderer is None:
+                self.save_mesh_sequence(vis_human_verts, vis_human_faces, vis_obj_verts, obj_mesh_faces, mesh_save_folder)
 
             if dest_out_vid_path is None:
                 dest_out_vid_path = out_vid_file_path
 
+            # Blender reads the mesh files back, wait for the pending writes. 
+            self.flush_mesh_writer()
+
             floor_blend_path = os.path.join(self.data_root_folder, "blender_files/floor_colorful_mat.blend")
             if vis_gt: 
-                run_blender_rendering_and_save2video(mesh_save_folder, out_rendered_img_folder, dest_out_vid_path, \
-                        condition_folder=ball_mesh_save_folder, vis_object=True, vis_condition=True, \
-                        scene_blend_path=floor_blend_path)
+                self.render_vis_video(mesh_save_folder, out_rendered_img_folder, dest_out_vid_path, \
+                        ball_mesh_save_folder, floor_blend_path, \
+                        vis_human_verts, vis_human_faces, vis_obj_verts, obj_mesh_faces, ball_for_vis_data)
             else:
-                run_blender_rendering_and_save2video(mesh_save_folder, out_rendered_img_folder, dest_out_vid_path, \
-                        condition_folder=ball_mesh_save_folder, vis_object=True, vis_condition=True, \
-                        scene_blend_path=floor_blend_path)
+                self.render_vis_video(mesh_save_folder, out_rendered_img_folder, dest_out_vid_path, \
+                        ball_mesh_save_folder, floor_blend_path, \
+                        vis_human_verts, vis_human_faces, vis_obj_verts, obj_mesh_faces, ball_for_vis_data)
             
             if idx >= 1:
                 break 
@@ -3047,7 +3359,8 @@ def run_train(opt, device):
                 max_timesteps=opt.window+1, out_dim=repr_dim, timesteps=1000, \
                 objective="pred_x0", loss_type=loss_type, \
                 input_first_human_pose=opt.input_first_human_pose, \
-                use_object_keypoints=opt.use_object_keypoints) 
+                use_object_keypoints=opt.use_object_keypoints, \
+                sampler=opt.sampler, sampling_steps=opt.sampling_steps) 
    
     diffusion_model.to(device)
 
@@ -3062,7 +3375,8 @@ def run_train(opt, device):
         ema_decay=0.995,                # exponential moving average decay
         amp=True,                        # turn on mixed precision
         results_folder=str(wdir),
-        use_wandb=opt.use_wandb 
+        use_wandb=opt.use_wandb, 
+        device=device 
     )
     trainer.train()
 
@@ -3088,7 +3402,8 @@ def run_sample(opt, device):
                 max_timesteps=opt.window+1, out_dim=repr_dim, timesteps=1000, \
                 objective="pred_x0", loss_type=loss_type, \
                 input_first_human_pose=opt.input_first_human_pose, \
-                use_object_keypoints=opt.use_object_keypoints)
+                use_object_keypoints=opt.use_object_keypoints, \
+                sampler=opt.sampler, sampling_steps=opt.sampling_steps)
 
     diffusion_model.to(device)
 
@@ -3102,7 +3417,8 @@ def run_sample(opt, device):
         ema_decay=0.995,                # exponential moving average decay
         amp=True,                        # turn on mixed precision
         results_folder=str(wdir),
-        use_wandb=opt.use_wandb 
+        use_wandb=opt.use_wandb, 
+        device=device 
     )
    
     if opt.use_long_planned_path:
@@ -3118,6 +3434,27 @@ def parse_opt():
     # Keeping only parameters not in config file for backwards compatibility
     parser.add_argument('--project', default='runs/train', help='project/name')
     parser.add_argument('--exp_name', default='chois', help='save to project/name')
+    parser.add_argument('--device', default='0', help='cuda device index, or cpu to run without a GPU')
+    parser.add_argument('--eval_batch_size', type=int, default=1, help='number of test windows evaluated together in cond_sample_res')
+    parser.add_argument('--long_seq_batch_size', type=int, default=1, help='number of planned paths generated together in cond_sample_res_w_long_planned_path')
+    parser.add_argument('--num_metric_workers', type=int, default=0, help='number of worker processes computing foot sliding metrics in cond_sample_res, 0 computes them inline')
+    parser.add_argument('--metric_queue_size', type=int, default=16, help='max number of samples waiting for the metric workers')
+    parser.add_argument('--sampler', type=str, default='ddpm', help='ddpm, ddim or dpm_solver++')
+    parser.add_argument('--sampling_steps', type=int, default=20, help='number of denoising steps for ddim and dpm_solver++')
+    parser.add_argument('--use_window_store', action='store_true', help='serve training windows from memory-mapped shards')
+    parser.add_argument('--preprocess_workers', type=int, default=0, help='number of processes used to build the window cache')
+    parser.add_argument('--use_preprocess_cache', action='store_true', help='key processed windows on hashes of the inputs and parameters')
+    parser.add_argument('--sdf_cache_mb', type=int, default=2048, help='memory budget of the SDF grid cache, 0 disables caching')
+    parser.add_argument('--sdf_cache_half', action='store_true', help='store cached SDF grids in half precision')
+    parser.add_argument('--use_sparse_sdf', action='store_true', help='keep full resolution SDF values only in a narrow band around surfaces')
+    parser.add_argument('--sparse_sdf_band', type=float, default=0.05, help='narrow band width of sparse SDFs, in the normalized [-1, 1] grid frame')
+    parser.add_argument('--use_text_embedding_store', action='store_true', help='serve CLIP text features from a persistent store')
+    parser.add_argument('--use_body_proxy_guidance', action='store_true', help='compute guidance joints with a sparse joint regressor instead of SMPL-X')
+    parser.add_argument('--use_batched_smplx', action='store_true', help='run SMPL-X once per gender for a whole batch, caching shape blend shapes per subject')
+    parser.add_argument('--use_async_mesh_writer', action='store_true', help='write visualization meshes from a background thread')
+    parser.add_argument('--mesh_writer_queue_mb', type=int, default=1024, help='max MB of mesh data waiting to be written')
+    parser.add_argument('--use_preview_renderer', action='store_true', help='render visualization videos with the CPU preview renderer instead of Blender')
+    parser.add_argument('--use_sdf_contact_guidance', action='store_true', help='query hand-object distances from the object SDF in guidance')
     
     # Note: Most parameters are now loaded from debug_config.yaml when --debug_mode is used
 
@@ -3199,8 +3536,11 @@ if __name__ == "__main__":
     opt.save_dir = os.path.join(opt.project, opt.exp_name)
     opt.exp_name = opt.save_dir.split('/')[-1]
     # Set device and make it available globally
-    device = torch.device(f"cuda:{opt.device}" if torch.cuda.is_available() else "cpu")
-    torch.cuda.set_device(device) # Set default CUDA device
+    if str(opt.device) != "cpu" and torch.cuda.is_available():
+        device = torch.device(f"cuda:{opt.device}")
+        torch.cuda.set_device(device) # Set default CUDA device
+    else:
+        device = torch.device("cpu")
     
     if opt.test_sample_res:
         run_sample(opt, device)
@@ -66,6 +66,10 @@ from primitive_functions import extract_object_id_for_faces, assign_semantics_fo
 
 from plan_path_on_habitat import gen_path_on_habitat, get_sim_and_agent, gen_path_for_multiple_objs_on_habitat
 
+from manip.data.path_processing import pack_paths, unpack_paths, select_paths, filter_paths, \
+    convert_habitat_coord_to_model, resample_paths_by_distance, densify_paths, trim_paths_to_windows, \
+    canonicalize_paths, PathStore
+
 # Try to match the descriptions in training data. 
 mapping_dict = {
     "Pick up floorlamp, move floorlamp to be close to the sofa.": "Lift the floorlamp, move the floorlamp, and put down the floorlamp.", 
@@ -485,99 +489,90 @@ def gen_scene_floor_height():
     print("Scene floor dict: {0}".format(scene_floor_dict))
     json.dump(scene_floor_dict, open(dest_json_path, 'w'))
 
-def filter_sampled_paths():
+def filter_sampled_paths(save_per_path_files=False):
     # 1. Discard very short or very long paths. 
     # 2. Discard paths that are not starting from a point on the floor. 
+    # All the paths are processed at once as packed arrays, the selected ones are saved in one path store 
+    # (dest_npy_root_folder + ".npz"). save_per_path_files also writes the npy files and figures of each path. 
     height_json_path = "/move/u/jiamanli/datasets/replica_processed/scene_floor_height.json"
     scene_floor_dict = json.load(open(height_json_path, 'r'))
 
     dest_json_path = "/viscam/u/jiamanli/github/scene_aware_manip/cvpr2024_utils/create_eval_dataset/selected_long_seq_names.json"
-    dest_json_dict = {} 
-    cnt = 0 
     
     npy_root_folder = "/viscam/u/jiamanli/github/scene_aware_manip/cvpr2024_utils/create_eval_dataset/replica_single_object_long_seq_data"
     dest_npy_root_folder = npy_root_folder + "_selected"
+
+    # Collect all the sampled paths. 
+    path_name_list = []
+    waypoints_list = []
+    floor_height_list = []
     scene_names = os.listdir(npy_root_folder)
     for s_name in scene_names:
         scene_folder_path = os.path.join(npy_root_folder, s_name)
-        object_names = os.listdir(scene_folder_path)
+        for o_name in os.listdir(scene_folder_path):
+            object_folder_path = os.path.join(scene_folder_path, o_name)
+            for text_index in os.listdir(object_folder_path):
+                text_folder_path = os.path.join(object_folder_path, text_index)
+                for npy_name in os.listdir(text_folder_path):
+                    if ".npy" in npy_name:
+                        path_name_list.append(os.path.join(s_name, o_name, text_index, npy_name))
+                        waypoints_list.append(np.load(os.path.join(text_folder_path, npy_name)))
+                        floor_height_list.append(scene_floor_dict[s_name])
+
+    print("Number of sampled paths:{0}".format(len(path_name_list)))
+    waypoints, offsets = pack_paths(waypoints_list) # sum(K) X 3 
+
+    # Remove paths shorter than 3 meters, and the sequences with starting frame not on the floor (y is up in Habitat). 
+    keep_mask = filter_paths(waypoints, offsets, np.asarray(floor_height_list), min_length=3., \
+                max_start_height=0.2, height_dim=1) # N 
+    waypoints, offsets = select_paths(waypoints, offsets, keep_mask)
+    path_name_list = [path_name_list[p_idx] for p_idx in np.nonzero(keep_mask)[0]]
+    print("Number of paths after filtering:{0}".format(len(path_name_list)))
+
+    # Process waypoints to be directly used for model testing 
+    converted_waypoints = convert_habitat_coord_to_model(waypoints).astype(np.float32) # sum(K) X 3 
+    new_xy_data, new_offsets = resample_paths_by_distance(converted_waypoints[:, :2], offsets, \
+                            num_samples_per_seg=20, dist_range=(0.7, 0.8)) # sum(N) X 2 
+
+    # Use the start height for all the points except the last one. 
+    num_new_points = np.diff(new_offsets)
+    new_z_data = np.repeat(converted_waypoints[offsets[:-1], 2], num_new_points)
+    new_z_data[new_offsets[1:][num_new_points > 0]-1] = converted_waypoints[offsets[1:]-1, 2][num_new_points > 0]
+    new_xyz_data = np.concatenate((new_xy_data, new_z_data[:, None]), axis=-1).astype(np.float32) # sum(N) X 3 
+
+    keep_mask = num_new_points >= 3 
+    new_xyz_data, new_offsets = select_paths(new_xyz_data, new_offsets, keep_mask)
+    path_name_list = [path_name_list[p_idx] for p_idx in np.nonzero(keep_mask)[0]]
+    dense_waypoints, dense_offsets = trim_paths_to_windows(new_xyz_data, new_offsets, remainder=3)
+
+    # Repeat the first and the last waypoint of each path. 
+    dense_waypoints_list = [np.concatenate((path[0:1], path, path[-1:]), axis=0).astype(np.float64) \
+                        for path in unpack_paths(dense_waypoints, dense_offsets)]
+    final_waypoints, final_offsets = pack_paths(dense_waypoints_list)
+    assert (np.diff(final_offsets) % 4 == 1).all() 
+
+    _, cano_quat = canonicalize_paths(final_waypoints, final_offsets) # N X 4 
+    path_store = PathStore(final_waypoints, final_offsets, path_name_list, extra_data={"cano_quat": cano_quat})
+    path_store.save(dest_npy_root_folder + ".npz")
 
-        curr_scene_height = scene_floor_dict[s_name]
+    dest_json_dict = {} 
+    for cnt, path_name in enumerate(path_name_list):
+        dest_json_dict[cnt] = path_name 
 
-        for o_name in object_names:
-            object_folder_path = os.path.join(scene_folder_path, o_name)
+        if save_per_path_files:
+            dest_npy_path = os.path.join(dest_npy_root_folder, path_name)
+            dest_data_folder = os.path.dirname(dest_npy_path)
+            if not os.path.exists(dest_data_folder):
+                os.makedirs(dest_data_folder)
+            dest_img_path = dest_npy_path.replace(".npy", ".png")
+            dest_fig_path = dest_npy_path.replace(".npy", "_xy.png")
 
-            text_idxs = os.listdir(object_folder_path)
-            for text_index in text_idxs:
-                text_folder_path = os.path.join(object_folder_path, text_index)
+            new_dense_waypoints = path_store.get(path_name)
+            np.save(dest_npy_path, new_dense_waypoints)
+            shutil.copy(os.path.join(npy_root_folder, path_name).replace(".npy", ".png"), dest_img_path) 
 
-                npy_files = os.listdir(text_folder_path)
-                for npy_name in npy_files:
-                    if ".npy" in npy_name:
-                        npy_path = os.path.join(text_folder_path, npy_name)
-
-                        waypoints = np.load(npy_path)
-
-                        num_waypoints = waypoints.shape[0]
-                        # Remove distance > 15 meter or < 6 meter. 
-                        total_dist = np.linalg.norm(np.diff(waypoints, axis=0), axis=-1).sum() 
-                        print("Total dist:{0}".format(total_dist)) 
-
-                        if total_dist < 3:
-                            print("Sequence is too short Discarded!")
-                            continue  
-
-                        # if total_dist < 6 or total_dist > 15:
-                        #     continue  
-
-                        # Remove the sequence with starting frame not on the floor.
-                        start_pt_height = waypoints[0, 1]
-                        print("start_pt_height:{0}".format(start_pt_height)) 
-                        if start_pt_height > curr_scene_height + 0.2:
-                            print("Start pt is not on the floor! Discarded!")
-                            continue 
-
-                        # Process waypoints to be directly used for model testing 
-                        converted_waypoints = convert_habitat_coord_to_model(waypoints) # K X 3 
-                        # dense_waypoints = sample_and_adjust_waypoints(converted_waypoints, \
-                        #     distance_range=(0.7, 0.9), remainder=3)
-
-                        converted_waypoints = torch.from_numpy(converted_waypoints).float() # K X 3 
-                        new_x_data, new_y_data = apply_heuristics_to_planned_path(converted_waypoints[:, 0:1], \
-                                            converted_waypoints[:, 1:2]) 
-                        # N X 3 
-                        new_z_data = torch.zeros_like(new_x_data)
-                        new_z_data[:-1, 0] = converted_waypoints[0, 2]
-                        new_z_data[-1, 0] = converted_waypoints[-1, 2] 
-
-                        new_xyz_data = torch.cat((new_x_data, new_y_data, new_z_data), dim=-1) # N X 3 
-                        print("new xyz data shape:{0}".format(new_xyz_data.shape))
-                        if new_xyz_data.shape[0] < 3:
-                            continue 
-                        dense_waypoints = adjust_waypoints(new_xyz_data.detach().cpu().numpy(), remainder=3) 
-
-                        new_dense_waypoints = np.zeros((dense_waypoints.shape[0]+2, 3))
-                        new_dense_waypoints[1:-1, :] = dense_waypoints.copy() 
-                        new_dense_waypoints[0, :] = dense_waypoints[0, :].copy()
-                        new_dense_waypoints[-1, :] = dense_waypoints[-1, :].copy()
-
-                        assert new_dense_waypoints.shape[0] % 4 == 1 
-
-                        dest_data_folder = os.path.join(dest_npy_root_folder, s_name, o_name, text_index)
-                        if not os.path.exists(dest_data_folder):
-                            os.makedirs(dest_data_folder)
-                        dest_npy_path = os.path.join(dest_data_folder, npy_name)
-                        dest_img_path = dest_npy_path.replace(".npy", ".png")
-                        dest_fig_path = dest_npy_path.replace(".npy", "_xy.png")
-
-                        np.save(dest_npy_path, new_dense_waypoints)
-                        shutil.copy(npy_path.replace(".npy", ".png"), dest_img_path) 
-
-                        # Also visualize dense waypoints 
-                        visualize_root_translation(new_dense_waypoints[:, :2], dest_fig_path)
-
-                        dest_json_dict[cnt] = os.path.join(s_name, o_name, text_index, npy_name) 
-                        cnt += 1 
+            # Also visualize dense waypoints 
+            visualize_root_translation(new_dense_waypoints[:, :2], dest_fig_path)
 
     json.dump(dest_json_dict, open(dest_json_path, 'w'))
     print("Number of sequences for evaluation:{0}".format(len(dest_json_dict)))
@@ -604,56 +599,6 @@ def visualize_root_translation(xy_data, dest_fig_path, title="Human Root Transla
     # plt.show()
     plt.savefig(dest_fig_path) 
 
-def convert_habitat_coord_to_model(habitat_coord):
-    # habitat_coord: K X 3 
-    xyz_data = np.zeros_like(habitat_coord) # K X 3 
-
-    xyz_data[:, 0] = habitat_coord[:, 0].copy()
-    xyz_data[:, 1] = -habitat_coord[:, 2].copy()
-    xyz_data[:, 2] = habitat_coord[:, 1].copy() 
-
-    return xyz_data  
-
-def add_points_in_planned_path(x_data, y_data):
-    # x_data: T X 1 
-    # y_data: T X 1 
-    num_waypoints = x_data.shape[0]
-
-    num_samples_per_seg = 20 
-    interval = 1.0/num_samples_per_seg 
-    new_x_data_list = []
-    new_y_data_list = []
-    for idx in range(num_waypoints-1):
-        start_pt_x = x_data[idx]
-        end_pt_x = x_data[idx+1]
-
-        for t_idx in range(num_samples_per_seg+1):
-            alpha = t_idx * interval 
-            curr_x_data = (1-alpha) * start_pt_x + alpha * end_pt_x 
-
-            new_x_data_list.append(curr_x_data)
-
-        start_pt_y = y_data[idx]
-        end_pt_y = y_data[idx+1] 
-
-        for t_idx in range(num_samples_per_seg+1):
-            alpha = t_idx * interval 
-            curr_y_data = (1-alpha) * start_pt_y + alpha * end_pt_y
-
-            new_y_data_list.append(curr_y_data)
-
-    new_x_data = torch.stack(new_x_data_list, dim=0) # T X 1 
-    new_y_data = torch.stack(new_y_data_list, dim=0) # T X 1 
-
-    return new_x_data, new_y_data 
-
-def compute_points_distance(x_data, y_data):
-    # x_data: T X 1 
-    # y_data: T X 1 
-    abs_dist = torch.sqrt(torch.pow(x_data[1:]-x_data[:-1], 2)+torch.pow(y_data[1:]-y_data[:-1], 2)) # (T-1) X 1 
-
-    return abs_dist 
-
 def apply_heuristics_to_planned_path(x_data, y_data):
     # x_data: T X 1 
     # y_data: T X 1 
@@ -661,64 +606,20 @@ def apply_heuristics_to_planned_path(x_data, y_data):
     # Currently, we only support the number of waypoints to be (multiple of 4 + 1).  
     # For navigation, use 0.7~0.9 for every 30 frames. Also, need to consider overlapped 10 frames for every two windows. 
     # 0   29   59   89   119   ||139   169   199  219   ||239   269   299  319   ||339   369   399   419    
+    xy_data = torch.cat((x_data, y_data), dim=-1).detach().cpu().numpy() # T X 2 
+    selected_xy, _ = resample_paths_by_distance(*pack_paths([xy_data]), num_samples_per_seg=20, \
+                    dist_range=(0.7, 0.8))
+    selected_xy = torch.from_numpy(selected_xy).to(x_data.dtype) # N X 2 
 
-    new_x_data, new_y_data = add_points_in_planned_path(x_data, y_data)
-    
-    num_waypoints = new_x_data.shape[0]
-
-    abs_dist = compute_points_distance(new_x_data, new_y_data) # (T-1) X 1 
-
-    test_x_data_list = [new_x_data[0]]
-    test_y_data_list = [new_y_data[0]] 
-
-    sum_dist = 0
-    dist_list = []
-   
-    dist_range_min = 0.7
-    dist_range_max = 0.8 
-
-    for idx in range(num_waypoints-1):
-        sum_dist += abs_dist[idx] 
-
-        if sum_dist <= dist_range_max and sum_dist >= dist_range_min:
-            test_x_data_list.append(new_x_data[idx+1])
-            test_y_data_list.append(new_y_data[idx+1])
-
-            dist_list.append(sum_dist)
-            sum_dist = 0  
-
-    test_x_data = torch.stack(test_x_data_list)
-    test_y_data = torch.stack(test_y_data_list)
-
-    # dist_list = torch.stack(dist_list)
-
-    return test_x_data, test_y_data
+    return selected_xy[:, 0:1], selected_xy[:, 1:2]
 
 def generate_dense_waypoints(waypoints, distance_range=(0.7, 0.9)):
-    dense_waypoints = [waypoints[0]]
-    for i in range(len(waypoints) - 1):
-        segment_length = np.linalg.norm(waypoints[i+1] - waypoints[i])
-        accumulated_distance = 0
-        
-        while accumulated_distance + distance_range[0] <= segment_length:
-            t = (accumulated_distance + distance_range[0]) / segment_length
-            interpolated_point = (1 - t) * waypoints[i] + t * waypoints[i+1]
-            dense_waypoints.append(interpolated_point)
-            accumulated_distance += distance_range[0]
-
-        # Check the gap between the last added point and the segment's end
-        if accumulated_distance < segment_length:
-            dense_waypoints.append(waypoints[i+1])
-                
-        accumulated_distance -= segment_length
-
-    dense_waypoints.append(waypoints[-1])
-    return np.array(dense_waypoints)
+    dense_waypoints, _ = densify_paths(*pack_paths([np.asarray(waypoints)]), step=distance_range[0])
+    return dense_waypoints
 
 def adjust_waypoints(dense_waypoints, remainder):
-    while (len(dense_waypoints) - remainder) % 4 != 0:
-        dense_waypoints = dense_waypoints[1:]
-    return dense_waypoints
+    adjusted_waypoints, _ = trim_paths_to_windows(*pack_paths([dense_waypoints]), remainder=remainder)
+    return adjusted_waypoints
 
 def sample_and_adjust_waypoints(waypoints, distance_range=(0.7, 0.9), remainder=1):
     dense_waypoints = generate_dense_waypoints(waypoints, distance_range)
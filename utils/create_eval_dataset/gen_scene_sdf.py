@@ -1,9 +1,6 @@
 import os
 os.environ['PYOPENGL_PLATFORM'] = 'egl'
 
-from mesh_to_sdf import mesh_to_voxels
-from mesh_to_sdf import sample_sdf_near_surface
-
 import trimesh
 import skimage
 
@@ -11,7 +8,9 @@ import numpy as np
 import time 
 import json 
 
-def gen_sdf(): 
+from manip.data.sdf_builder import MeshSDFBuilder, save_multi_res_sdf
+
+def gen_sdf(save_multi_res=False, num_workers=-1): 
     dest_root_folder = "/move/u/jiamanli/datasets/semantic_manip/scene_data/hm3d_processed"
     dest_voxel_mesh_folder = os.path.join(dest_root_folder, "hm3d_voxel_objs_res256")
     dest_sdf_folder = os.path.join(dest_root_folder, "hm3d_sdfs_res256") 
@@ -50,10 +49,17 @@ def gen_sdf():
         # points, sdf = sample_sdf_near_surface(mesh, number_of_points=256*256*256)
         # points, sdf = sample_sdf_near_surface(mesh, number_of_points=512*512*512)
         
-        sdf = mesh_to_voxels(mesh, voxel_resolution=256, \
-            surface_point_method='sample', sign_method='normal', \
-            scan_count=100, scan_resolution=400, sample_point_count=10000000, \
-            normal_sample_count=11, pad=False, check_result=False, return_gradients=False)
+        # Same as mesh_to_voxels with surface_point_method='sample' and sign_method='normal',
+        # the grid is evaluated in chunks with parallel KD-tree queries.
+        sdf_builder = MeshSDFBuilder(mesh, sample_point_count=10000000, normal_sample_count=11, \
+                    num_workers=num_workers)
+        sdf = sdf_builder.build_dense(256)
+
+        if save_multi_res:
+            # Coarse grid and fine blocks near the scene surface, far from the surface only the coarse grid is stored.
+            coarse_sdf, block_idx, block_sdf = sdf_builder.build_multi_res(num_blocks=32, block_size=8)
+            dest_multi_res_sdf_path = os.path.join(dest_sdf_folder, scene_n + "_sdf_multi_res.npz")
+            save_multi_res_sdf(dest_multi_res_sdf_path, centroid, extents, coarse_sdf, block_idx, block_sdf)
 
         vertices, faces, normals, _ = skimage.measure.marching_cubes(sdf, level=0)
         mesh = trimesh.Trimesh(vertices=vertices, faces=faces, vertex_normals=normals)
@@ -9,40 +9,8 @@ import time
 
 import torch 
 
-def generate_sdf(mesh, dest_json_path, dest_sdf_path, dest_voxel_mesh_path="", grid_dim=256, print_time=False):
-    from mesh_to_sdf import mesh_to_voxels, sample_sdf_near_surface
-    # Save centroid and extents data used for transforming vertices to [-1,1] while query
-    # vertices = mesh.vertices - mesh.bounding_box.centroid
-    # vertices *= 2 / np.max(mesh.bounding_box.extents)
-    centroid = mesh.bounding_box.centroid
-    extents = mesh.bounding_box.extents
-    # Save centroid and extents as SDF
-    json_dict = {}
-    json_dict['centroid'] = centroid.tolist()
-    json_dict['extents'] = extents.tolist()
-    json_dict['grid_dim'] = grid_dim
-    json.dump(json_dict, open(dest_json_path, 'w'))
-    
-    if print_time:
-        start_time = time.time() 
-    
-    sdf = mesh_to_voxels(mesh, voxel_resolution=grid_dim)
-    
-    if dest_voxel_mesh_path != "":
-        import skimage.measure
-        vertices, faces, normals, _ = skimage.measure.marching_cubes(sdf, level=0)
-        voxel_mesh = trimesh.Trimesh(vertices=vertices, faces=faces, vertex_normals=normals)
-        voxel_mesh.export(open(dest_voxel_mesh_path, 'w'), file_type='obj')
-    
-    if print_time:
-        print("Generating SDF took {0} seconds".format(time.time()-start_time))
-    
-    np.save(dest_sdf_path, sdf)
-    
-    centroid = np.copy(centroid)
-    extents = np.copy(extents)
-    
-    return centroid, extents, sdf
+from manip.data.sdf_builder import generate_sdf
+from manip.data.sdf_grid import get_multi_res_sdf_path
 
 def get_rest_obj_sdf():
     data_root_folder = "/move/u/jiamanli/datasets/semantic_manip/processed_data"
@@ -64,7 +32,8 @@ def get_rest_obj_sdf():
             dest_voxel_mesh_path = os.path.join(dest_obj_sdf_folder, object_name+".obj")
 
             generate_sdf(obj_mesh, dest_json_path, dest_sdf_path, \
-            dest_voxel_mesh_path, grid_dim=256, print_time=False)
+            dest_voxel_mesh_path, grid_dim=256, print_time=False, \
+            dest_multi_res_sdf_path=get_multi_res_sdf_path(dest_sdf_path))
     
 def get_behave_obj_sdf():
     data_root_folder = "/move/u/jiamanli/github/chois_baselines/datasets"
@@ -97,7 +66,8 @@ def get_behave_obj_sdf():
         dest_voxel_mesh_path = os.path.join(dest_obj_sdf_folder, object_name+".obj")
 
         generate_sdf(obj_mesh, dest_json_path, dest_sdf_path, \
-        dest_voxel_mesh_path, grid_dim=256, print_time=False)
+        dest_voxel_mesh_path, grid_dim=256, print_time=False, \
+        dest_multi_res_sdf_path=get_multi_res_sdf_path(dest_sdf_path))
 
 if __name__ == "__main__":
     # get_rest_obj_sdf()
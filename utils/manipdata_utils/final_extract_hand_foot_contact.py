@@ -5,11 +5,16 @@ import torch
 
 import pickle as pkl
 
+import multiprocessing 
+from concurrent.futures import ProcessPoolExecutor, as_completed 
+
 from human_body_prior.body_model.body_model import BodyModel
 
 import igl 
 from vis_all_captured_motion_and_object import get_contact_labels, run_smplx_model
 
+from manip.vis.mesh_writer import write_obj 
+
 def extract_part_vert_idx(part_obj_path, full_obj_path): 
     part_mesh = trimesh.load_mesh(part_obj_path)
     part_verts = np.asarray(part_mesh.vertices) # Nv X 3
@@ -118,16 +123,85 @@ def sample_pcs_from_mesh():
             sampled_points = trimesh.PointCloud(sampled_points)
             sampled_points.export(dest_ply_path)
 
-def compute_contact_label_w_semantics():
-    # Prepare SMPLX model 
+def compute_point_to_mesh_dists(query_points, mesh_verts, mesh_faces, max_chunk_elems=2**26):
+    # query_points: K X 3, mesh_verts: K X Nv X 3, each query point against its own frame's mesh
+    # mesh_faces: Nf X 3
+    # Returns K unsigned distances to the closest point on the mesh.
+    num_faces = mesh_faces.shape[0]
+    chunk_size = max(1, max_chunk_elems // (num_faces * 9))
+
+    dists = torch.zeros(query_points.shape[0])
+    for c_idx in range(0, query_points.shape[0], chunk_size):
+        p = query_points[c_idx:c_idx+chunk_size, None, :] # K' X 1 X 3
+        tris = mesh_verts[c_idx:c_idx+chunk_size][:, mesh_faces] # K' X Nf X 3 X 3
+        a, b, c = tris[:, :, 0], tris[:, :, 1], tris[:, :, 2] # K' X Nf X 3
+
+        # Distance to the plane if the projection falls inside the triangle.
+        normals = torch.cross(b - a, c - a, dim=-1)
+        normal_len = torch.norm(normals, dim=-1).clamp(min=1e-12) # K' X Nf
+        inside = (torch.cross(b - a, p - a, dim=-1) * normals).sum(dim=-1).ge(0) & \
+            (torch.cross(c - b, p - b, dim=-1) * normals).sum(dim=-1).ge(0) & \
+            (torch.cross(a - c, p - c, dim=-1) * normals).sum(dim=-1).ge(0) & normal_len.gt(1e-10)
+        plane_dists = ((p - a) * normals).sum(dim=-1).abs() / normal_len # K' X Nf
+
+        # Otherwise the closest point is on one of the edges.
+        edge_dists = None
+        for e_start, e_end in ((a, b), (b, c), (c, a)):
+            edge = e_end - e_start
+            t = ((p - e_start) * edge).sum(dim=-1) / (edge * edge).sum(dim=-1).clamp(min=1e-12)
+            closest = e_start + t.clamp(0, 1)[..., None] * edge
+            curr_edge_dists = torch.norm(p - closest, dim=-1) # K' X Nf
+            edge_dists = curr_edge_dists if edge_dists is None else torch.minimum(edge_dists, curr_edge_dists)
+
+        face_dists = torch.where(inside, plane_dists, edge_dists) # K' X Nf
+        dists[c_idx:c_idx+chunk_size] = face_dists.min(dim=1)[0]
+
+    return dists
+
+def compute_contact_labels_batch(obj_points, part_verts, part_faces, contact_thresh, max_chunk_elems=2**26):
+    # obj_points: T X N X 3, part_verts: T X Nv X 3, part_faces: Nf X 3, numpy arrays
+    # Returns T X N bool, an object point is in contact if it is within contact_thresh of the part mesh.
+    # Frames are processed in chunks so that the distance matrix and the triangles stay below max_chunk_elems.
+    obj_points = torch.from_numpy(obj_points).float()
+    part_verts = torch.from_numpy(part_verts).float()
+    part_faces = torch.from_numpy(part_faces.astype(np.int64))
+
+    num_steps, num_points = obj_points.shape[:2]
+    frame_elems = max(num_points * part_verts.shape[1], part_faces.shape[0] * 9)
+    frame_chunk_size = max(1, max_chunk_elems // frame_elems)
+
+    contact_labels = torch.zeros(num_steps, num_points, dtype=torch.bool) # T X N
+    for c_idx in range(0, num_steps, frame_chunk_size):
+        curr_points = obj_points[c_idx:c_idx+frame_chunk_size] # T' X N X 3
+        curr_verts = part_verts[c_idx:c_idx+frame_chunk_size] # T' X Nv X 3
+
+        # The distance to the closest vertex bounds the distance to the mesh: it is never smaller, and at most larger
+        # by the longest edge. Only the points in between need the exact point to triangle distances.
+        tris = curr_verts[:, part_faces] # T' X Nf X 3 X 3
+        max_edge_len = torch.norm(tris - tris.roll(1, dims=2), dim=-1).max()
+        vert_dists = torch.cdist(curr_points, curr_verts).min(dim=2)[0] # T' X N
+
+        curr_labels = vert_dists < contact_thresh # T' X N
+        candidate_mask = (~curr_labels) & (vert_dists < contact_thresh + max_edge_len)
+        t_idx, p_idx = torch.nonzero(candidate_mask, as_tuple=True)
+        if t_idx.shape[0] > 0:
+            dists = compute_point_to_mesh_dists(curr_points[t_idx, p_idx], curr_verts[t_idx], part_faces) # K
+            curr_labels[t_idx, p_idx] = dists < contact_thresh
+
+        contact_labels[c_idx:c_idx+frame_chunk_size] = curr_labels
+
+    return contact_labels.numpy()
+
+def prep_contact_label_data():
+    # Prepare SMPLX model
     soma_work_base_dir = '/move/u/jiamanli/datasets/mreaching_data'
     support_base_dir = os.path.join(soma_work_base_dir, 'support_files')
     surface_model_type = "smplx"
     surface_model_fname = os.path.join(support_base_dir, surface_model_type, "male", 'model.npz')
     dmpl_fname = None
-    num_dmpls = None 
+    num_dmpls = None
     num_expressions = None
-    num_betas = 16 
+    num_betas = 16
 
     male_bm = BodyModel(bm_fname=surface_model_fname,
                     num_betas=num_betas,
@@ -141,36 +215,125 @@ def compute_contact_label_w_semantics():
                     dmpl_fname=dmpl_fname)
     bm_dict = {'male' : male_bm, 'female' : female_bm}
 
-    motion_data_folder = "/move/u/jiamanli/datasets/FullBodyManipCapture/processed_manip_data/npz_files"
-
+    # Part vertex ids and part geometry to get the faces
     part_vids_folder = "./part_vert_ids"
-    left_hand_vids_path = os.path.join(part_vids_folder, "left_hand_vids.npy")
-    right_hand_vids_path = os.path.join(part_vids_folder, "right_hand_vids.npy")
-    left_foot_vids_path = os.path.join(part_vids_folder, "left_foot_vids.npy")
-    right_foot_vids_path = os.path.join(part_vids_folder, "right_foot_vids.npy")
-
-    left_hand_vids = np.load(left_hand_vids_path)
-    right_hand_vids = np.load(right_hand_vids_path)
-    left_foot_vids = np.load(left_foot_vids_path)
-    right_foot_vids = np.load(right_foot_vids_path) 
-
-    # Load part object geometry to get the faces 
-    left_hand_geo_path = "./left_hand.ply"
-    right_hand_geo_path = "./right_hand.ply"
-    left_foot_geo_path = "./left_foot.ply"
-    right_foot_geo_path = "./right_foot.ply"
-    
-    left_hand_mesh = trimesh.load_mesh(left_hand_geo_path)
-    left_hand_faces = np.asarray(left_hand_mesh.faces) 
-    
-    right_hand_mesh = trimesh.load_mesh(right_hand_geo_path)
-    right_hand_faces = np.asarray(right_hand_mesh.faces) 
-    
-    left_foot_mesh = trimesh.load_mesh(left_foot_geo_path)
-    left_foot_faces = np.asarray(left_foot_mesh.faces) 
-    
-    right_foot_mesh = trimesh.load_mesh(right_foot_geo_path)
-    right_foot_faces = np.asarray(right_foot_mesh.faces) 
+    part_vids_dict = {}
+    part_faces_dict = {}
+    for part_name, part_file_name in (("lhand", "left_hand"), ("rhand", "right_hand"), \
+        ("lfoot", "left_foot"), ("rfoot", "right_foot")):
+        part_vids_dict[part_name] = np.load(os.path.join(part_vids_folder, part_file_name+"_vids.npy"))
+        part_mesh = trimesh.load_mesh("./"+part_file_name+".ply")
+        part_faces_dict[part_name] = np.asarray(part_mesh.faces)
+
+    return bm_dict, part_vids_dict, part_faces_dict
+
+CONTACT_LABEL_DATA = None
+
+def init_contact_label_worker(num_threads):
+    # Each worker loads the body models and part geometry once.
+    global CONTACT_LABEL_DATA
+    torch.set_num_threads(num_threads)
+    CONTACT_LABEL_DATA = prep_contact_label_data()
+
+def compute_contact_labels_for_seq_batch(job_list, contact_thresh, use_vectorized_query=False):
+    # job_list: list of (npz_path, dest_contact_pkl_path, dest_debug_vis_folder), dest_debug_vis_folder is ""
+    # if no visualization is needed.
+    # SMPL-X runs once for all the frames of the batch, each frame is a separate sample with its own betas and gender.
+    if CONTACT_LABEL_DATA is None:
+        init_contact_label_worker(torch.get_num_threads())
+    bm_dict, part_vids_dict, part_faces_dict = CONTACT_LABEL_DATA
+
+    seq_data_list = []
+    root_trans_list = []
+    aa_rot_rep_list = []
+    betas_list = []
+    gender_list = []
+    for npz_path, _, _ in job_list:
+        npz_data = np.load(npz_path)
+        object_name = npz_path.split("/")[-1].split("_")[1]
+
+        root_trans = torch.from_numpy(npz_data['root_trans']).float() # T X 3
+
+        root_orient = torch.from_numpy(npz_data['root_orient']).float() # T X 3
+        pose_body = torch.from_numpy(npz_data['pose_body']).float() # T X 63
+        aa_rot_rep = torch.cat((root_orient[:, None, :], pose_body.reshape(-1, 21, 3)), dim=1) # T X 22 X 3
+
+        betas = torch.from_numpy(npz_data['betas']).float() # 1 X 16
+        gender = str(npz_data['gender'])
+
+        num_steps = root_trans.shape[0]
+        root_trans_list.append(root_trans)
+        aa_rot_rep_list.append(aa_rot_rep)
+        betas_list.append(betas.reshape(1, -1).repeat(num_steps, 1))
+        gender_list += [gender] * num_steps
+
+        # Get object points
+        obj_points = load_object_geometry(object_name, npz_data['obj_scale'], npz_data['obj_rot'], npz_data['obj_trans'])
+        seq_data_list.append((num_steps, obj_points))
+
+    # Get human mesh, all frames of the batch as BS = sum(T), T = 1
+    with torch.no_grad():
+        _, all_human_verts, human_faces = run_smplx_model(torch.cat(root_trans_list)[:, None], \
+            torch.cat(aa_rot_rep_list)[:, None], torch.cat(betas_list), gender_list, bm_dict)
+    all_human_verts = all_human_verts[:, 0].detach().cpu().numpy() # sum(T) X Nv X 3
+
+    lhand_color = np.asarray([255, 87, 51])  # red
+    rhand_color = np.asarray([134, 17, 226]) # purple
+    lfoot_color = np.asarray([17, 99, 226]) # blue
+    rfoot_color = np.asarray([22, 173, 100]) # green
+
+    start_idx = 0
+    for (num_steps, obj_points), (_, dest_contact_pkl_path, dest_debug_vis_folder) in zip(seq_data_list, job_list):
+        human_verts = all_human_verts[start_idx:start_idx+num_steps] # T X Nv X 3
+        start_idx += num_steps
+
+        # Compute contact between each human part and the object
+        part_contact_labels = {}
+        for part_name in part_vids_dict:
+            part_verts = human_verts[:, part_vids_dict[part_name], :] # T X Nv' X 3
+            if use_vectorized_query:
+                part_contact_labels[part_name] = compute_contact_labels_batch(obj_points, part_verts, \
+                                        part_faces_dict[part_name], contact_thresh) # T X N
+            else:
+                part_contact_labels[part_name] = np.stack([get_contact_labels(obj_points[t_idx], \
+                    part_verts[t_idx], part_faces_dict[part_name])[1] for t_idx in range(num_steps)])
+
+        curr_seq_contact_dict = {}
+        for part_name in part_contact_labels:
+            curr_seq_contact_dict[part_name+'_contact_labels'] = {}
+            for t_idx in range(num_steps):
+                curr_seq_contact_dict[part_name+'_contact_labels'][t_idx] = part_contact_labels[part_name][t_idx]
+
+        # Visulization of contact for debug, only for the first sequence of each subject and object pair
+        if dest_debug_vis_folder != "":
+            if not os.path.exists(dest_debug_vis_folder):
+                os.makedirs(dest_debug_vis_folder)
+
+            for t_idx in range(num_steps):
+                obj_vertex_colors = get_vertex_colors_in_contact(obj_points[t_idx], \
+                            [part_contact_labels['lhand'][t_idx], part_contact_labels['rhand'][t_idx], \
+                            part_contact_labels['lfoot'][t_idx], part_contact_labels['rfoot'][t_idx]], \
+                            [lhand_color, rhand_color, lfoot_color, rfoot_color])
+
+                dest_debug_obj_mesh_path = os.path.join(dest_debug_vis_folder, "%05d"%(t_idx)+"_object.ply")
+                sampled_points = trimesh.PointCloud(obj_points[t_idx], colors=obj_vertex_colors)
+                sampled_points.export(dest_debug_obj_mesh_path)
+
+                dest_debug_human_mesh_path = os.path.join(dest_debug_vis_folder, "%05d"%(t_idx)+"_human.obj")
+                write_obj(human_verts[t_idx], human_faces, dest_debug_human_mesh_path)
+
+        pkl.dump(curr_seq_contact_dict, open(dest_contact_pkl_path, 'wb'))
+
+    return len(job_list)
+
+def compute_contact_label_w_semantics(shard_idx=0, num_shards=1, num_workers=0, seq_batch_size=4, \
+    contact_thresh=0.03, use_vectorized_query=False):
+    # Sequences are split into num_shards shards by their sorted index, this call handles shard_idx.
+    # Within a shard, batches of seq_batch_size sequences run in num_workers processes (0: in this process).
+    # By default get_contact_labels is called frame by frame, as for the released labels.
+    # use_vectorized_query: contact if an object point is within contact_thresh of the part mesh, computed for all
+    # frames at once. This rule is not yet verified against get_contact_labels, keep it off for labels used in training.
+    motion_data_folder = "/move/u/jiamanli/datasets/FullBodyManipCapture/processed_manip_data/npz_files"
 
     dest_contact_npz_folder = "/move/u/jiamanli/datasets/FullBodyManipCapture/processed_manip_data/final_hand_foot_contact_pkl_files"
     dest_contact_vis_obj_folder = "/move/u/jiamanli/datasets/FullBodyManipCapture/processed_manip_data/final_hand_foot_contact_vis_obj"
@@ -181,180 +344,45 @@ def compute_contact_label_w_semantics():
     if not os.path.exists(dest_contact_vis_obj_folder):
         os.makedirs(dest_contact_vis_obj_folder)
 
-    subject_object_dict = {} 
-
     npz_files = os.listdir(motion_data_folder)
-    npz_files.sort() 
-
-    # block_idx = 0 
-    # block_size = 700 
-    # start_idx = block_idx * block_size 
-    # end_idx = (block_idx+1) * block_size 
+    npz_files.sort()
+    npz_files = npz_files[shard_idx::num_shards]
 
+    subject_object_dict = {}
+    job_list = []
     for npz_name in npz_files:
         dest_contact_pkl_path = os.path.join(dest_contact_npz_folder, npz_name.replace(".npz", ".pkl"))
         if os.path.exists(dest_contact_pkl_path):
-            continue 
-
-        npz_path = os.path.join(motion_data_folder, npz_name) 
-        npz_data = np.load(npz_path)
+            continue
 
         subject_name = npz_name.split("_")[0]
         object_name = npz_name.split("_")[1]
 
-        # tmp_k_name = subject_name + "_" + object_name 
-        # if tmp_k_name in subject_object_dict:
-        #     continue 
-
-        root_trans = torch.from_numpy(npz_data['root_trans']).float() # T X 3 
-        
-        root_orient = torch.from_numpy(npz_data['root_orient']).float() # T X 3 
-        pose_body = torch.from_numpy(npz_data['pose_body']).float() # T X 63 
-        aa_rot_rep = torch.cat((root_orient[:, None, :], pose_body.reshape(-1, 21, 3)), dim=1) # T X 22 X 3 
-
-        betas = torch.from_numpy(npz_data['betas']).float() # 1 X 16 
-        gender = npz_data['gender']
-
-        obj_rot = npz_data['obj_rot'] # T X 3 X 3 
-        obj_scale = npz_data['obj_scale'] # T 
-        obj_trans = npz_data['obj_trans'] # T X 3 X 1 
-
-        # Get object mesh 
-        obj_points = load_object_geometry(object_name, obj_scale, obj_rot, obj_trans) 
-
-        # Get human mesh 
-        human_jnts, human_verts, human_faces = run_smplx_model(root_trans[None], aa_rot_rep[None], betas, [gender], bm_dict) 
-
-        # Extract human part vertices 
-        left_hand_verts = human_verts[0][:, left_hand_vids, :].detach().cpu().numpy()
-        right_hand_verts = human_verts[0][:, right_hand_vids, :].detach().cpu().numpy()
-        left_foot_verts = human_verts[0][:, left_foot_vids, :].detach().cpu().numpy()
-        right_foot_verts = human_verts[0][:, right_foot_vids, :].detach().cpu().numpy()
-
-        curr_seq_contact_dict = {}
-        curr_seq_contact_dict['lhand_contact_labels'] = {}
-        curr_seq_contact_dict['rhand_contact_labels'] = {}
-        curr_seq_contact_dict['lfoot_contact_labels'] = {}
-        curr_seq_contact_dict['rfoot_contact_labels'] = {}
-
-        # Compute contact for between each human part and object 
-        num_steps = obj_points.shape[0]
-        for t_idx in range(num_steps): 
-            lhand_contact_part_points, lhand_contact_part_labels, lhand_contact_obj_verts = \
-                            get_contact_labels(obj_points[t_idx], left_hand_verts[t_idx], left_hand_faces) 
-
-            rhand_contact_part_points, rhand_contact_part_labels, rhand_contact_obj_verts = \
-                            get_contact_labels(obj_points[t_idx], right_hand_verts[t_idx], right_hand_faces) 
-
-            lfoot_contact_part_points, lfoot_contact_part_labels, lfoot_contact_obj_verts = \
-                            get_contact_labels(obj_points[t_idx], left_foot_verts[t_idx], left_foot_faces) 
-
-            rfoot_contact_part_points, rfoot_contact_part_labels, rfoot_contact_obj_verts = \
-                            get_contact_labels(obj_points[t_idx], right_foot_verts[t_idx], right_foot_faces) 
-
-
-            debug_part = False 
-            if debug_part:
-                dest_debug_vis_folder = os.path.join(dest_contact_vis_obj_folder, npz_name.replace(".npz", ""))
-                if not os.path.exists(dest_debug_vis_folder):
-                    os.makedirs(dest_debug_vis_folder) 
-
-                dest_debug_lhand_mesh_path = os.path.join(dest_debug_vis_folder, "%05d"%(t_idx)+"_lhand.obj")
-                debug_lhand_mesh = trimesh.Trimesh(
-                    vertices=left_hand_verts[t_idx],
-                    faces=left_hand_faces,
-                    process=False)
-                
-                debug_lhand_mesh.export(open(dest_debug_lhand_mesh_path, 'w'), file_type='obj')
-
-                dest_debug_rhand_mesh_path = os.path.join(dest_debug_vis_folder, "%05d"%(t_idx)+"_rhand.obj")
-                debug_rhand_mesh = trimesh.Trimesh(
-                    vertices=right_hand_verts[t_idx],
-                    faces=right_hand_faces,
-                    process=False)
-                
-                debug_rhand_mesh.export(open(dest_debug_rhand_mesh_path, 'w'), file_type='obj')
-
-                dest_debug_lfoot_mesh_path = os.path.join(dest_debug_vis_folder, "%05d"%(t_idx)+"_lfoot.obj")
-                debug_lfoot_mesh = trimesh.Trimesh(
-                    vertices=left_foot_verts[t_idx],
-                    faces=left_foot_faces,
-                    process=False)
-                
-                debug_lfoot_mesh.export(open(dest_debug_lfoot_mesh_path, 'w'), file_type='obj')
-
-                dest_debug_rfoot_mesh_path = os.path.join(dest_debug_vis_folder, "%05d"%(t_idx)+"_rfoot.obj")
-                debug_rfoot_mesh = trimesh.Trimesh(
-                    vertices=right_foot_verts[t_idx],
-                    faces=right_foot_faces,
-                    process=False)
-                
-                debug_rfoot_mesh.export(open(dest_debug_rfoot_mesh_path, 'w'), file_type='obj')
-
-            # Save to npz files. 
-            lhand_color = np.asarray([255, 87, 51])  # red 
-            rhand_color = np.asarray([134, 17, 226]) # purple 
-            lfoot_color = np.asarray([17, 99, 226]) # blue
-            rfoot_color = np.asarray([22, 173, 100]) # green 
-
-            # Visulization of contact for debug 
-            obj_vertex_colors = get_vertex_colors_in_contact(obj_points[t_idx], \
-                        [lhand_contact_part_labels, rhand_contact_part_labels, \
-                        lfoot_contact_part_labels, rfoot_contact_part_labels], \
-                        [lhand_color, rhand_color, lfoot_color, rfoot_color])
-            
-            curr_seq_contact_dict['lhand_contact_labels'][t_idx] = lhand_contact_part_labels
-            curr_seq_contact_dict['rhand_contact_labels'][t_idx] = rhand_contact_part_labels
-            curr_seq_contact_dict['lfoot_contact_labels'][t_idx] = lfoot_contact_part_labels
-            curr_seq_contact_dict['rfoot_contact_labels'][t_idx] = rfoot_contact_part_labels
-
-            # print("lhand contact labels sum:{0}".format(lhand_contact_part_labels.sum()))
-            # print("rhand contact labels sum:{0}".format(rhand_contact_part_labels.sum()))
-            # print("lfoot contact labels sum:{0}".format(lfoot_contact_part_labels.sum()))
-            # print("rfoot contact labels sum:{0}".format(rfoot_contact_part_labels.sum()))
-            # human_vertex_colors = np.zeros_like(human_verts[0][t_idx].detach().cpu().numpy()) # Nv X 3 
-            # for tmp_idx in range(human_vertex_colors.shape[0]):
-            #     human_vertex_colors[tmp_idx] = np.asarray([238, 228, 228])
-            
-            # dest_root_vis_folder = "./debug_contact_vis_mesh"
-            # dest_debug_vis_folder = os.path.join(dest_root_vis_folder, npz_name.replace(".npz", ""))
-            # if not os.path.exists(dest_debug_vis_folder):
-            #     os.makedirs(dest_debug_vis_folder)
-
-            tmp_k_name = subject_name + "_" + object_name 
-            if tmp_k_name not in subject_object_dict:
-                dest_debug_vis_folder = os.path.join(dest_contact_vis_obj_folder, npz_name.replace(".npz", ""))
-                if not os.path.exists(dest_debug_vis_folder):
-                    os.makedirs(dest_debug_vis_folder) 
-                dest_debug_obj_mesh_path = os.path.join(dest_debug_vis_folder, "%05d"%(t_idx)+"_object.ply")
-                # debug_obj_mesh = trimesh.Trimesh(
-                #     vertices=obj_verts[t_idx],
-                #     faces=obj_faces,
-                #     vertex_colors=obj_vertex_colors,
-                #     process=False)
-
-                # result = trimesh.exchange.ply.export_ply(debug_obj_mesh, encoding='ascii')
-                # output_file = open(dest_debug_obj_mesh_path, "wb+")
-                # output_file.write(result)
-                # output_file.close()
-
-                # debug_obj_mesh.export(open(dest_debug_obj_mesh_path, 'w'), file_type='ply')
-
-                sampled_points = trimesh.PointCloud(obj_points[t_idx], colors=obj_vertex_colors)
-                sampled_points.export(dest_debug_obj_mesh_path)
-
-                dest_debug_human_mesh_path = os.path.join(dest_debug_vis_folder, "%05d"%(t_idx)+"_human.obj")
-                debug_human_mesh = trimesh.Trimesh(
-                    vertices=human_verts[0][t_idx].detach().cpu().numpy(),
-                    faces=human_faces,
-                    # vertex_colors=obj_vertex_colors,
-                    process=False)
-                
-                debug_human_mesh.export(open(dest_debug_human_mesh_path, 'w'), file_type='obj')
-
-        pkl.dump(curr_seq_contact_dict, open(dest_contact_pkl_path, 'wb'))
-
-        subject_object_dict[tmp_k_name] = 1 
+        tmp_k_name = subject_name + "_" + object_name
+        if tmp_k_name not in subject_object_dict:
+            dest_debug_vis_folder = os.path.join(dest_contact_vis_obj_folder, npz_name.replace(".npz", ""))
+            subject_object_dict[tmp_k_name] = 1
+        else:
+            dest_debug_vis_folder = ""
+
+        job_list.append((os.path.join(motion_data_folder, npz_name), dest_contact_pkl_path, dest_debug_vis_folder))
+
+    batch_list = [job_list[b_idx:b_idx+seq_batch_size] for b_idx in range(0, len(job_list), seq_batch_size)]
+
+    num_done = 0
+    if num_workers == 0:
+        for seq_batch in batch_list:
+            num_done += compute_contact_labels_for_seq_batch(seq_batch, contact_thresh, use_vectorized_query)
+            print("Contact labels done for {0}/{1} sequences".format(num_done, len(job_list)))
+    else:
+        num_threads = max(1, multiprocessing.cpu_count() // num_workers)
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"), \
+            initializer=init_contact_label_worker, initargs=(num_threads,)) as executor:
+            futures = [executor.submit(compute_contact_labels_for_seq_batch, seq_batch, contact_thresh, \
+                    use_vectorized_query) for seq_batch in batch_list]
+            for future in as_completed(futures):
+                num_done += future.result()
+                print("Contact labels done for {0}/{1} sequences".format(num_done, len(job_list)))
 
 def check_contact_mode():
     contact_pkl_folder = "/move/u/jiamanli/datasets/FullBodyManipCapture/processed_manip_data/final_hand_foot_contact_pkl_files" 
@@ -382,4 +410,4 @@ if __name__ == "__main__":
 
     # sample_pcs_from_mesh() 
 
-    # compute_contact_label_w_semantics() 
+    # compute_contact_label_w_semantics(shard_idx=0, num_shards=1, num_workers=8) 